@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+from psycopg2.extras import RealDictCursor
+
+from common.notify import NotifyListener, publish
+
+USER_CHANNEL = 'user_profile'
+NOTIFY_BATCH = 500
+# Баланса в профиле нет: он меняется с каждой записью журнала и читается
+# отдельно (common.ledger.balance)
+PROFILE_FIELDS = ('id', 'name', 'email', 'phone', 'photo_url')
+
+
+class TokenCache:
+    """LRU проверенных JWT: повторный запрос с тем же токеном не считает HMAC.
+
+    Ключ - SHA-256 токена (сами токены в памяти не храним), значение -
+    user_id и exp; запись с истекшим exp отклоняется так же, как jwt.decode.
+    Невалидные токены не кэшируются.
+    """
+
+    def __init__(self, secret, maxsize=None, algorithms=('HS256',)):
+        self.secret = secret
+        self.maxsize = int(maxsize or os.getenv('TOKEN_CACHE_SIZE', 10000))
+        self.algorithms = list(algorithms)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {digest: (user_id, exp)}
+
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token):
+        """user_id из токена; jwt.InvalidTokenError, если токен невалиден или истек"""
+        digest = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                user_id, exp = entry
+                if exp is not None and exp <= time.time():
+                    del self._entries[digest]
+                    raise jwt.ExpiredSignatureError('Signature has expired')
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return user_id
+
+        payload = jwt.decode(token, self.secret, algorithms=self.algorithms)
+        user_id = payload['user_id']
+        with self._lock:
+            self.misses += 1
+            self._entries[digest] = (user_id, payload.get('exp'))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return user_id
+
+    def forget_user(self, user_id):
+        """Удаляет все токены пользователя: после смены пароля они проверяются заново.
+        Вызывается UserCache при уведомлении об изменении учетных данных"""
+        with self._lock:
+            for digest in [key for key, (uid, _) in self._entries.items() if uid == user_id]:
+                del self._entries[digest]
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class UserCache:
+    """Профили пользователей (без пароля) в памяти процесса.
+
+    Процесс, меняющий пользователя, вызывает notify() в своей транзакции
+    и invalidate() после коммита; остальные процессы узнают об изменении
+    через NOTIFY. Потерянное событие исправляется истечением ttl.
+    on_credentials_change(user_id) вызывается в каждом процессе, когда
+    изменились учетные данные (notify(..., credentials=True)).
+    """
+
+    def __init__(self, db_pool, ttl=None, maxsize=None, on_credentials_change=None):
+        self.db_pool = db_pool
+        self.on_credentials_change = on_credentials_change
+        self.ttl = float(ttl or os.getenv('USER_CACHE_TTL', 30))
+        self.maxsize = int(maxsize or os.getenv('USER_CACHE_SIZE', 10000))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {user_id: (profile, expires_at)}
+        self._listener = NotifyListener(
+            db_pool.db_config, USER_CHANNEL, self._on_notify,
+            on_connect=self.invalidate, name='User cache',
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Профиль пользователя (dict) или None, если пользователя нет"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[0])
+            self.misses += 1
+
+        with self.db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(f"SELECT {', '.join(PROFILE_FIELDS)} FROM users WHERE id = %s", (user_id,))
+            profile = cur.fetchone()
+        if profile is None:
+            return None
+
+        profile = dict(profile)
+        with self._lock:
+            self._entries[user_id] = (profile, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dict(profile)
+
+    def notify(self, cursor, user_id, credentials=False):
+        """Сообщает другим процессам об изменении пользователя; доставляется при коммите"""
+        message = {'id': int(user_id)}
+        if credentials:
+            message['credentials'] = True
+        publish(cursor, USER_CHANNEL, message)
+
+    def notify_many(self, cursor, user_ids):
+        """Изменение множества пользователей - одно уведомление на NOTIFY_BATCH"""
+        user_ids = [int(user_id) for user_id in user_ids]
+        for i in range(0, len(user_ids), NOTIFY_BATCH):
+            publish(cursor, USER_CHANNEL, {'ids': user_ids[i:i + NOTIFY_BATCH]})
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def _on_notify(self, payload):
+        try:
+            message = json.loads(payload)
+            user_ids = message['ids'] if 'ids' in message else [message['id']]
+        except (ValueError, KeyError, TypeError):
+            self.invalidate()
+            return
+        for user_id in user_ids:
+            self.invalidate(user_id)
+            if message.get('credentials') and self.on_credentials_change:
+                self.on_credentials_change(user_id)
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+class CurrentUser(int):
+    """Пользователь запроса: ведет себя как его id (в SQL, сравнениях, JSON),
+    профиль берется из UserCache при первом обращении"""
+
+    def __new__(cls, user_id, cache):
+        user = super().__new__(cls, user_id)
+        user._cache = cache
+        user._profile = None
+        return user
+
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._profile = self._cache.get(int(self))
+        return self._profile
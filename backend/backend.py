@@ -1,15 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from datetime import datetime, timedelta
 from functools import wraps
-import socket
+import hashlib
 import json
+import math
 import threading
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.charging import (
+    NO_SESSION, NO_STATION, NOT_CHARGING, RESERVED_BY_OTHER, STOPPED, UNAVAILABLE,
+    cancel_session, install as install_charging_functions, start_session, stop_session,
+)
+from common.commands import ACK, ACK_ACTION, ACKS_CAPABILITY, EXPIRED, NACK, NOT_CONNECTED, CommandDispatcher
+from common.db import DatabasePool
+from common.gateway import StationGateway
+from common.ingest import EnergyIngestor
+from common.ledger import (
+    DEPOSIT, LedgerSettlement, balance as ledger_balance, init_db as init_ledger,
+)
+from common.liveness import LivenessTable
+from common.pubsub import TelemetryHub
+from common.registry import COMMAND, ConnectionRegistry
+from common.reservations import (
+    CANCELLED, CONFLICT, FORBIDDEN, NOT_FOUND, ReservationEngine,
+)
+from common.routing import CommandBus
+from common.station_cache import StationStateCache
+from common.tariffs import TariffEngine
+from common.timeseries import ROLLUPS, MeterSeries
+from auth import CurrentUser, TokenCache, UserCache
+from geo import MAX_CLUSTER_ZOOM, StationIndex
+from passwords import Overloaded, PasswordHasher, RateLimiter
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -17,10 +46,12 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = "12345"
 # Функция для подключения к PostgreSQL
 
+# Очереди команд станциям с подтверждениями; HTTP-поток ждет итог не дольше дедлайна
+command_dispatcher = CommandDispatcher()
+COMMAND_DEADLINE = float(os.getenv('COMMAND_DEADLINE', 10))
+
 class ChargingStationManager:
     _instance = None
-    connections = {}  # Хранит соединения с станциями: {station_id: socket}
-    command_sockets = {}  # Хранит командные соединения с станциями
     
     def __new__(cls):
         if cls._instance is None:
@@ -29,53 +60,139 @@ class ChargingStationManager:
         return cls._instance
     
     def init(self):
-        # Здесь можно добавить инициализацию, если нужно
-        pass
+        # Основное и командное соединения станций с обратным поиском по соединению;
+        # станции без heartbeat дольше STATION_TIMEOUT отключаются
+        self.registry = ConnectionRegistry(on_evict=self.on_evict)
     
-    def add_connection(self, station_id, socket):
-        self.connections[station_id] = socket
+    def add_connection(self, station_id, channel):
+        self.registry.register(station_id, channel)
     
-    def add_command_connection(self, station_id, socket):
-        self.command_sockets[station_id] = socket
+    def add_command_connection(self, station_id, channel, acks=True):
+        self.registry.register(station_id, channel, COMMAND)
+        command_dispatcher.register(station_id, channel, acks)
+        command_bus.claim(station_id)
     
-    def remove_connection(self, station_id):
-        self.connections.pop(station_id, None)
-        self.command_sockets.pop(station_id, None)
+    def remove_channel(self, channel):
+        """Закрытое соединение; возвращает (station_id, вид) или None"""
+        command_dispatcher.unregister(channel)
+        owner = self.registry.unregister(channel)
+        if owner and owner[1] == COMMAND:
+            command_bus.release(owner[0])
+        return owner
     
-    def send_command(self, station_id, command):
-        """Отправляет команду на станцию через отдельное соединение"""
-        try:
-            if station_id in self.command_sockets:
-                sock = self.command_sockets[station_id]
-                sock.sendall(json.dumps(command).encode('utf-8'))
-                return True
-            return False
-        except Exception as e:
-            print(f"Error sending command to station {station_id}: {e}")
-            self.command_sockets.pop(station_id, None)
-            return False
+    def touch(self, station_id):
+        self.registry.touch(station_id)
+    
+    def is_connected(self, station_id):
+        return self.registry.is_connected(station_id)
+    
+    def on_evict(self, station_id, channels):
+        for channel in channels:
+            command_dispatcher.unregister(channel)
+        # Удаляет запись владения, только если она все еще наша
+        command_bus.release(station_id)
+    
+    def send_command(self, station_id, command, timeout=COMMAND_DEADLINE):
+        """Ставит команду в очередь станции (на любом шлюзе) и ждет подтверждения не дольше timeout"""
+        return command_bus.send(station_id, command, timeout)
         
 
 station_manager = ChargingStationManager()        
 
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host='localhost',
-        database='postgres',
-        user='postgres',
-        password='postgres',
-        port='5432'
-    )
-    return conn
+# Общий пул соединений для HTTP-маршрутов и сокет-сервера
+db_pool = DatabasePool()
+
+# Порт сокет-сервера станций; входит в идентификатор шлюза
+SOCKET_PORT = 9090
+
+# Команды станциям, подключенным к другим экземплярам шлюза, идут через NOTIFY;
+# станция переподключилась к другому шлюзу - здешние соединения закрываются
+command_bus = CommandBus(
+    db_pool, command_dispatcher, on_ownership_lost=station_manager.registry.disconnect, port=SOCKET_PORT,
+)
+
+# Последние heartbeat станций: читаются из памяти, в БД пишутся пачками
+liveness = LivenessTable(db_pool)
+
+# Показания энергии из update-кадров пишутся пачками
+ingestor = EnergyIngestor(db_pool)
+
+# Пространственный индекс станций для поиска ближайших
+station_index = StationIndex()
+station_index_lock = threading.Lock()
+
+# Кэш состояния станций; изменения из других процессов приходят через NOTIFY
+station_cache = StationStateCache(db_pool)
+station_cache.subscribe(lambda station_id, fields: station_index.update(station_id, **fields))
+
+# Стоимость сессий по тарифам станций, считается на каждом update-кадре
+tariffs = TariffEngine(db_pool)
+station_cache.subscribe(tariffs.on_state_change)
+
+# История показаний сессий: сырые кадры по суткам и свертки 1m/1h/1d
+meter_series = MeterSeries(db_pool)
+
+# Живая телеметрия сессий для /api/sessions/<id>/stream
+telemetry_hub = TelemetryHub()
+active_sessions = {}  # {station_id: session_id} - сессии, о которых знает этот процесс
+STREAM_KEEPALIVE = 15  # секунд между комментариями keep-alive в пустом стриме
+
+def publish_station_state(station_id, fields):
+    """Смена статуса или мощности станции уходит в стрим ее текущей сессии"""
+    session_id = active_sessions.get(station_id)
+    if session_id is None or not ({'status', 'power'} & fields.keys()):
+        return
+    if fields.get('status', 'busy') != 'busy':
+        # Сессию завершил другой процесс - итоговой энергии здесь нет
+        active_sessions.pop(station_id, None)
+        telemetry_hub.close_topic(session_id, {'event': 'end', 'session_id': session_id, **fields})
+        return
+    telemetry_hub.publish(session_id, {'event': 'status', 'session_id': session_id, **fields})
+
+station_cache.subscribe(publish_station_state)
+
+# Бронирование станций; просроченные брони снимает фоновая уборка
+reservations = ReservationEngine(db_pool, station_cache)
+
+# Проверенные JWT и профили пользователей: горячие авторизованные запросы
+# не считают HMAC и не читают пользователя из БД заново; смена учетных
+# данных в любом процессе сбрасывает закэшированные токены пользователя
+token_cache = TokenCache(app.config['SECRET_KEY'])
+user_cache = UserCache(db_pool, on_credentials_change=token_cache.forget_user)
+
+
+# Баланс - журнал записей; users.balance обновляет фоновый расчет пачками.
+# Каждая запись в users (в т.ч. расчет) уведомляет кэши пользователей
+ledger = LedgerSettlement(db_pool, on_settle=user_cache.notify_many)
+
+# Хеширование паролей - в пуле процессов, чтобы шторм входов не занимал
+# HTTP-потоки; лимиты по IP и email отсекают запросы до хеширования
+password_hasher = PasswordHasher()
+login_ip_limiter = RateLimiter(os.getenv('LOGIN_RATE_PER_IP', 5), os.getenv('LOGIN_BURST_PER_IP', 20))
+login_email_limiter = RateLimiter(os.getenv('LOGIN_RATE_PER_EMAIL', 0.2), os.getenv('LOGIN_BURST_PER_EMAIL', 5))
+# У регистрации свой лимит: шторм регистраций с адреса не блокирует входы с него
+register_ip_limiter = RateLimiter(os.getenv('REGISTER_RATE_PER_IP', 0.5), os.getenv('REGISTER_BURST_PER_IP', 10))
+
+
+def too_many_requests(retry_after):
+    response = jsonify({'error': 'Too many requests, try again later'})
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response, 429
+
+
+def hashing_overloaded(e):
+    response = jsonify({'error': 'Server is busy, try again later'})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
 
 # Инициализация БД (выполняется один раз)
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
     
-    # Создаем таблицу, если она не существует
-    cursor.execute('''  
+        # Создаем таблицу, если она не существует
+        cursor.execute('''  
         CREATE TABLE IF NOT EXISTS transactions (
             id SERIAL PRIMARY KEY,
             user_id INTEGER REFERENCES users(id) NOT NULL,
@@ -88,6 +205,58 @@ def init_db():
         );              
     ''')
     
+        # Индексы для фильтров списка станций (см. build_stations_query)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS charging_stations_filters_idx
+            ON charging_stations (status, connector_type, current_type, power)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS charging_stations_status_id_idx
+            ON charging_stations (status, id)
+        ''')
+
+        # Версия таблицы станций: каждое изменение строки получает новое
+        # значение из последовательности (ETag станции) и номер изменившей
+        # ее транзакции (?since= в /api/stations, см. current_stations_version)
+        cursor.execute('CREATE SEQUENCE IF NOT EXISTS charging_stations_version_seq')
+        cursor.execute('''
+            ALTER TABLE charging_stations
+            ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('charging_stations_version_seq'),
+            ADD COLUMN IF NOT EXISTS version_xid xid8 NOT NULL DEFAULT pg_current_xact_id()
+        ''')
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION charging_stations_bump_version() RETURNS trigger AS $$
+            BEGIN
+                -- Отметка живости (last_connection) изменением станции не считается
+                IF to_jsonb(NEW) - 'last_connection' - 'version' - 'version_xid'
+                   IS DISTINCT FROM to_jsonb(OLD) - 'last_connection' - 'version' - 'version_xid' THEN
+                    NEW.version := nextval('charging_stations_version_seq');
+                    NEW.version_xid := pg_current_xact_id();
+                END IF;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        cursor.execute('DROP TRIGGER IF EXISTS charging_stations_version_trg ON charging_stations')
+        cursor.execute('''
+            CREATE TRIGGER charging_stations_version_trg
+            BEFORE UPDATE ON charging_stations
+            FOR EACH ROW EXECUTE FUNCTION charging_stations_bump_version()
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS charging_stations_version_idx
+            ON charging_stations (version)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS charging_stations_version_xid_idx
+            ON charging_stations (version_xid)
+        ''')
+        reservations.init_db(cursor)
+        init_ledger(cursor)
+        tariffs.init_db(cursor)
+        meter_series.init_db(cursor)
+        install_charging_functions(cursor)
+
     # # Проверяем, есть ли данные в таблице
     # cursor.execute('SELECT COUNT(*) FROM charging_stations')
     # if cursor.fetchone()[0] == 0:
@@ -105,9 +274,8 @@ def init_db():
     #         'Station 3', '789 Pine Blvd', 55.7500, 37.6150, 'CCS', 'DC', 100.0, 'maintenance', 'http://example.com/photo3.jpg', 1
     #     ))
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+        conn.commit()
+        cursor.close()
 
 
 # Генерация JWT токена
@@ -131,12 +299,12 @@ def token_required(f):
             return jsonify({'message': 'Token is missing!'}), 401
             
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = data['user_id']
-        except:
+            user_id = token_cache.verify(token)
+        except (jwt.InvalidTokenError, KeyError):
             return jsonify({'message': 'Token is invalid!'}), 401
-            
-        return f(current_user, *args, **kwargs)
+        
+        # Ведет себя как id пользователя; профиль - current_user.profile
+        return f(CurrentUser(user_id, user_cache), *args, **kwargs)
         
     return decorated
 
@@ -147,41 +315,47 @@ def register():
     if not request.is_json:
         return jsonify({'error': 'Content-Type must be application/json'}), 415
     
-    data = request.get_json()
+    data = request.get_json(silent=True)
     
     # Валидация входных данных
-    if not data:
+    if not data or not isinstance(data, dict):
         return jsonify({'error': 'No data provided'}), 400
         
     required_fields = ['name', 'email', 'password']
     for field in required_fields:
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
+        if not isinstance(data[field], str) or not data[field].strip():
+            return jsonify({'error': f'{field} must be a non-empty string'}), 400
     
     if len(data['password']) < 6:
         return jsonify({'error': 'Password must be at least 6 characters'}), 400
     
-    # Хеширование пароля (исправленная версия)
-    hashed_password = generate_password_hash(data['password'])
+    retry_after = register_ip_limiter.acquire(request.remote_addr)
+    if retry_after:
+        return too_many_requests(retry_after)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    try:
+        hashed_password = password_hasher.hash(data['password'])
+    except Overloaded as e:
+        return hashing_overloaded(e)
     
     try:
-        cursor.execute('''
-            INSERT INTO users (name, email, password, phone, photo_url)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (
-            data['name'],
-            data['email'],
-            hashed_password,
-            data.get('phone'),
-            data.get('photo_url')
-        ))
-        
-        user_id = cursor.fetchone()[0]
-        conn.commit()
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO users (name, email, password, phone, photo_url)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (
+                data['name'],
+                data['email'],
+                hashed_password,
+                data.get('phone'),
+                data.get('photo_url')
+            ))
+            
+            user_id = cursor.fetchone()[0]
+            conn.commit()
         
         # Генерация токена
         token = generate_token(user_id)
@@ -193,76 +367,58 @@ def register():
         }), 201
         
     except psycopg2.IntegrityError as e:
-        conn.rollback()
         if 'users_email_key' in str(e):
             return jsonify({'error': 'Email already exists'}), 409
         return jsonify({'error': 'Database integrity error'}), 400
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-        
-    finally:
-        cursor.close()
-        conn.close()
 
 
 @app.route('/api/stations/<int:station_id>/reserve', methods=['POST'])
 @token_required
 def reserve_station(current_user, station_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Проверяем текущий статус станции
-        cursor.execute('''
-            SELECT status, reserved_by FROM charging_stations WHERE id = %s
-        ''', (station_id,))
-        
-        station = cursor.fetchone()
-        
-        if not station:
+        # Занятую станцию отклоняем по кэшу, не обращаясь к БД; бронь
+        # могла истечь, поэтому 'reserved' проверяет уже сам UPDATE
+        state = station_cache.get(station_id)
+        if not state:
             return jsonify({'error': 'Station not found'}), 404
-            
-        current_status = station[0]
-        reserved_by = station[1]
-        
-        if current_status != 'free':
+        if state['status'] not in ('free', 'reserved'):
             return jsonify({
                 'error': 'Station is not available for reservation',
-                'current_status': current_status,
-                'reserved_by': reserved_by
+                'current_status': state['status'],
+                'reserved_by': state['reserved_by']
             }), 409
         
-        # 2. Обновляем статус станции и записываем ID пользователя
-        cursor.execute('''
-            UPDATE charging_stations 
-            SET status = 'reserved', reserved_by = %s
-            WHERE id = %s
-            RETURNING id, status, reserved_by
-        ''', (current_user, station_id))
-        
-        updated_station = cursor.fetchone()
-        
-    
-        
-       
-        
-        conn.commit()
+        data = request.get_json(silent=True) or {}
+        try:
+            ttl = float(data['ttl']) if data.get('ttl') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'ttl must be a number of seconds'}), 400
+        if ttl is not None and not 0 < ttl <= reservations.ttl:
+            return jsonify({'error': f'ttl must be between 0 and {reservations.ttl:.0f} seconds'}), 400
+        
+        result = reservations.reserve(station_id, current_user, ttl)
+        if result['result'] == NOT_FOUND:
+            return jsonify({'error': 'Station not found'}), 404
+        if result['result'] == CONFLICT:
+            return jsonify({
+                'error': 'Station is not available for reservation',
+                'current_status': result['status'],
+                'reserved_by': result['reserved_by']
+            }), 409
         
         return jsonify({
             'message': 'Station reserved successfully',
-            'station_id': updated_station[0],
-            'new_status': updated_station[1],
-            'reserved_by': updated_station[2]
+            'station_id': station_id,
+            'new_status': result['status'],
+            'reserved_by': result['reserved_by'],
+            'reserved_until': result['reserved_until'].isoformat(),
         }), 200
         
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': str(e)}), 500
-        
-    finally:
-        cursor.close()
-        conn.close()
 
 
 
@@ -271,50 +427,20 @@ def reserve_station(current_user, station_id):
 @token_required
 def cancel_reservation(current_user, station_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Проверяем, что станция зарезервирована текущим пользователем
-        cursor.execute('''
-            SELECT reserved_by FROM charging_stations 
-            WHERE id = %s AND status = 'reserved'
-        ''', (station_id,))
-        
-        station = cursor.fetchone()
-        
-        if not station:
-            return jsonify({'error': 'Station is not reserved'}), 400
-            
-        if station[0] != current_user:
+        result = reservations.cancel(station_id, current_user)
+        if result['result'] == FORBIDDEN:
             return jsonify({'error': 'You are not the reserving user'}), 403
-        
-        # 2. Обновляем статус станции
-        cursor.execute('''
-            UPDATE charging_stations 
-            SET status = 'free', reserved_by = NULL
-            WHERE id = %s
-            RETURNING id, status
-        ''', (station_id,))
-        
-        updated_station = cursor.fetchone()
-        
-    
-        
-        conn.commit()
+        if result['result'] != CANCELLED:
+            return jsonify({'error': 'Station is not reserved'}), 400
         
         return jsonify({
             'message': 'Reservation cancelled successfully',
-            'station_id': updated_station[0],
-            'new_status': updated_station[1],
+            'station_id': station_id,
+            'new_status': result['status'],
         }), 200
         
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': str(e)}), 500
-        
-    finally:
-        cursor.close()
-        conn.close()
 
 
 @app.route('/api/balance/replenish', methods=['POST'])
@@ -339,59 +465,44 @@ def replenish_balance(current_user):
         # Здесь должна быть реальная логика обработки платежа через платежный шлюз
         # Для примера просто имитируем успешную оплату
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         try:
-            # 1. Создаем запись о транзакции
-            cursor.execute('''
-                INSERT INTO transactions 
-                (user_id, amount, transaction_type, status, card_last_four)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id
-            ''', (
-                current_user,
-                amount,
-                'deposit',
-                'completed',
-                data['card_number'][-4:]  # сохраняем последние 4 цифры карты
-            ))
-            
-            transaction_id = cursor.fetchone()[0]
-            
-            # 2. Обновляем баланс пользователя
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance + %s 
-                WHERE id = %s
-                RETURNING balance
-            ''', (amount, current_user))
-            
-            new_balance = cursor.fetchone()[0]
-            
-            # 3. Обновляем статус транзакции как завершенной
-            cursor.execute('''
-                UPDATE transactions 
-                SET completed_at = CURRENT_TIMESTAMP 
-                WHERE id = %s
-            ''', (transaction_id,))
-            
-            conn.commit()
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                # Платеж и запись журнала - один запрос; строку пользователя
+                # не трогаем, баланс пересчитает LedgerSettlement
+                cursor.execute('''
+                    WITH payment AS (
+                        INSERT INTO transactions
+                        (user_id, amount, transaction_type, status, card_last_four, completed_at)
+                        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                        RETURNING id, user_id, amount
+                    )
+                    INSERT INTO ledger_entries (user_id, amount, kind, reference_id)
+                    SELECT user_id, amount, %s, id FROM payment
+                    RETURNING reference_id
+                ''', (
+                    current_user,
+                    amount,
+                    'deposit',
+                    'completed',
+                    data['card_number'][-4:],  # сохраняем последние 4 цифры карты
+                    DEPOSIT,
+                ))
+                
+                transaction_id = cursor.fetchone()[0]
+                new_balance = ledger_balance(cursor, current_user)
+                user_cache.notify(cursor, current_user)
+                conn.commit()
+            user_cache.invalidate(current_user)
             
             return jsonify({
                 'message': 'Balance replenished successfully',
-                'new_balance': float(new_balance),
+                'new_balance': new_balance,
                 'transaction_id': transaction_id
             }), 200
             
         except Exception as e:
-            conn.rollback()
             return jsonify({'error': f'Database error: {str(e)}'}), 500
             
-        finally:
-            cursor.close()
-            conn.close()
-            
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -400,20 +511,11 @@ def replenish_balance(current_user):
 @token_required
 def get_balance(current_user):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT balance FROM users WHERE id = %s
-        ''', (current_user,))
-        
-        balance = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
-        
-        if balance:
-            return jsonify({'balance': float(balance[0])}), 200
+        # Рассчитанный баланс плюс еще не рассчитанные записи журнала
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            balance = ledger_balance(cursor, current_user)
+        if balance is not None:
+            return jsonify({'balance': balance}), 200
         else:
             return jsonify({'error': 'User not found'}), 404
             
@@ -424,26 +526,49 @@ def get_balance(current_user):
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
-        if not data or not data.get('email') or not data.get('password'):
+        # Типы проверяются до лимитов: email нормализуется для ключа лимита
+        if not isinstance(data, dict) or not all(
+            isinstance(data.get(field), str) and data[field].strip() for field in ('email', 'password')
+        ):
             return jsonify({'error': 'Email and password required'}), 400
-            
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('''
-        SELECT id, password FROM users WHERE email = %s
-        ''', (data['email'],))
         
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        # Лимиты проверяются до запроса к БД и хеширования
+        retry_after = (login_ip_limiter.acquire(request.remote_addr)
+                       or login_email_limiter.acquire(data['email'].strip().lower()))
+        if retry_after:
+            return too_many_requests(retry_after)
+            
+        with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('''
+            SELECT id, password FROM users WHERE email = %s
+            ''', (data['email'],))
+            
+            user = cursor.fetchone()
         
         if not user:
             return jsonify({'error': 'Invalid credentials'}), 401
             
-        if check_password_hash(user['password'], data['password']):
+        if password_hasher.verify(user['password'], data['password']):
+            if password_hasher.needs_rehash(user['password']):
+                # Хеш со старыми параметрами заменяем в фоне; условие по
+                # старому хешу не затирает пароль, смененный за это время
+                def save(new_hash, user_id=user['id'], old_hash=user['password']):
+                    with db_pool.connection() as conn, conn.cursor() as cursor:
+                        cursor.execute(
+                            'UPDATE users SET password = %s WHERE id = %s AND password = %s',
+                            (new_hash, user_id, old_hash)
+                        )
+                        updated = cursor.rowcount
+                        if updated:
+                            user_cache.notify(cursor, user_id, credentials=True)
+                        conn.commit()
+                    if updated:
+                        user_cache.invalidate(user_id)
+                        token_cache.forget_user(user_id)
+                password_hasher.rehash_later(data['password'], save)
+            
             token = generate_token(user['id'])
             
             return jsonify({
@@ -454,6 +579,8 @@ def login():
         else:
             return jsonify({'error': 'Invalid credentials'}), 401
             
+    except Overloaded as e:
+        return hashing_overloaded(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -462,21 +589,11 @@ def login():
 @token_required
 def get_current_user(current_user):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute('''
-        SELECT id, name, email, phone, balance, photo_url 
-        FROM users WHERE id = %s
-        ''', (current_user,))
-        
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
+        user = current_user.profile
         if user:
-            # Убираем чувствительные данные перед отправкой
-            user.pop('password', None)
+            # Баланс - как в /api/balance, с еще не рассчитанными записями журнала
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                user['balance'] = ledger_balance(cursor, current_user)
             return jsonify(user), 200
         else:
             return jsonify({'error': 'User not found'}), 404
@@ -485,17 +602,52 @@ def get_current_user(current_user):
         return jsonify({'error': str(e)}), 500
 
 
+def apply_last_seen(station):
+    """Подставляет last_connection из памяти - в БД он может отставать на интервал сброса"""
+    last_seen = liveness.last_seen(station['id'])
+    if last_seen and (station.get('last_connection') is None or station['last_connection'] < last_seen):
+        station['last_connection'] = last_seen
+    return station
+
+# Поля станции, которые отдаются в списке
+STATION_LIST_COLUMNS = [
+    'id', 'name', 'address', 'latitude', 'longitude', 'connector_type',
+    'current_type', 'power', 'status', 'photo_url', 'tariff_id',
+    'reserved_by', 'last_connection', 'version',
+]
+STATIONS_PAGE_SIZE = 1000
+STATIONS_MAX_PAGE_SIZE = 5000
+
+def build_stations_query(filters, after_id=0, limit=STATIONS_PAGE_SIZE, since=None):
+    """Собирает запрос списка станций с фильтрами и пагинацией по id"""
+    conditions = [sql.SQL('id > %s')]
+    params = [after_id]
+    
+    # Только станции, измененные транзакциями с номером не меньше since
+    if since is not None:
+        conditions.append(sql.SQL('version_xid >= %s::text::xid8'))
+        params.append(str(since))
+    
+    for key, value in filters.items():
+        if value is None or value == '':
+            continue
+        if key == 'min_power':
+            conditions.append(sql.SQL('power >= %s'))
+        else:
+            conditions.append(sql.SQL('{} = %s').format(sql.Identifier(key)))
+        params.append(value)
+    
+    query = sql.SQL('SELECT {columns} FROM charging_stations WHERE {conditions} ORDER BY id LIMIT %s').format(
+        columns=sql.SQL(', ').join(map(sql.Identifier, STATION_LIST_COLUMNS)),
+        conditions=sql.SQL(' AND ').join(conditions),
+    )
+    params.append(limit)
+    return query, params
+
 # Маршрут для получения списка всех зарядных станций
 @app.route('/api/stations', methods=['GET'])
 def get_stations():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Базовый запрос
-        base_query = sql.SQL('SELECT * FROM charging_stations')
-        params = []
-        
         # Параметры фильтрации
         filters = {
             'connector_type': request.args.get('connector_type'),
@@ -504,29 +656,156 @@ def get_stations():
             'status': request.args.get('status')
         }
         
-        # Добавляем условия фильтрации
-        conditions = []
-        for key, value in filters.items():
-            if value:
-                if key == 'min_power':
-                    conditions.append(sql.SQL('power >= {}').format(sql.Literal(value)))
-                else:
-                    conditions.append(sql.SQL('{} = {}').format(
-                        sql.Identifier(key),
-                        sql.Literal(value)
-                    ))
+        # Числовые фильтры приводятся до выбора ветки: и область карты,
+        # и список отвечают 400 на нечисловое значение
+        if filters['min_power']:
+            try:
+                min_power = float(filters['min_power'])
+            except ValueError:
+                min_power = math.nan
+            if math.isnan(min_power):
+                return jsonify({'error': 'min_power must be a number'}), 400
+            filters['min_power'] = min_power
+        
+        # Видимая область карты: кластеры или станции в зависимости от масштаба
+        if request.args.get('bbox'):
+            return get_stations_in_viewport(filters)
+        
+        # Пагинация по ключу: следующая страница начинается после after_id
+        try:
+            after_id = int(request.args.get('after_id', 0))
+            limit = min(int(request.args.get('limit', STATIONS_PAGE_SIZE)), STATIONS_MAX_PAGE_SIZE)
+            since = int(request.args['since']) if request.args.get('since') else None
+        except ValueError:
+            return jsonify({'error': 'after_id, limit and since must be numbers'}), 400
         
-        if conditions:
-            query = sql.SQL(' ').join([base_query, sql.SQL('AND '), sql.SQL(' AND ').join(conditions)])
-        else:
-            query = base_query
+        if limit <= 0:
+            return jsonify({'error': 'limit must be positive'}), 400
         
-        # Выполняем запрос
-        cursor.execute(query)
-        stations = cursor.fetchall()
+        query, params = build_stations_query(filters, after_id, limit + 1, since)
         
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Версию читаем до выборки: изменение, попавшее между ними,
+            # клиент получит повторно со следующим since, но не потеряет
+            version, watermark = current_stations_version(cursor)
+            etag = f'stations-{version}-{watermark}-{stations_query_key(filters, after_id, limit, since)}'
+            if request.if_none_match.contains(etag):
+                return not_modified(etag)
+            
+            cursor.execute(query, params)
+            stations = cursor.fetchall()
+        
+        # Лишняя строка означает, что есть следующая страница
+        next_after_id = None
+        if len(stations) > limit:
+            stations = stations[:limit]
+            next_after_id = stations[-1]['id']
+        
+        for station in stations:
+            apply_last_seen(station)
+        
+        response = jsonify({'stations': stations, 'next_after_id': next_after_id, 'version': watermark})
+        return with_etag(response, etag), 200
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def get_stations_in_viewport(filters):
+    try:
+        min_lon, min_lat, max_lon, max_lat = map(float, request.args['bbox'].split(','))
+        zoom = int(request.args.get('zoom', MAX_CLUSTER_ZOOM + 1))
+    except ValueError:
+        return jsonify({'error': 'bbox must be min_lon,min_lat,max_lon,max_lat and zoom an integer'}), 400
+    
+    if min_lat > max_lat or min_lon > max_lon:
+        return jsonify({'error': 'Invalid bbox'}), 400
+    
+    filters = {key: value or None for key, value in filters.items()}
+    index = ensure_station_index()
+    
+    if zoom <= MAX_CLUSTER_ZOOM:
+        clusters = index.clusters_in_bbox(zoom, min_lat, min_lon, max_lat, max_lon, **filters)
+        return jsonify({'zoom': zoom, 'clusters': clusters}), 200
+    
+    stations = [
+        apply_last_seen(station)
+        for station in index.in_bbox(min_lat, min_lon, max_lat, max_lon, **filters)
+    ]
+    return jsonify({'zoom': zoom, 'stations': stations}), 200
+
+def stations_query_key(filters, after_id, limit, since):
+    """Хеш нормализованных параметров списка: у разных страниц и фильтров разные ETag"""
+    params = {key: None if value == '' else value for key, value in filters.items()}
+    params.update(after_id=after_id, limit=limit, since=since)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def current_stations_version(cursor):
+    """Версия таблицы станций: (последнее значение последовательности, since для следующего запроса).
+
+    Значение последовательности выдается в транзакции, которая может
+    зафиксироваться позже транзакции с большим значением, поэтому since -
+    не оно, а xmin текущего снимка: все транзакции с меньшим номером уже
+    завершены, а незавершенные и будущие получат номер не меньше. Строки
+    таких транзакций попадут в выборку version_xid >= since, возможно
+    повторно. По той же причине xmin входит и в ETag списка.
+    """
+    cursor.execute('''
+        SELECT last_value AS version,
+               pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS watermark
+        FROM charging_stations_version_seq
+    ''')
+    row = cursor.fetchone()
+    return row['version'], row['watermark']
+
+def with_etag(response, etag):
+    """ETag ответа; no-cache - клиент каждый раз перепроверяет его через If-None-Match"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def not_modified(etag):
+    return with_etag(app.response_class(status=304), etag)
+
+def ensure_station_index():
+    """Загружает индекс станций из БД при первом обращении"""
+    if station_index.loaded:
+        return station_index
+    with station_index_lock:
+        if not station_index.loaded:
+            with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute('SELECT * FROM charging_stations')
+                station_index.load(cursor.fetchall())
+    return station_index
+
+# Поиск ближайших станций
+@app.route('/api/stations/nearby', methods=['GET'])
+def get_nearby_stations():
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius = min(float(request.args.get('radius', 10)), 200.0)  # км
+        limit = min(int(request.args.get('limit', 20)), 100)
+        min_power = float(request.args['min_power']) if request.args.get('min_power') else None
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lon are required, radius, limit and min_power must be numbers'}), 400
+    
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or radius <= 0 or limit <= 0:
+        return jsonify({'error': 'Invalid coordinates, radius or limit'}), 400
+    
+    try:
+        nearest = ensure_station_index().nearest(
+            lat, lon, radius_km=radius, limit=limit,
+            connector_type=request.args.get('connector_type'),
+            current_type=request.args.get('current_type'),
+            min_power=min_power,
+            status=request.args.get('status'),
+        )
+        
+        stations = []
+        for distance, station in nearest:
+            station = apply_last_seen(station)
+            station['distance_km'] = round(distance, 3)
+            stations.append(station)
         
         return jsonify({'stations': stations}), 200
     
@@ -537,26 +816,76 @@ def get_stations():
 @app.route('/api/stations/<int:station_id>', methods=['GET'])
 def get_station(station_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(
-            'SELECT * FROM charging_stations WHERE id = %s',
-            (station_id,)
-        )
-        station = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
-        
-        if station:
-            return jsonify(station), 200
-        else:
-            return jsonify({'error': 'Station not found'}), 404
+        with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # Сначала только версия строки: если клиент ее уже видел, тело не нужно
+            cursor.execute('SELECT version FROM charging_stations WHERE id = %s', (station_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return jsonify({'error': 'Station not found'}), 404
+            
+            etag = f'station-{station_id}-{row["version"]}'
+            if request.if_none_match.contains(etag):
+                return not_modified(etag)
+            
+            # Копия в индексе актуальна, пока версия не сменилась
+            station = ensure_station_index().get(station_id)
+            if station is None or station.get('version') != row['version']:
+                cursor.execute('SELECT * FROM charging_stations WHERE id = %s', (station_id,))
+                station = cursor.fetchone()
+                station_index.add(station)
+        
+        response = jsonify(apply_last_seen(dict(station)))
+        return with_etag(response, etag), 200
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def local_time(value):
+    """ISO 8601 в местное время без пояса - так хранятся показания и свертки"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+def energy_window():
+    """Окно и свертка кривой энергии из ?from=&to=&resolution= (по умолчанию - последние сутки)"""
+    end = local_time(request.args['to']) if request.args.get('to') else datetime.now()
+    start = local_time(request.args['from']) if request.args.get('from') else end - timedelta(days=1)
+    resolution = request.args.get('resolution')
+    if start >= end or (resolution and resolution not in ROLLUPS):
+        raise ValueError('Invalid window or resolution')
+    return start, end, resolution
+
+
+def energy_curve(start, end, resolution, **key):
+    resolution, points = meter_series.curve(start, end, resolution=resolution, **key)
+    return {'from': start.isoformat(), 'to': end.isoformat(), 'resolution': resolution, 'points': points}
+
+# Кривая энергии станции из свертки, подходящей к ширине окна
+@app.route('/api/stations/<int:station_id>/energy', methods=['GET'])
+def get_station_energy(station_id):
+    try:
+        start, end, resolution = energy_window()
+    except ValueError:
+        return jsonify({'error': f"from/to must be ISO 8601 with from < to, resolution one of {', '.join(ROLLUPS)}"}), 400
+    try:
+        return jsonify({'station_id': station_id, **energy_curve(start, end, resolution, station_id=station_id)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Кривая энергии текущего пользователя по всем станциям
+@app.route('/api/auth/me/energy', methods=['GET'])
+@token_required
+def get_user_energy(current_user):
+    try:
+        start, end, resolution = energy_window()
+    except ValueError:
+        return jsonify({'error': f"from/to must be ISO 8601 with from < to, resolution one of {', '.join(ROLLUPS)}"}), 400
+    try:
+        return jsonify({'user_id': current_user, **energy_curve(start, end, resolution, user_id=current_user)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # Маршрут для добавления новой станции
 @app.route('/api/stations', methods=['POST'])
 def add_station():
@@ -569,32 +898,31 @@ def add_station():
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO charging_stations 
-        (name, address, latitude, longitude, connector_type, current_type, power, status, photo_url, tariff_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-        ''', (
-            data['name'],
-            data['address'],
-            data['latitude'],
-            data['longitude'],
-            data['connector_type'],
-            data['current_type'],
-            data['power'],
-            data['status'],
-            data.get('photo_url'),
-            data.get('tariff_id')
-        ))
-        
-        station_id = cursor.fetchone()[0]
-        conn.commit()
+        with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute('''
+            INSERT INTO charging_stations 
+            (name, address, latitude, longitude, connector_type, current_type, power, status, photo_url, tariff_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING *
+            ''', (
+                data['name'],
+                data['address'],
+                data['latitude'],
+                data['longitude'],
+                data['connector_type'],
+                data['current_type'],
+                data['power'],
+                data['status'],
+                data.get('photo_url'),
+                data.get('tariff_id')
+            ))
+            
+            station = cursor.fetchone()
+            conn.commit()
         
-        cursor.close()
-        conn.close()
+        station_id = station['id']
+        if station_index.loaded:
+            station_index.add(station)
         
         return jsonify({'id': station_id}), 201
     
@@ -605,242 +933,337 @@ def add_station():
 @token_required
 def start_charging(current_user, station_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Проверяем статус станции
-        cursor.execute(
-            "SELECT status, reserved_by FROM charging_stations WHERE id=%s FOR UPDATE",
-            (station_id,)
-        )
-        result = cursor.fetchone()
-        
-        if not result:
+        state = station_cache.get(station_id)
+        if not state:
             return jsonify({"status": "error", "message": "Station not found"}), 404
+        if state['status'] not in ['free', 'reserved']:
+            return jsonify({"status": "error", "message": f"Station is {state['status']}"}), 400
+        if not command_bus.is_connected(station_id):
+            return jsonify({"status": "error", "message": "Station is not connected"}), 400
         
-        status = result[0]
-        reserved_by = result[1]
+        # Проверка, смена статуса и создание сессии - один вызов функции в БД
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            started = start_session(cursor, station_cache, tariffs, station_id, current_user)
+            conn.commit()
         
-        # Проверяем, что станция свободна или зарезервирована текущим пользователем
-        if status not in ['free', 'reserved']:
-            return jsonify({"status": "error", "message": f"Station is {status}"}), 400
-        elif status == 'reserved' and reserved_by != current_user:
+        if started['result'] == NO_STATION:
+            return jsonify({"status": "error", "message": "Station not found"}), 404
+        if started['result'] == UNAVAILABLE:
+            return jsonify({"status": "error", "message": f"Station is {started['previous_status']}"}), 400
+        if started['result'] == RESERVED_BY_OTHER:
             return jsonify({"status": "error", "message": "Station is reserved by another user"}), 403
         
-        # 2. Обновляем статус станции
-        cursor.execute(
-            "UPDATE charging_stations SET status='busy' WHERE id=%s",
-            (station_id,)
-        )
-        
-        # 3. Создаем запись о сессии
-        cursor.execute(
-            """INSERT INTO sessions (station_id, user_id, start_time, initial_electricity_meter)
-            VALUES (%s, %s, %s, 0) RETURNING id""",
-            (station_id, current_user, datetime.now())
-        )
-        session_id = cursor.fetchone()[0]
-        
-        conn.commit()
+        session_id = started['session_id']
+        status = started['previous_status']
+        active_sessions[station_id] = session_id
+        station_cache.apply(station_id, status='busy', using_by=current_user)
         
-        # 4. Отправляем команду станции начать зарядку
-        if not station_manager.send_command(station_id, {
+        # Отправляем команду станции начать зарядку и ждем подтверждения
+        result = station_manager.send_command(station_id, {
             "action": "start_charging",
             "session_id": session_id,
             "user_id": current_user
-        }):
-            return jsonify({"status": "error", "message": "Station is not connected"}), 400
+        })
+        if result['status'] == ACK:
+            return jsonify({
+                "status": "success",
+                "session_id": session_id,
+                "message": "Charging started"
+            }), 200
+        
+        if result['status'] in (NOT_CONNECTED, NACK, EXPIRED):
+            # Станция отказалась или не подтвердила команду до ее срока - сессия не началась
+            cancel_started_session(station_id, session_id, status)
+            return jsonify({
+                "status": "error",
+                "message": result['message'] or "Station rejected the command",
+                "command": result,
+            }), 409
         
+        # Шлюз-владелец станции не ответил: итог команды неизвестен
         return jsonify({
-            "status": "success",
+            "status": "pending",
             "session_id": session_id,
-            "message": "Charging started"
-        }), 200
+            "message": "Station has not confirmed the command yet",
+            "command": result,
+        }), 202
         
     except Exception as e:
-        conn.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
+
+def cancel_started_session(station_id, session_id, status):
+    """Откатывает запуск зарядки, который станция не приняла"""
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cancelled = cancel_session(cursor, station_cache, tariffs, station_id, session_id, status)
+        conn.commit()
+    if cancelled:
+        station_cache.apply(station_id, status=status, using_by=None)
 
 @app.route('/api/stations/<int:station_id>/stop', methods=['POST'])
 @token_required
 def stop_charging(current_user, station_id):
     try:
-        data = request.get_json()
-        energy_consumed = float(data.get('energy_consumed', 0))
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Проверяем статус станции
-        cursor.execute(
-            "SELECT status FROM charging_stations WHERE id=%s FOR UPDATE",
-            (station_id,)
-        )
-        result = cursor.fetchone()
+        data = request.get_json(silent=True) or {}
+        # Без явного значения берем последнее показание станции
+        energy_consumed = data.get('energy_consumed')
+        if energy_consumed is not None:
+            energy_consumed = float(energy_consumed)
+        
+        # Проверка, закрытие сессии и освобождение станции - один вызов функции в БД
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            stopped = stop_session(cursor, station_cache, ingestor, tariffs, station_id, current_user, energy_consumed)
+            if stopped['result'] == STOPPED:
+                user_cache.notify(cursor, current_user)
+            conn.commit()
+        if stopped['result'] == STOPPED:
+            user_cache.invalidate(current_user)
         
-        if not result:
+        if stopped['result'] == NO_STATION:
             return jsonify({"status": "error", "message": "Station not found"}), 404
-        
-        if result[0] != 'busy':
+        if stopped['result'] == NOT_CHARGING:
             return jsonify({"status": "error", "message": "Station is not charging"}), 400
-        
-        # 2. Проверяем, что текущий пользователь начал сессию
-        cursor.execute(
-            """SELECT id FROM sessions 
-            WHERE station_id=%s AND user_id=%s AND end_time IS NULL""",
-            (station_id, current_user)
-        )
-        session = cursor.fetchone()
-        
-        if not session:
+        if stopped['result'] == NO_SESSION:
             return jsonify({"status": "error", "message": "No active session for this user"}), 403
-        
-        # 3. Обновляем статус станции
-        cursor.execute(
-            """UPDATE charging_stations 
-            SET status='free', reserved_by=NULL 
-            WHERE id=%s""",
-            (station_id,)
-        )
-        
-        # 4. Обновляем сессию
-        cursor.execute(
-            """UPDATE sessions SET 
-            end_time=%s, 
-            energy_consumed=%s
-            WHERE station_id=%s AND user_id=%s AND end_time IS NULL""",
-            (datetime.now(), energy_consumed, station_id, current_user)
-        )
-        
-        conn.commit()
-        
-        # 5. Отправляем команду станции остановить зарядку
-        if not station_manager.send_command(station_id, {
+        energy_consumed = stopped['energy']
+        
+        # Итоговое показание закрывает стримы сессии
+        active_sessions.pop(station_id, None)
+        meter_series.end_session(stopped['session_id'])
+        telemetry_hub.close_topic(stopped['session_id'], {
+            'event': 'end',
+            'session_id': stopped['session_id'],
+            'status': 'free',
+            'energy_consumed': energy_consumed,
+            'cost': stopped['cost'],
+        })
+        station_cache.apply(station_id, status='free', reserved_by=None, using_by=None)
+        
+        # Отправляем команду станции остановить зарядку. Сессия в БД уже
+        # закрыта, поэтому без подтверждения отвечаем 202
+        result = station_manager.send_command(station_id, {
             "action": "stop_charging",
             "user_id": current_user,
-        }):
-            return jsonify({"status": "error", "message": "Station is not connected"}), 400
+        })
+        if result['status'] != ACK:
+            return jsonify({
+                "status": "success",
+                "message": "Charging stopped, station has not confirmed",
+                "energy_consumed": energy_consumed,
+                "cost": stopped['cost'],
+                "command": result,
+            }), 202
         
         return jsonify({
             "status": "success", 
             "message": "Charging stopped",
-            "energy_consumed": energy_consumed
+            "energy_consumed": energy_consumed,
+            "cost": stopped['cost'],
         }), 200
         
     except Exception as e:
-        conn.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
-def start_socket_server(ip, port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((ip, port))
-    sock.listen(5)
-    print(f"Socket server listening on {ip, port}")
+# Метрики пула соединений (время ожидания, загрузка)
+@app.route('/api/metrics/db', methods=['GET'])
+def get_db_metrics():
+    return jsonify({
+        **db_pool.stats(),
+        'heartbeats': liveness.stats(),
+        'energy_ingestion': ingestor.stats(),
+        'station_cache': station_cache.stats(),
+        'telemetry': telemetry_hub.stats(),
+        'reservations': reservations.stats(),
+        'tokens': token_cache.stats(),
+        'users': user_cache.stats(),
+        'ledger': ledger.stats(),
+        'tariffs': tariffs.stats(),
+        'meter_series': meter_series.stats(),
+        'passwords': {
+            **password_hasher.stats(),
+            'ip_limit': login_ip_limiter.stats(),
+            'email_limit': login_email_limiter.stats(),
+            'register_limit': register_ip_limiter.stats(),
+        },
+        'commands': command_dispatcher.stats(),
+        'connections': station_manager.registry.stats(),
+        'gateway_bus': command_bus.stats(),
+    }), 200
+
+# Сверка журнала: баланс каждого пользователя пересчитывается из записей
+@app.route('/api/metrics/ledger', methods=['GET'])
+def verify_ledger():
+    mismatches = ledger.verify()
+    return jsonify({
+        **ledger.stats(),
+        'consistent': not mismatches,
+        'mismatches': mismatches[:100],
+    }), 200
+
+def sse_event(event):
+    return f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+# Живой стрим сессии (Server-Sent Events) вместо ежесекундного опроса
+@app.route('/api/sessions/<int:session_id>/stream', methods=['GET'])
+@token_required
+def stream_session(current_user, session_id):
+    # Подписываемся до чтения снимка, чтобы не пропустить события между ними
+    subscription = telemetry_hub.subscribe(session_id)
+    try:
+        with db_pool.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                '''SELECT s.station_id, s.energy_consumed, s.cost, s.end_time, cs.status, cs.power
+                FROM sessions s JOIN charging_stations cs ON cs.id = s.station_id
+                WHERE s.id = %s AND s.user_id = %s''',
+                (session_id, current_user)
+            )
+            session = cursor.fetchone()
+    except Exception as e:
+        telemetry_hub.unsubscribe(subscription)
+        return jsonify({'error': str(e)}), 500
+    
+    if session is None:
+        telemetry_hub.unsubscribe(subscription)
+        return jsonify({'error': 'Session not found'}), 404
     
-    def handle_client(client_socket, addr):
+    snapshot = {
+        'event': 'snapshot',
+        'session_id': session_id,
+        'station_id': session['station_id'],
+        'energy_consumed': session['energy_consumed'],
+        # Живая стоимость, если сессию считает этот процесс, иначе последняя записанная
+        'cost': tariffs.current(session['station_id'], session_id) or session['cost'],
+        'status': session['status'],
+        'power': session['power'],
+    }
+    if session['end_time'] is None:
+        active_sessions.setdefault(session['station_id'], session_id)
+    else:
+        telemetry_hub.unsubscribe(subscription)
+    
+    def generate():
         try:
+            yield sse_event(snapshot)
+            if session['end_time'] is not None:
+                yield sse_event({'event': 'end', 'session_id': session_id,
+                                 'energy_consumed': session['energy_consumed'], 'cost': session['cost']})
+                return
             while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-                
-                try:
-                    request = json.loads(data.decode('utf-8'))
-                    response = process_socket_request(request, client_socket)
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-                except json.JSONDecodeError:
-                    response = {"status": "error", "message": "Invalid JSON"}
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-        except ConnectionResetError:
-            print(f"Client {addr} disconnected")
+                event = subscription.get(timeout=STREAM_KEEPALIVE)
+                if event is not None:
+                    yield sse_event(event)
+                    if event['event'] == 'end':
+                        return
+                elif subscription.evicted:
+                    # Клиент не успевает читать - пусть переподключится и получит снимок
+                    yield sse_event({'event': 'dropped', 'session_id': session_id})
+                    return
+                elif subscription.closed:
+                    return
+                else:
+                    yield ': keep-alive\n\n'
         finally:
-            # Удаляем соединение при отключении
-            for station_id, sock in list(station_manager.connections.items()):
-                if sock == client_socket:
-                    station_manager.remove_connection(station_id)
-                    break
-            client_socket.close()
-    
-    def process_socket_request(request, client_socket):
-        action = request.get("action")
-        station_id = request.get("station_id")
-        
-        if action == "init":
-            print(f"New connection from Station(id={station_id})")
-            station_manager.add_connection(station_id, client_socket)
-            return {"status": "success", "message": "Connection established"}
-            
-        elif action == "register_command":
-            station_manager.add_command_connection(station_id, client_socket)
-            return {"status": "success", "message": "Command channel registered"}
-            
-        elif action == "heartbeat":
-            conn = get_db_connection()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE charging_stations SET last_connection=%s WHERE id=%s",
-                        (datetime.now(), station_id)
-                    )
-                    conn.commit()
-                    return {"status": "success"}
-            except Exception as e:
-                return {"status": "error", "message": str(e)}
-            finally:
-                conn.close()
-                
-        elif action == "update":
-            energy_consumed = request.get("energy_consumed", 0)
-            user_id = request.get("user_id")
-            session_id = request.get("session_id")
-            
-            conn = get_db_connection()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """UPDATE sessions SET 
-                        energy_consumed=%s
-                        WHERE id=%s AND station_id=%s AND user_id=%s""",
-                        (energy_consumed, session_id, station_id, user_id)
-                    )
-                    conn.commit()
-                    return {"status": "success"}
-            except Exception as e:
-                return {"status": "error", "message": str(e)}
-            finally:
-                conn.close()
-                
-        else:
-            return {"status": "error", "message": "Unknown action"}
+            telemetry_hub.unsubscribe(subscription)
     
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+def process_socket_request(request, channel):
+    """Обработчик запросов станций для шлюза"""
+    action = request.get("action")
+    station_id = request.get("station_id")
+
+    if action == "init":
+        print(f"New connection from Station(id={station_id})")
+        station_manager.add_connection(station_id, channel)
+        return {"status": "success", "message": "Connection established"}
+
+    elif action == "register_command":
+        station_manager.add_command_connection(station_id, channel, acks=request.get(ACKS_CAPABILITY) is True)
+        return {"status": "success", "message": "Command channel registered"}
+
+    elif action == "heartbeat":
+        liveness.record(station_id)
+        station_manager.touch(station_id)
+        return {"status": "success"}
+
+    elif action == ACK_ACTION:
+        # Подтверждение команды по командному соединению - без ответа
+        command_dispatcher.acknowledge(
+            request.get("command_id"), request.get("status") == "success", request.get("message")
+        )
+        return None
+
+    elif action == "update":
+        energy_consumed = request.get("energy_consumed", 0)
+        user_id = request.get("user_id")
+        session_id = request.get("session_id")
+        liveness.record(station_id)
+        station_manager.touch(station_id)
+
+        # Стоимость растет на каждом кадре, без пересчета по истории сессии
+        meter = tariffs.update(station_id, session_id, energy_consumed) if session_id is not None else None
+        cost, metered_at = (meter.cost, meter.metered_at) if meter else (None, None)
+        accepted = ingestor.submit(station_id, user_id, session_id, energy_consumed, cost, metered_at)
+        meter_series.record(station_id, session_id, user_id, energy_consumed)
+        if session_id is not None:
+            active_sessions[station_id] = session_id
+            # Показание уходит подписчикам, даже если запись в БД отложена
+            if telemetry_hub.has_subscribers(session_id):
+                telemetry_hub.publish(session_id, {
+                    'event': 'energy',
+                    'session_id': session_id,
+                    'station_id': station_id,
+                    'energy_consumed': energy_consumed,
+                    'cost': round(cost, 2) if meter else None,
+                })
+        return {"status": "success", "accepted": accepted}
+
+    else:
+        return {"status": "error", "message": "Unknown action"}
+
+
+def on_station_disconnect(channel):
+    # Удаляем соединение при отключении
+    station_manager.remove_channel(channel)
+
+
+def start_socket_server(ip, port):
+    # Все станции обслуживаются одним циклом событий вместо потока на клиента
+    gateway = StationGateway(max_workers=db_pool.maxconn)
+    gateway.add_listener(ip, port, process_socket_request, on_station_disconnect)
+    liveness.start()
+    ingestor.start()
+    meter_series.start()
+    command_dispatcher.start()
+    station_manager.registry.start()
     try:
-        while True:
-            client_socket, addr = sock.accept()
-            client_thread = threading.Thread(
-                target=handle_client,
-                args=(client_socket, addr),
-                daemon=True
-            )
-            client_thread.start()
+        gateway.run()
     except KeyboardInterrupt:
         print("Shutting down socket server...")
     finally:
-        sock.close()
+        station_manager.registry.stop()
+        command_dispatcher.stop()
+        liveness.stop()
+        ingestor.stop()
+        meter_series.stop()
 
 
 
 if __name__ == '__main__':
     init_db()
-    print("Flask API listening on ('0.0.0.0', 5000)")
-    app.run(host='0.0.0.0', port=5000, debug=True)
-    socket_thread = threading.Thread(target=start_socket_server('0.0.0.0', 9090), daemon=True)
+    command_bus.init_db()
+    station_cache.start()
+    command_bus.start()
+    reservations.start()
+    user_cache.start()
+    ledger.start()
+    socket_thread = threading.Thread(target=start_socket_server, args=('0.0.0.0', SOCKET_PORT), daemon=True)
     socket_thread.start()
+    print("Flask API listening on ('0.0.0.0', 5000)")
+    # Перезагрузчик отключен: он запустил бы второй шлюз на том же порту
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
     
     
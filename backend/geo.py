@@ -0,0 +1,272 @@
+import heapq
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+# До этого уровня масштаба карта получает кластеры, дальше - сами станции
+MAX_CLUSTER_ZOOM = 12
+# Кластерных ячеек на сторону тайла карты
+CLUSTER_CELLS_PER_TILE = 2
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def matches_filters(station, connector_type=None, current_type=None, min_power=None, status=None):
+    """Те же фильтры, что и у /api/stations"""
+    if connector_type and station.get('connector_type') != connector_type:
+        return False
+    if current_type and station.get('current_type') != current_type:
+        return False
+    if status and station.get('status') != status:
+        return False
+    if min_power is not None and float(station.get('power') or 0) < float(min_power):
+        return False
+    return True
+
+
+def cluster_cell_deg(zoom):
+    return 360.0 / (2 ** zoom * CLUSTER_CELLS_PER_TILE)
+
+
+class _Cluster:
+    __slots__ = ('count', 'statuses', 'powers', 'sum_lat', 'sum_lon')
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}  # {статус: число станций}
+        self.powers = {}  # {мощность: число станций} - чтобы max пересчитывался при удалении
+        self.sum_lat = 0.0
+        self.sum_lon = 0.0
+
+    def apply(self, station, sign, power):
+        self.count += sign
+        status = station.get('status')
+        self.statuses[status] = self.statuses.get(status, 0) + sign
+        self.powers[power] = self.powers.get(power, 0) + sign
+        self.sum_lat += sign * station['latitude']
+        self.sum_lon += sign * station['longitude']
+
+    def to_dict(self):
+        return {
+            'latitude': self.sum_lat / self.count,
+            'longitude': self.sum_lon / self.count,
+            'count': self.count,
+            'free': self.statuses.get('free', 0),
+            'busy': self.statuses.get('busy', 0),
+            'reserved': self.statuses.get('reserved', 0),
+            'max_power': max((p for p, n in self.powers.items() if n > 0), default=0.0),
+        }
+
+
+class ClusterTiers:
+    """Предрассчитанные кластеры станций для каждого уровня масштаба 0..MAX_CLUSTER_ZOOM.
+
+    Добавление, удаление или смена статуса станции меняет по одной ячейке
+    на каждом уровне, без пересчета остальных.
+    """
+
+    def __init__(self, zooms=range(MAX_CLUSTER_ZOOM + 1)):
+        self.cell_deg = {zoom: cluster_cell_deg(zoom) for zoom in zooms}
+        self.tiers = {zoom: {} for zoom in zooms}  # {zoom: {(cx, cy): _Cluster}}
+
+    def _cell(self, zoom, lat, lon):
+        size = self.cell_deg[zoom]
+        return int(math.floor(lat / size)), int(math.floor(lon / size))
+
+    def apply(self, station, sign):
+        power = float(station.get('power') or 0)
+        for zoom, tier in self.tiers.items():
+            cell = self._cell(zoom, station['latitude'], station['longitude'])
+            cluster = tier.get(cell)
+            if cluster is None:
+                cluster = tier[cell] = _Cluster()
+            cluster.apply(station, sign, power)
+            if cluster.count <= 0:
+                del tier[cell]
+
+    def clear(self):
+        for tier in self.tiers.values():
+            tier.clear()
+
+    def query(self, zoom, min_lat, min_lon, max_lat, max_lon):
+        tier = self.tiers[zoom]
+        (cx0, cy0) = self._cell(zoom, min_lat, min_lon)
+        (cx1, cy1) = self._cell(zoom, max_lat, max_lon)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(tier):
+            cells = ((cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1))
+            clusters = (tier[cell] for cell in cells if cell in tier)
+        else:
+            clusters = (
+                cluster for (cx, cy), cluster in tier.items()
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1
+            )
+        return [cluster.to_dict() for cluster in clusters]
+
+
+class StationIndex:
+    """Сеточный пространственный индекс станций для поиска ближайших.
+
+    Станции раскладываются по ячейкам cell_deg x cell_deg градусов; поиск
+    k ближайших обходит кольца ячеек вокруг точки и останавливается, как
+    только следующее кольцо заведомо дальше k-й найденной станции.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self._lock = threading.RLock()
+        self._cells = {}  # {(cx, cy): set(station_id)}
+        self._stations = {}  # {station_id: dict станции}
+        self.clusters = ClusterTiers()
+        self.loaded = False
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def load(self, stations):
+        with self._lock:
+            self._cells.clear()
+            self._stations.clear()
+            self.clusters.clear()
+            for station in stations:
+                self.add(station)
+            self.loaded = True
+
+    def add(self, station):
+        if station.get('latitude') is None or station.get('longitude') is None:
+            return
+        station = dict(station)
+        station['latitude'] = float(station['latitude'])
+        station['longitude'] = float(station['longitude'])
+        with self._lock:
+            self.remove(station['id'])
+            self._stations[station['id']] = station
+            cell = self._cell(station['latitude'], station['longitude'])
+            self._cells.setdefault(cell, set()).add(station['id'])
+            self.clusters.apply(station, +1)
+
+    def remove(self, station_id):
+        with self._lock:
+            station = self._stations.pop(station_id, None)
+            if station is None:
+                return
+            self.clusters.apply(station, -1)
+            cell = self._cell(station['latitude'], station['longitude'])
+            members = self._cells.get(cell)
+            if members:
+                members.discard(station_id)
+                if not members:
+                    del self._cells[cell]
+
+    def update(self, station_id, **fields):
+        """Обновляет атрибуты станции (статус, мощность и т.п.) без перестройки ячеек"""
+        with self._lock:
+            station = self._stations.get(station_id)
+            if station is None:
+                return
+            if 'latitude' in fields or 'longitude' in fields:
+                self.add({**station, **fields})
+            else:
+                self.clusters.apply(station, -1)
+                station.update(fields)
+                self.clusters.apply(station, +1)
+
+    def get(self, station_id):
+        return self._stations.get(station_id)
+
+    def __len__(self):
+        return len(self._stations)
+
+    def nearest(self, lat, lon, radius_km=10.0, limit=20, **filters):
+        """Возвращает [(расстояние_км, станция)] по возрастанию расстояния"""
+        lat, lon = float(lat), float(lon)
+        cx, cy = self._cell(lat, lon)
+
+        # Ширина ячейки по долготе сужается к полюсам - считаем по худшей широте
+        max_lat = min(89.9, abs(lat) + radius_km / KM_PER_DEGREE)
+        cell_km = self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(max_lat))
+        max_ring = int(math.ceil(radius_km / cell_km)) + 1
+
+        best = []  # max-heap по расстоянию: (-dist, station_id)
+
+        def consider(station_id):
+            station = self._stations[station_id]
+            if not matches_filters(station, **filters):
+                return
+            dist = haversine_km(lat, lon, station['latitude'], station['longitude'])
+            if dist > radius_km:
+                return
+            if len(best) < limit:
+                heapq.heappush(best, (-dist, station_id))
+            elif dist < -best[0][0]:
+                heapq.heapreplace(best, (-dist, station_id))
+
+        with self._lock:
+            # У полюсов ячейки по долготе узкие и колец становится неограниченно
+            # много; кольца до ring_cap покрывают не меньше ячеек, чем есть в
+            # индексе, - дальше дешевле проверить все станции
+            ring_cap = math.isqrt(len(self._cells)) + 1
+            for ring in range(min(max_ring, ring_cap) + 1):
+                # Все станции в кольце ring не ближе (ring - 1) ячеек
+                if len(best) >= limit and -best[0][0] <= (ring - 1) * cell_km:
+                    break
+                for cell in self._ring_cells(cx, cy, ring):
+                    for station_id in self._cells.get(cell, ()):
+                        consider(station_id)
+            else:
+                if max_ring > ring_cap:
+                    best.clear()
+                    for station_id in self._stations:
+                        consider(station_id)
+            result = [(-neg, dict(self._stations[sid])) for neg, sid in best]
+        result.sort(key=lambda item: item[0])
+        return result
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon, **filters):
+        """Станции внутри прямоугольника, удовлетворяющие фильтрам"""
+        (cx0, cy0) = self._cell(min_lat, min_lon)
+        (cx1, cy1) = self._cell(max_lat, max_lon)
+        result = []
+        with self._lock:
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(self._cells):
+                cells = ((cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1))
+                candidates = (sid for cell in cells for sid in self._cells.get(cell, ()))
+            else:
+                candidates = iter(list(self._stations))
+            for station_id in candidates:
+                station = self._stations[station_id]
+                if (min_lat <= station['latitude'] <= max_lat
+                        and min_lon <= station['longitude'] <= max_lon
+                        and matches_filters(station, **filters)):
+                    result.append(dict(station))
+        return result
+
+    def clusters_in_bbox(self, zoom, min_lat, min_lon, max_lat, max_lon, **filters):
+        """Кластеры видимой области; с фильтрами считаются на лету по станциям"""
+        zoom = max(0, min(zoom, MAX_CLUSTER_ZOOM))
+        if not any(value is not None for value in filters.values()):
+            with self._lock:
+                return self.clusters.query(zoom, min_lat, min_lon, max_lat, max_lon)
+
+        filtered = ClusterTiers(zooms=[zoom])
+        for station in self.in_bbox(min_lat, min_lon, max_lat, max_lon, **filters):
+            filtered.apply(station, +1)
+        return filtered.query(zoom, min_lat, min_lon, max_lat, max_lon)
+
+    @staticmethod
+    def _ring_cells(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Параметры хеша для новых паролей; старые хеши пересчитываются при входе
+HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+
+class Overloaded(Exception):
+    """Пул хеширования занят - запрос отклоняется, а не ждет в очереди"""
+
+    def __init__(self, retry_after):
+        super().__init__('Password hashing is overloaded')
+        self.retry_after = retry_after
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _check(stored, password):
+    return check_password_hash(stored, password)
+
+
+def hash_method(stored):
+    """Метод и параметры из сохраненного хеша werkzeug ("scrypt:32768:8:1$соль$хеш")"""
+    return stored.split('$', 1)[0]
+
+
+class PasswordHasher:
+    """Хеширование паролей в отдельном пуле процессов.
+
+    Вычисление ключа занимает CPU на десятки миллисекунд и под GIL
+    останавливает HTTP-потоки, поэтому уходит в процессы. Очередь
+    ограничена max_pending: если места нет дольше queue_timeout,
+    бросается Overloaded - шторм входов не копит бесконечную очередь.
+    """
+
+    def __init__(self, workers=None, max_pending=None, queue_timeout=None, method=HASH_METHOD):
+        self.workers = int(workers or os.getenv('PASSWORD_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+        self.max_pending = int(max_pending or os.getenv('PASSWORD_MAX_PENDING', self.workers * 4))
+        self.queue_timeout = float(queue_timeout or os.getenv('PASSWORD_QUEUE_TIMEOUT', 0.5))
+        self.timeout = float(os.getenv('PASSWORD_TIMEOUT', 10))
+        self.method = method
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        # Запись пересчитанных хешей в БД - вне HTTP-потока
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rehash')
+
+        self.hashed = 0
+        self.checked = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _get_pool(self):
+        # Процессы создаются при первом запросе, а не при импорте модуля.
+        # Не fork: копия многопоточного процесса могла бы унаследовать
+        # захваченные блокировки (пула соединений, логирования)
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'),
+                    )
+        return self._pool
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise Overloaded(retry_after=1)
+        try:
+            future = self._get_pool().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _result(self, future):
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise Overloaded(retry_after=1)
+
+    def hash(self, password):
+        result = self._result(self._submit(_hash, password, self.method))
+        self.hashed += 1
+        return result
+
+    def verify(self, stored, password):
+        """True, если пароль подходит к сохраненному хешу"""
+        result = self._result(self._submit(_check, stored, password))
+        self.checked += 1
+        return result
+
+    def needs_rehash(self, stored):
+        return hash_method(stored) != self.method
+
+    def rehash_later(self, password, save):
+        """Пересчитывает хеш с текущими параметрами и передает его в save(новый_хеш).
+
+        Без ожидания: вход уже выполнен, а при занятом пуле пересчет
+        просто переносится на следующий вход.
+        """
+        try:
+            future = self._submit(_hash, password, self.method)
+        except Overloaded:
+            return
+
+        def done(future):
+            if future.cancelled() or future.exception():
+                return
+            try:
+                self._background.submit(self._save, save, future.result())
+            except RuntimeError:
+                # Хешер остановлен - пересчитаем при следующем входе
+                pass
+
+        future.add_done_callback(done)
+
+    def _save(self, save, new_hash):
+        try:
+            save(new_hash)
+            self.rehashed += 1
+        except Exception as e:
+            print(f"Password rehash failed: {e}")
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._background.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'method': self.method,
+            'hashed': self.hashed,
+            'checked': self.checked,
+            'rejected': self.rejected,
+            'rehashed': self.rehashed,
+        }
+
+
+class RateLimiter:
+    """Token bucket на ключ (IP, email): rate запросов в секунду, запас burst.
+
+    Проверяется до хеширования, поэтому отклоненный запрос не стоит CPU.
+    Хранится не больше maxsize ключей; давно не использованные вытесняются.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # {ключ: (токены, время обновления)}
+
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, key):
+        """0, если запрос пропущен, иначе через сколько секунд появится токен"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+                self.allowed += 1
+                return 0
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            self.limited += 1
+            return (1 - tokens) / self.rate
+
+    def stats(self):
+        return {'keys': len(self._buckets), 'allowed': self.allowed, 'limited': self.limited}
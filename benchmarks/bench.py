@@ -0,0 +1,452 @@
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+import psycopg2
+from dotenv import load_dotenv
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..'))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'controller'))
+from common.db import db_config
+from common.stats import LatencyHistogram
+from loadgen import FleetSimulator, parse_args as loadgen_args
+from seed import PASSWORD, SIZES, seed, seeded_fleet
+
+load_dotenv()
+
+PERCENTILES = (50, 95, 99)
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# Фильтры списка станций, которые чаще всего шлет приложение
+STATION_FILTERS = [
+    {},
+    {'status': 'free'},
+    {'connector_type': 'CCS', 'min_power': 50},
+    {'current_type': 'AC', 'status': 'free'},
+]
+# Окно карты над тестовым парком (см. STATIONS_SQL в seed.py)
+VIEWPORT = (37.35, 55.55, 37.85, 55.95)
+
+
+class Worker:
+    """Поток нагрузки: свой пользователь, свое HTTP-соединение и свои станции.
+
+    Станции делятся между потоками без пересечений, поэтому резервы и
+    зарядки разных потоков не конфликтуют и не попадают в ошибки.
+    """
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.random = random.Random(index)
+        self.email = bench.users[index % len(bench.users)]
+        self.stations = bench.stations[index::bench.options.concurrency]
+        self.online = bench.online[index::bench.options.concurrency]
+        self.token = None
+        self.metrics = {}
+        self.errors = Counter()
+        url = urlsplit(bench.options.api)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=bench.options.timeout)
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        try:
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.conn.close()
+            return response.status, json.loads(data) if data else {}
+        except (OSError, http.client.HTTPException, ValueError):
+            self.conn.close()
+            return None, {}
+
+    def call(self, metric, method, path, body=None, expect=(200,)):
+        started = time.perf_counter()
+        status, data = self.request(method, path, body)
+        elapsed = (time.perf_counter() - started) * 1000
+        if self.bench.recording:
+            self.metrics.setdefault(metric, LatencyHistogram()).record(elapsed)
+            if status not in expect:
+                self.errors[metric] += 1
+        return data if status in expect else None
+
+    def login(self):
+        data = self.call('login', 'POST', '/api/auth/login', {'email': self.email, 'password': PASSWORD})
+        if data:
+            self.token = data['token']
+        return data
+
+    def close(self):
+        self.conn.close()
+
+
+# Пропускная способность хеширования: сервер запускают с LOGIN_RATE_PER_IP=0
+# и LOGIN_RATE_PER_EMAIL=0, иначе все потоки с одного адреса упрутся в лимит
+def scenario_login(worker):
+    worker.login()
+
+
+def scenario_stations(worker):
+    filters = worker.random.choice(STATION_FILTERS)
+    after_id = worker.random.choice(worker.bench.stations) if worker.random.random() < 0.5 else 0
+    query = urlencode({**filters, 'after_id': after_id, 'limit': 100})
+    worker.call('stations_page', 'GET', f'/api/stations?{query}')
+
+    min_lon, min_lat, max_lon, max_lat = VIEWPORT
+    zoom = worker.random.choice((10, 13, 17))
+    # Чем крупнее масштаб, тем меньше окно карты
+    span = 0.5 / 2 ** (zoom - 10)
+    lon = worker.random.uniform(min_lon, max_lon - span)
+    lat = worker.random.uniform(min_lat, max_lat - span)
+    query = urlencode({'bbox': f'{lon},{lat},{lon + span},{lat + span}', 'zoom': zoom})
+    worker.call('stations_viewport', 'GET', f'/api/stations?{query}')
+
+
+def scenario_station(worker):
+    station_id = worker.random.choice(worker.bench.stations)
+    worker.call('station', 'GET', f'/api/stations/{station_id}')
+
+
+def scenario_reserve(worker):
+    station_id = worker.random.choice(worker.stations)
+    if worker.call('reserve', 'POST', f'/api/stations/{station_id}/reserve') is not None:
+        worker.call('cancel', 'POST', f'/api/stations/{station_id}/cancel')
+
+
+def scenario_charge(worker):
+    if not worker.online:
+        return
+    station_id = worker.random.choice(worker.online)
+    # 202 - сессия открыта, но станция не успела подтвердить команду
+    if worker.call('start', 'POST', f'/api/stations/{station_id}/start', expect=(200, 202)) is not None:
+        worker.call('stop', 'POST', f'/api/stations/{station_id}/stop', {'energy_consumed': 1.0}, expect=(200, 202))
+
+
+def scenario_balance(worker):
+    worker.call('balance', 'GET', '/api/balance')
+
+
+def scenario_login_storm(worker):
+    """Половина потоков входит без остановки, остальные листают станции.
+
+    Показывает, не ждут ли обычные запросы хеширования паролей. Отказы
+    лимитов (429) и занятого пула (503) - ожидаемый исход, а не ошибка:
+    они пишутся в storm_rejected и должны быть быстрыми.
+    """
+    if worker.index % 2:
+        scenario_stations(worker)
+        return
+    started = time.perf_counter()
+    status, _ = worker.request('POST', '/api/auth/login', {'email': worker.email, 'password': PASSWORD})
+    elapsed = (time.perf_counter() - started) * 1000
+    if not worker.bench.recording:
+        return
+    metric = 'storm_rejected' if status in (429, 503) else 'storm_login'
+    worker.metrics.setdefault(metric, LatencyHistogram()).record(elapsed)
+    if status not in (200, 429, 503):
+        worker.errors[metric] += 1
+
+
+SCENARIOS = {
+    'login': scenario_login,
+    'stations': scenario_stations,
+    'station': scenario_station,
+    'reserve': scenario_reserve,
+    'charge': scenario_charge,
+    'balance': scenario_balance,
+    'login_storm': scenario_login_storm,
+}
+
+
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.stations = []
+        self.users = []
+        self.online = []
+        self.recording = False
+        self.fleet = None
+        self._fleet_thread = None
+
+    def load_fleet(self):
+        conn = psycopg2.connect(**db_config())
+        try:
+            with conn.cursor() as cursor:
+                self.stations, self.users = seeded_fleet(cursor)
+        finally:
+            conn.close()
+        if len(self.stations) != SIZES[self.options.size] or len(self.users) != SIZES[self.options.size]:
+            raise SystemExit(f"Seeded fleet has {len(self.stations)} stations and {len(self.users)} users, "
+                             f"expected {SIZES[self.options.size]}; run with --seed")
+
+    def start_stations(self):
+        """Виртуальные станции для start/stop: без подключенной станции запуск не пройдет"""
+        count = min(self.options.online, len(self.stations))
+        if not count:
+            return
+        if self.stations[count - 1] - self.stations[0] != count - 1:
+            raise SystemExit('Seeded station IDs are not contiguous; reseed into a clean database')
+        options = loadgen_args([
+            '--stations', str(count), '--first-id', str(self.stations[0]),
+            '--host', self.options.gateway_host, '--port', str(self.options.gateway_port),
+            '--duration', '86400', '--ramp', '2', '--progress', '0', '--session-rate', '0',
+        ])
+        options.api = None
+        self.fleet = FleetSimulator(options)
+        self._fleet_thread = threading.Thread(target=asyncio.run, args=(self.fleet.run(),), daemon=True)
+        self._fleet_thread.start()
+
+        deadline = time.monotonic() + 30
+        while self.fleet.online() < count and time.monotonic() < deadline:
+            time.sleep(0.2)
+        self.online = [station.station_id for station in self.fleet.stations if station.online]
+        print(f"Virtual stations online: {len(self.online)}/{count}")
+
+    def stop_stations(self):
+        if self.fleet:
+            self.fleet.stop()
+            self._fleet_thread.join(timeout=5)
+
+    def run_scenario(self, name, workers):
+        step = SCENARIOS[name]
+        stop = threading.Event()
+
+        def loop(worker):
+            while not stop.is_set():
+                step(worker)
+
+        for worker in workers:
+            worker.metrics.clear()
+            worker.errors.clear()
+        threads = [threading.Thread(target=loop, args=(worker,), daemon=True) for worker in workers]
+        for thread in threads:
+            thread.start()
+
+        # Прогрев не записывается: кэши, пул соединений, JIT планов Postgres
+        time.sleep(self.options.warmup)
+        self.recording = True
+        started = time.perf_counter()
+        time.sleep(self.options.duration)
+        self.recording = False
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=self.options.timeout)
+
+        merged = {}
+        errors = Counter()
+        for worker in workers:
+            for metric, histogram in worker.metrics.items():
+                merged.setdefault(metric, LatencyHistogram()).merge(histogram)
+            errors.update(worker.errors)
+
+        results = {}
+        for metric, histogram in merged.items():
+            results[metric] = {
+                'requests': histogram.count,
+                'errors': errors[metric],
+                'throughput': round(histogram.count / elapsed, 2),
+                'mean': round(histogram.total / histogram.count, 3),
+                **histogram.percentiles(PERCENTILES),
+            }
+        return results
+
+    def run(self):
+        options = self.options
+        if options.seed:
+            seed(options.size)
+        self.load_fleet()
+        if 'charge' in options.scenarios:
+            self.start_stations()
+
+        workers = [Worker(self, index) for index in range(options.concurrency)]
+        try:
+            for worker in workers:
+                if not worker.login():
+                    raise SystemExit(f"Login failed for {worker.email}")
+
+            results = {}
+            for name in options.scenarios:
+                print(f"Running {name} ({options.concurrency} workers, {options.duration}s)...")
+                results.update(self.run_scenario(name, workers))
+        finally:
+            for worker in workers:
+                worker.close()
+            self.stop_stations()
+
+        return {
+            'meta': {
+                'size': options.size,
+                'stations': len(self.stations),
+                'users': len(self.users),
+                'online_stations': len(self.online),
+                'concurrency': options.concurrency,
+                'duration': options.duration,
+                'commit': git_commit(),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'host': platform.node(),
+            },
+            'results': results,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold, min_delta_ms):
+    """Сравнение с базой; возвращает список регрессий (пустой - все в норме).
+
+    Задержка считается регрессией, если выросла больше чем на threshold
+    и больше чем на min_delta_ms (шум на быстрых запросах), пропускная
+    способность - если упала больше чем на threshold.
+    """
+    regressions = []
+    for metric, base in baseline['results'].items():
+        result = current['results'].get(metric)
+        if result is None:
+            continue
+        for key in [f'p{point}' for point in PERCENTILES]:
+            if base[key] is None or result[key] is None:
+                continue
+            if result[key] > base[key] * (1 + threshold) and result[key] - base[key] > min_delta_ms:
+                regressions.append(f"{metric} {key}: {base[key]:.2f} -> {result[key]:.2f} ms")
+        if result['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(f"{metric} throughput: {base['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+        base_rate = base['errors'] / base['requests'] if base['requests'] else 0
+        rate = result['errors'] / result['requests'] if result['requests'] else 0
+        if rate > base_rate + 0.01:
+            regressions.append(f"{metric} errors: {base_rate:.1%} -> {rate:.1%}")
+    return regressions
+
+
+def print_results(report, baseline=None):
+    print(f"\n{'metric':<20}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>8}{'p95 vs base':>14}")
+    for metric, result in report['results'].items():
+        change = ''
+        base = (baseline or {}).get('results', {}).get(metric)
+        if base and base['p95'] and result['p95'] is not None:
+            change = f"{(result['p95'] / base['p95'] - 1) * 100:+.1f}%"
+        values = [result[key] if result[key] is not None else 0 for key in ('p50', 'p95', 'p99')]
+        print(f"{metric:<20}{result['throughput']:>10.1f}" + ''.join(f"{value:>10.2f}" for value in values)
+              + f"{result['errors']:>8}{change:>14}")
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def check(report, baseline_path, options):
+    """Печатает сравнение с базой; код выхода 1 при регрессии"""
+    if not os.path.exists(baseline_path):
+        print_results(report)
+        print(f"\nNo baseline at {baseline_path}; save one with --save-baseline")
+        return 0
+    baseline = load_json(baseline_path)
+    print_results(report, baseline)
+    for key in ('size', 'concurrency', 'duration'):
+        if baseline['meta'].get(key) != report['meta'].get(key):
+            print(f"Warning: baseline {key}={baseline['meta'].get(key)}, this run {key}={report['meta'].get(key)}")
+
+    regressions = compare(report, baseline, options.threshold, options.min_delta)
+    if regressions:
+        print(f"\nRegressions against {baseline_path} (commit {baseline['meta'].get('commit')}):")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\nNo regressions beyond {options.threshold:.0%} against {baseline_path}")
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='REST API benchmark against a seeded fleet')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run the benchmark and compare with the baseline')
+    run.add_argument('--size', choices=sorted(SIZES, key=SIZES.get), default='10k')
+    run.add_argument('--seed', action='store_true', help='reseed the fleet before running')
+    run.add_argument('--api', default=os.getenv('BENCH_API', 'http://localhost:5000'))
+    run.add_argument('--gateway-host', default=os.getenv('GATEWAY_HOST', 'localhost'))
+    run.add_argument('--gateway-port', type=int, default=int(os.getenv('GATEWAY_PORT', 9090)))
+    run.add_argument('--scenarios', default=','.join(SCENARIOS),
+                     help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--duration', type=float, default=30, help='measured seconds per scenario')
+    run.add_argument('--warmup', type=float, default=3, help='unmeasured seconds per scenario')
+    run.add_argument('--timeout', type=float, default=30)
+    run.add_argument('--online', type=int, default=200, help='virtual stations connected for start/stop')
+    run.add_argument('--output', help='results file (default: results/<size>-<time>.json)')
+    run.add_argument('--baseline', help='baseline file (default: baselines/<size>.json)')
+    run.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+
+    diff = commands.add_parser('compare', help='compare a results file with a baseline')
+    diff.add_argument('results')
+    diff.add_argument('baseline')
+
+    for command in (run, diff):
+        command.add_argument('--threshold', type=float, default=float(os.getenv('BENCH_THRESHOLD', 0.10)),
+                             help='allowed relative regression (0.10 = 10%%)')
+        command.add_argument('--min-delta', type=float, default=1.0,
+                             help='latency changes below this many ms are noise')
+
+    options = parser.parse_args()
+    if options.command == 'run':
+        options.scenarios = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+        unknown = set(options.scenarios) - set(SCENARIOS)
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main():
+    options = parse_args()
+    if options.command == 'compare':
+        sys.exit(check(load_json(options.results), options.baseline, options))
+
+    report = Benchmark(options).run()
+    output = options.output or os.path.join(
+        RESULTS_DIR, f"{options.size}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    save_json(output, report)
+    print(f"Results written to {output}")
+
+    baseline_path = options.baseline or os.path.join(BASELINE_DIR, f'{options.size}.json')
+    if options.save_baseline:
+        save_json(baseline_path, report)
+        print(f"Baseline saved to {baseline_path}")
+        print_results(report)
+        return
+    sys.exit(check(report, baseline_path, options))
+
+
+if __name__ == "__main__":
+    main()
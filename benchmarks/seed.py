@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.db import db_config
+
+load_dotenv()
+
+# Размеры тестового парка: станций и пользователей поровну
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000}
+
+STATION_PREFIX = 'bench-'
+USER_DOMAIN = '@bench.local'
+PASSWORD = 'bench-password'
+
+# Случайные, но воспроизводимые станции вокруг Москвы
+STATIONS_SQL = '''
+    INSERT INTO charging_stations
+    (name, address, latitude, longitude, connector_type, current_type, power, status)
+    SELECT
+        %(prefix)s || n,
+        'Bench street ' || n,
+        55.55 + (hashtext('lat' || n) & 65535) / 65535.0 * 0.4,
+        37.35 + (hashtext('lon' || n) & 65535) / 65535.0 * 0.5,
+        (ARRAY['Type 2', 'CCS', 'CHAdeMO'])[1 + (n % 3)],
+        CASE WHEN n % 3 = 0 THEN 'AC' ELSE 'DC' END,
+        (ARRAY[7.4, 22.0, 50.0, 100.0, 150.0])[1 + (n % 5)],
+        'free'
+    FROM generate_series(1, %(count)s) AS n
+'''
+
+USERS_SQL = '''
+    INSERT INTO users (name, email, password, balance)
+    SELECT 'Bench user ' || n, 'bench' || n || %(domain)s, %(password)s, 100000
+    FROM generate_series(1, %(count)s) AS n
+'''
+
+
+def reset(cursor):
+    """Удаляет данные прошлого прогона: сессии, транзакции, записи журнала, пользователей и станции"""
+    cursor.execute('''
+        DELETE FROM sessions
+        WHERE station_id IN (SELECT id FROM charging_stations WHERE name LIKE %(prefix)s)
+           OR user_id IN (SELECT id FROM users WHERE email LIKE %(domain)s)
+    ''', {'prefix': STATION_PREFIX + '%', 'domain': '%' + USER_DOMAIN})
+    cursor.execute('''
+        DELETE FROM transactions WHERE user_id IN (SELECT id FROM users WHERE email LIKE %s)
+    ''', ('%' + USER_DOMAIN,))
+    cursor.execute('''
+        DELETE FROM ledger_entries WHERE user_id IN (SELECT id FROM users WHERE email LIKE %s)
+    ''', ('%' + USER_DOMAIN,))
+    cursor.execute('''
+        UPDATE charging_stations SET reserved_by = NULL
+        WHERE reserved_by IN (SELECT id FROM users WHERE email LIKE %s)
+    ''', ('%' + USER_DOMAIN,))
+    cursor.execute('DELETE FROM charging_stations WHERE name LIKE %s', (STATION_PREFIX + '%',))
+    cursor.execute('DELETE FROM users WHERE email LIKE %s', ('%' + USER_DOMAIN,))
+
+
+def seed(size):
+    count = SIZES[size]
+    # Хеш один на всех: генерация 100k хешей заняла бы дольше самого прогона
+    password = generate_password_hash(PASSWORD)
+    conn = psycopg2.connect(**db_config())
+    try:
+        with conn.cursor() as cursor:
+            reset(cursor)
+            cursor.execute(STATIONS_SQL, {'prefix': STATION_PREFIX, 'count': count})
+            cursor.execute(USERS_SQL, {'domain': USER_DOMAIN, 'password': password, 'count': count})
+            conn.commit()
+            cursor.execute('ANALYZE charging_stations')
+            cursor.execute('ANALYZE users')
+            conn.commit()
+    finally:
+        conn.close()
+    print(f"Seeded {count} stations and {count} users ({size})")
+
+
+def seeded_fleet(cursor):
+    """ID станций и email пользователей тестового парка, по возрастанию ID"""
+    cursor.execute('SELECT id FROM charging_stations WHERE name LIKE %s ORDER BY id', (STATION_PREFIX + '%',))
+    stations = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT email FROM users WHERE email LIKE %s ORDER BY id', ('%' + USER_DOMAIN,))
+    users = [row[0] for row in cursor.fetchall()]
+    return stations, users
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seed the benchmark fleet (replaces the previous one)')
+    parser.add_argument('size', choices=sorted(SIZES, key=SIZES.get))
+    seed(parser.parse_args().size)
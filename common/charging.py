@@ -0,0 +1,201 @@
+from common.ledger import charge_session
+from common.station_cache import NOTIFY_CHANNEL
+
+# Итог start_session/stop_session
+STARTED = 'started'
+STOPPED = 'stopped'
+NO_STATION = 'not_found'
+UNAVAILABLE = 'unavailable'  # станция не свободна и не забронирована
+RESERVED_BY_OTHER = 'reserved'  # действующая бронь другого пользователя
+NOT_CHARGING = 'not_charging'
+NO_SESSION = 'no_session'  # у пользователя нет открытой сессии на станции
+
+# Проверка и переход выполняются на сервере БД одним вызовом: строка
+# станции блокируется только на время функции, без круговых поездок
+# клиента между SELECT ... FOR UPDATE и UPDATE. Уведомление кэша
+# состояния (формат StationStateCache) уходит только при успехе.
+START_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION start_charging_session(
+        p_station_id INTEGER, p_user_id INTEGER, p_channel TEXT, p_origin TEXT)
+    RETURNS TABLE (result TEXT, previous_status TEXT, session_id INTEGER,
+                   started_at TIMESTAMP, meter_start FLOAT) AS $$
+    DECLARE
+        station RECORD;
+    BEGIN
+        SELECT cs.status, cs.reserved_by, cs.reserved_until, cs.power_consumption INTO station
+        FROM charging_stations cs WHERE cs.id = p_station_id FOR UPDATE;
+        IF NOT FOUND THEN
+            result := 'not_found';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+
+        previous_status := trim(station.status);
+        IF previous_status NOT IN ('free', 'reserved') THEN
+            result := 'unavailable';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+        IF previous_status = 'reserved' AND station.reserved_by IS DISTINCT FROM p_user_id
+           AND (station.reserved_until IS NULL OR station.reserved_until > LOCALTIMESTAMP) THEN
+            result := 'reserved';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+
+        UPDATE charging_stations
+        SET status = 'busy', using_by = p_user_id, reserved_until = NULL
+        WHERE id = p_station_id;
+
+        meter_start := COALESCE(station.power_consumption, 0);
+        INSERT INTO sessions (station_id, user_id, start_time, initial_electricity_meter)
+        VALUES (p_station_id, p_user_id, LOCALTIMESTAMP, meter_start)
+        RETURNING id, start_time INTO session_id, started_at;
+
+        PERFORM pg_notify(p_channel, json_build_object(
+            'id', p_station_id, 'origin', p_origin,
+            'fields', json_build_object('status', 'busy', 'using_by', p_user_id))::text);
+        result := 'started';
+        RETURN NEXT;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+# Энергия сессии: последнее показание из очереди EnergyIngestor, затем
+# записанное в сессию; значение клиента - только если показаний счетчика
+# нет, иначе оценка по мощности
+STOP_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION stop_charging_session(
+        p_station_id INTEGER, p_user_id INTEGER, p_energy FLOAT, p_reading FLOAT,
+        p_channel TEXT, p_origin TEXT)
+    RETURNS TABLE (result TEXT, session_id INTEGER, started_at TIMESTAMP, ended_at TIMESTAMP,
+                   energy FLOAT, meter_start FLOAT, meter_end FLOAT) AS $$
+    DECLARE
+        station RECORD;
+        open_session RECORD;
+    BEGIN
+        SELECT cs.status, cs.power INTO station
+        FROM charging_stations cs WHERE cs.id = p_station_id FOR UPDATE;
+        IF NOT FOUND THEN
+            result := 'not_found';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+        IF trim(station.status) <> 'busy' THEN
+            result := 'not_charging';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+
+        SELECT s.id, s.start_time, s.initial_electricity_meter, s.energy_consumed INTO open_session
+        FROM sessions s
+        WHERE s.station_id = p_station_id AND s.user_id = p_user_id AND s.end_time IS NULL
+        ORDER BY s.id DESC
+        LIMIT 1
+        FOR UPDATE;
+        IF NOT FOUND THEN
+            result := 'no_session';
+            RETURN NEXT;
+            RETURN;
+        END IF;
+
+        session_id := open_session.id;
+        started_at := open_session.start_time;
+        ended_at := LOCALTIMESTAMP;
+        energy := COALESCE(p_reading, open_session.energy_consumed, p_energy,
+                           COALESCE(station.power, 0) * EXTRACT(EPOCH FROM ended_at - started_at)::float / 3600);
+        meter_start := COALESCE(open_session.initial_electricity_meter, 0);
+        meter_end := meter_start + energy;
+
+        UPDATE charging_stations
+        SET status = 'free', reserved_by = NULL, using_by = NULL, reserved_until = NULL,
+            power_consumption = COALESCE(power_consumption, 0) + energy
+        WHERE id = p_station_id;
+
+        UPDATE sessions
+        SET end_time = ended_at, energy_consumed = energy, end_electricity_meter = meter_end
+        WHERE id = open_session.id;
+
+        PERFORM pg_notify(p_channel, json_build_object(
+            'id', p_station_id, 'origin', p_origin,
+            'fields', json_build_object('status', 'free', 'reserved_by', NULL, 'using_by', NULL))::text);
+        result := 'stopped';
+        RETURN NEXT;
+    END;
+    $$ LANGUAGE plpgsql
+'''
+
+# Откат запуска, который станция не приняла: сессия закрывается с нулевой
+# энергией, станция возвращается в прежний статус, если она все еще busy
+CANCEL_SQL = '''
+    WITH closed AS (
+        UPDATE sessions SET end_time = LOCALTIMESTAMP, energy_consumed = 0
+        WHERE id = %(session_id)s AND end_time IS NULL
+        RETURNING station_id
+    )
+    UPDATE charging_stations
+    SET status = %(status)s, using_by = NULL
+    WHERE id = %(station_id)s AND status = 'busy' AND id IN (SELECT station_id FROM closed)
+'''
+
+
+def install(cursor):
+    """Создает (или обновляет) функции запуска и остановки зарядки"""
+    cursor.execute(START_FUNCTION)
+    cursor.execute(STOP_FUNCTION)
+
+
+def _row(cursor):
+    row = cursor.fetchone()
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+def start_session(cursor, station_cache, tariffs, station_id, user_id):
+    """Открывает сессию в транзакции вызывающего; коммит и apply() - за ним.
+
+    Возвращает result (STARTED или причину отказа), previous_status,
+    session_id, started_at и meter_start.
+    """
+    cursor.execute(
+        'SELECT * FROM start_charging_session(%s, %s, %s, %s)',
+        (station_id, user_id, NOTIFY_CHANNEL, station_cache.origin)
+    )
+    started = _row(cursor)
+    if started['result'] == STARTED:
+        tariffs.begin(cursor, station_id, started['session_id'], user_id, started['started_at'])
+    return started
+
+
+def stop_session(cursor, station_cache, ingestor, tariffs, station_id, user_id, energy=None):
+    """Закрывает сессию пользователя; возвращает result, session_id, energy,
+    показания счетчика и cost - итоговую стоимость по тарифу станции"""
+    # Последнее показание из очереди передаем аргументом, а не отдельным UPDATE.
+    # Из очереди оно убирается только после закрытия сессии: при отказе
+    # показание остается и будет записано как обычно
+    reading = ingestor.peek_station(station_id)
+    meter = tariffs.meter_for(cursor, station_id, user_id)
+    cursor.execute(
+        'SELECT * FROM stop_charging_session(%s, %s, %s, %s, %s, %s)',
+        (station_id, user_id, energy, reading, NOTIFY_CHANNEL, station_cache.origin)
+    )
+    stopped = _row(cursor)
+    stopped['cost'] = None
+    if stopped['result'] == STOPPED:
+        # Если транзакция вызывающего откатится, следующий кадр станции
+        # снова поставит показание открытой сессии в очередь
+        ingestor.take_station(station_id)
+        # Стоимость досчитывается от последнего показания; списание - запись
+        # журнала в той же транзакции, что и закрытие сессии
+        stopped['cost'] = tariffs.finish(cursor, station_id, meter, stopped)
+        charge_session(cursor, user_id, stopped['session_id'], stopped['cost'])
+    return stopped
+
+
+def cancel_session(cursor, station_cache, tariffs, station_id, session_id, status):
+    """Откатывает запуск; True, если станция возвращена в status"""
+    tariffs.discard(station_id, session_id)
+    cursor.execute(CANCEL_SQL, {'station_id': station_id, 'session_id': session_id, 'status': status})
+    if not cursor.rowcount:
+        return False
+    station_cache.notify(cursor, station_id, status=status, using_by=None)
+    return True
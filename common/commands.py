@@ -0,0 +1,322 @@
+import heapq
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# Итог команды
+ACK = 'ack'
+NACK = 'nack'
+TIMEOUT = 'timeout'  # итог пока неизвестен (например, шлюз-владелец не ответил)
+EXPIRED = 'expired'  # диспетчер снял команду: повторы исчерпаны или истек ее срок
+NOT_CONNECTED = 'not_connected'
+
+ACK_ACTION = 'command_ack'
+# Станция, подтверждающая команды, сообщает об этом в register_command ({"acks": true});
+# командам станций без подтверждений итог ACK выставляется после доставки
+ACKS_CAPABILITY = 'acks'
+DELIVERED_MESSAGE = 'Delivered; station does not acknowledge commands'
+
+
+class PendingCommand:
+    """Команда, ожидающая подтверждения станции"""
+
+    def __init__(self, station_id, command, ttl):
+        self.id = uuid.uuid4().hex[:16]
+        self.station_id = station_id
+        self.command = {**command, 'command_id': self.id}
+        self.attempts = 0
+        self.deadline = None
+        self.created_at = time.monotonic()
+        self.expires_at = self.created_at + ttl
+        self.result = None
+        self._done = threading.Event()
+
+    def resolve(self, status, message=None):
+        if self._done.is_set():
+            return
+        self.result = {
+            'status': status,
+            'command_id': self.id,
+            'attempts': self.attempts,
+            'message': message,
+            'latency_ms': round((time.monotonic() - self.created_at) * 1000, 2),
+        }
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Итог команды или None, если за timeout он не определился"""
+        self._done.wait(timeout)
+        return self.result
+
+    @property
+    def acknowledged(self):
+        return self.result is not None and self.result['status'] == ACK
+
+
+class CommandDispatcher:
+    """Очереди исходящих команд станций с подтверждениями и повторами.
+
+    У каждой станции своя очередь и не больше одной команды в полете:
+    порядок команд станции сохраняется, а медленная станция не задерживает
+    остальные. Отправкой и таймаутами занимается один фоновый поток;
+    вызывающий получает PendingCommand и может ждать итог с дедлайном.
+    Повтор уходит с тем же command_id, станция отвечает на дубликат
+    прежним подтверждением. У команды есть срок (ttl): не подтвержденная
+    к нему команда снимается с итогом EXPIRED, в том числе из очереди
+    отключенной станции - после переподключения устаревшие команды не
+    доставляются. Станции старых прошивок не подтверждают команды: для
+    их соединений (register(..., acks=False)) итог - успешная отправка.
+    """
+
+    def __init__(self, ack_timeout=None, max_attempts=None, max_queue=100, ttl=None):
+        self.ack_timeout = float(ack_timeout or os.getenv('COMMAND_ACK_TIMEOUT', 3))
+        self.max_attempts = int(max_attempts or os.getenv('COMMAND_MAX_ATTEMPTS', 3))
+        self.max_queue = max_queue
+        self.ttl = float(ttl or os.getenv('COMMAND_TTL', self.ack_timeout * self.max_attempts))
+
+        self._cond = threading.Condition()
+        self._channels = {}  # {station_id: channel}
+        self._stations = {}  # {channel: station_id} - для отключения за O(1)
+        self._unacked = set()  # соединения станций, не подтверждающих команды
+        self._queues = {}  # {station_id: deque(PendingCommand)}
+        self._inflight = {}  # {station_id: PendingCommand}
+        self._by_id = {}  # {command_id: PendingCommand}
+        self._ready = set()  # станции, у которых можно отправить следующую команду
+        self._deadlines = []  # heap (deadline, command_id)
+        self._expiry = []  # heap (expires_at, command_id)
+        self._stopped = False
+        self._thread = None
+
+        self.sent = 0
+        self.retries = 0
+        self.acked = 0
+        self.nacked = 0
+        self.timeouts = 0
+        self.expired = 0
+        self.delivered = 0
+
+    def register(self, station_id, channel, acks=True):
+        """Командное соединение станции; команда в полете переотправляется сразу.
+        acks=False - станция не подтверждает команды (нет ACKS_CAPABILITY)"""
+        with self._cond:
+            previous = self._channels.get(station_id)
+            if previous is not None:
+                self._stations.pop(previous, None)
+                self._unacked.discard(previous)
+            self._channels[station_id] = channel
+            self._stations[channel] = station_id
+            if not acks:
+                self._unacked.add(channel)
+            pending = self._inflight.get(station_id)
+            if pending is not None:
+                self._push_deadline(pending, 0)
+            self._ready.add(station_id)
+            self._cond.notify_all()
+
+    def unregister(self, channel):
+        """Закрытое соединение; ожидающие команды дождутся переподключения или своего срока"""
+        with self._cond:
+            station_id = self._stations.pop(channel, None)
+            self._unacked.discard(channel)
+            if station_id is not None and self._channels.get(station_id) is channel:
+                del self._channels[station_id]
+
+    def is_connected(self, station_id):
+        return station_id in self._channels
+
+    def connected_stations(self):
+        with self._cond:
+            return list(self._channels)
+
+    def dispatch(self, station_id, command, ttl=None):
+        pending = PendingCommand(station_id, command, self.ttl if ttl is None else ttl)
+        with self._cond:
+            if station_id not in self._channels:
+                pending.resolve(NOT_CONNECTED, 'Station is not connected')
+                return pending
+            queue = self._queues.setdefault(station_id, deque())
+            if len(queue) >= self.max_queue:
+                pending.resolve(NACK, 'Command queue is full')
+                return pending
+            queue.append(pending)
+            self._by_id[pending.id] = pending
+            heapq.heappush(self._expiry, (pending.expires_at, pending.id))
+            self._ready.add(station_id)
+            self._cond.notify_all()
+        return pending
+
+    def send(self, station_id, command, timeout=None):
+        """Отправляет команду со сроком timeout секунд и ждет ее итог.
+
+        Итог всегда окончательный: команда, не подтвержденная к сроку,
+        снимается с итогом EXPIRED и станции уже не отправляется.
+        """
+        if timeout is None:
+            timeout = self.ttl
+        pending = self.dispatch(station_id, command, ttl=timeout)
+        if pending.wait(timeout) is None:
+            self.expire(pending)
+        return pending.result
+
+    def expire(self, pending):
+        """Снимает команду, если итога еще нет; подтверждение, пришедшее раньше, остается итогом"""
+        with self._cond:
+            if self._by_id.get(pending.id) is not pending:
+                return False
+            self._withdraw(pending)
+            self.expired += 1
+            self._cond.notify_all()
+        pending.resolve(EXPIRED, 'Command expired before acknowledgement')
+        return True
+
+    def _withdraw(self, pending):
+        """Под блокировкой: убирает команду из очереди или из полета"""
+        del self._by_id[pending.id]
+        if self._inflight.get(pending.station_id) is pending:
+            del self._inflight[pending.station_id]
+            self._ready.add(pending.station_id)
+            return
+        queue = self._queues.get(pending.station_id)
+        if queue is not None:
+            try:
+                queue.remove(pending)
+            except ValueError:
+                pass
+
+    def acknowledge(self, command_id, ok=True, message=None):
+        """Подтверждение (ACK/NACK) от станции"""
+        with self._cond:
+            pending = self._by_id.pop(command_id, None)
+            if pending is None:
+                return False
+            if self._inflight.get(pending.station_id) is pending:
+                del self._inflight[pending.station_id]
+                self._ready.add(pending.station_id)
+            if ok:
+                self.acked += 1
+            else:
+                self.nacked += 1
+            self._cond.notify_all()
+        pending.resolve(ACK if ok else NACK, message)
+        return True
+
+    def _push_deadline(self, pending, delay):
+        pending.deadline = time.monotonic() + delay
+        heapq.heappush(self._deadlines, (pending.deadline, pending.id))
+
+    def _collect(self):
+        """Под блокировкой: что отправить сейчас и что завершить по таймауту"""
+        now = time.monotonic()
+        to_send, expired = [], []
+
+        # Срок команды истек - в очереди или в полете, на подключенной станции или нет
+        while self._expiry and self._expiry[0][0] <= now:
+            _, command_id = heapq.heappop(self._expiry)
+            pending = self._by_id.get(command_id)
+            if pending is None:
+                continue
+            self._withdraw(pending)
+            self.expired += 1
+            expired.append((pending, 'Command expired before acknowledgement'))
+
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, command_id = heapq.heappop(self._deadlines)
+            pending = self._by_id.get(command_id)
+            if pending is None or pending.deadline != deadline:
+                continue
+            channel = self._channels.get(pending.station_id)
+            if pending.attempts >= self.max_attempts:
+                self._withdraw(pending)
+                self.timeouts += 1
+                expired.append((pending, f'No acknowledgement after {pending.attempts} attempts'))
+            elif channel is None:
+                self._push_deadline(pending, self.ack_timeout)
+            else:
+                if pending.attempts:
+                    self.retries += 1
+                to_send.append((channel, pending))
+
+        for station_id in list(self._ready):
+            if station_id in self._inflight:
+                self._ready.discard(station_id)
+                continue
+            queue = self._queues.get(station_id)
+            channel = self._channels.get(station_id)
+            if not queue:
+                self._ready.discard(station_id)
+                self._queues.pop(station_id, None)
+                continue
+            if channel is None:
+                continue
+            self._ready.discard(station_id)
+            pending = queue.popleft()
+            self._inflight[station_id] = pending
+            to_send.append((channel, pending))
+
+        for channel, pending in to_send:
+            pending.attempts += 1
+            self._push_deadline(pending, self.ack_timeout)
+        return to_send, expired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                to_send, expired = self._collect()
+                if not to_send and not expired:
+                    heads = [heap[0][0] for heap in (self._deadlines, self._expiry) if heap]
+                    self._cond.wait(min(heads) - time.monotonic() if heads else None)
+                    continue
+
+            for pending, message in expired:
+                pending.resolve(EXPIRED, message)
+            for channel, pending in to_send:
+                try:
+                    channel.send(pending.command)
+                    self.sent += 1
+                except Exception as e:
+                    # Соединение потеряно - повтор после переподключения
+                    print(f"Error sending command to station {pending.station_id}: {e}")
+                    self.unregister(channel)
+                    continue
+                if channel in self._unacked:
+                    self.delivered += 1
+                    self.acknowledge(pending.id, True, DELIVERED_MESSAGE)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            pending = list(self._by_id.values())
+            self._by_id.clear()
+            self._cond.notify_all()
+        for command in pending:
+            command.resolve(NOT_CONNECTED, 'Dispatcher stopped')
+
+    def stats(self):
+        with self._cond:
+            queued = sum(len(queue) for queue in self._queues.values())
+            inflight = len(self._inflight)
+            connected = len(self._channels)
+        return {
+            'connected': connected,
+            'queued': queued,
+            'inflight': inflight,
+            'sent': self.sent,
+            'retries': self.retries,
+            'acked': self.acked,
+            'nacked': self.nacked,
+            'timeouts': self.timeouts,
+            'expired': self.expired,
+            'delivered': self.delivered,
+        }
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+
+def db_config():
+    """Параметры подключения к PostgreSQL (можно переопределить через .env)"""
+    return {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'database': os.getenv('DB_NAME', 'postgres'),
+        'user': os.getenv('DB_USER', 'postgres'),
+        'password': os.getenv('DB_PASSWORD', 'postgres'),
+        'port': os.getenv('DB_PORT', '5432'),
+    }
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class DatabasePool:
+    """Потокобезопасный пул соединений PostgreSQL с проверкой здоровья и метриками"""
+
+    def __init__(self, minconn=None, maxconn=None, checkout_timeout=10.0,
+                 health_check_interval=30.0, **db_config_overrides):
+        self.minconn = int(minconn or os.getenv('DB_POOL_MIN', 1))
+        self.maxconn = int(maxconn or os.getenv('DB_POOL_MAX', 20))
+        self.checkout_timeout = checkout_timeout
+        # Соединение, простоявшее дольше этого времени, проверяется SELECT 1
+        self.health_check_interval = health_check_interval
+        self.db_config = {**db_config(), **db_config_overrides}
+
+        self._pool = None
+        self._init_lock = threading.Lock()
+        # ThreadedConnectionPool не ждет свободного соединения, а сразу
+        # бросает PoolError, поэтому очередь ожидания держим на семафоре
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._last_used = {}
+
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._health_failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _get_pool(self):
+        # Пул создается лениво, чтобы импорт модуля не требовал живой БД
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, **self.db_config
+                    )
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._stats_lock:
+                self._timeouts += 1
+            raise PoolTimeout(f'No free database connection after {self.checkout_timeout}s')
+
+        try:
+            db_pool = self._get_pool()
+            conn = db_pool.getconn()
+            if not self._is_healthy(conn):
+                with self._stats_lock:
+                    self._health_failures += 1
+                self._last_used.pop(id(conn), None)
+                db_pool.putconn(conn, close=True)
+                conn = db_pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        try:
+            broken = conn.closed != 0
+            if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # Не возвращаем в пул соединение с незавершенной транзакцией
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._get_pool().putconn(conn, close=broken)
+        finally:
+            with self._stats_lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение из пула; при исключении откатывает транзакцию"""
+        conn = self.getconn()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts = self._checkouts
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'peak_in_use': self._peak_in_use,
+                'utilization': self._in_use / self.maxconn,
+                'checkouts': checkouts,
+                'timeouts': self._timeouts,
+                'health_check_failures': self._health_failures,
+                'wait_avg_ms': (self._wait_total / checkouts * 1000) if checkouts else 0.0,
+                'wait_max_ms': self._wait_max * 1000,
+            }
+
+    def closeall(self):
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+            self._last_used.clear()
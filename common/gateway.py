@@ -0,0 +1,165 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.protocol import (
+    CODEC_JSON, MAX_FRAME_SIZE, RECV_SIZE, ChannelState, ProtocolError, handshake_codec,
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class AsyncMessageChannel(ChannelState):
+    """Соединение шлюза: читается в цикле событий, писать можно из любого потока.
+
+    Интерфейс send/reply совпадает с MessageChannel, поэтому обработчики
+    запросов не знают, каким сервером обслуживается станция.
+    """
+
+    def __init__(self, reader, writer, gateway, codec=CODEC_JSON, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(codec, max_frame_size)
+        self.reader = reader
+        self.writer = writer
+        self.gateway = gateway
+        self.peer = writer.get_extra_info('peername')
+
+    def send(self, message):
+        data = self.encode(message)
+        if self.writer.is_closing():
+            raise ConnectionError(f'Connection to {self.peer} is closed')
+        if self.gateway.in_loop_thread():
+            self.writer.write(data)
+        else:
+            self.gateway.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def reply(self, request, response):
+        codec = handshake_codec(request, response)
+        if codec:
+            response = {**response, 'codec': codec}
+        self.send(response)
+        if codec:
+            self.set_codec(codec)
+
+    async def receive_batch(self):
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            batch = self.decoder.feed(data)
+            if batch:
+                return batch
+
+    def close(self):
+        if self.gateway.in_loop_thread():
+            self.writer.close()
+        else:
+            self.gateway.loop.call_soon_threadsafe(self.writer.close)
+
+
+class StationGateway:
+    """Асинхронный шлюз: все порты станций и API обслуживаются одним циклом событий.
+
+    Обработчики остаются синхронными и выполняются в ограниченном пуле
+    потоков (по размеру пула соединений с БД), запросы одного соединения
+    обрабатываются строго по порядку.
+    """
+
+    def __init__(self, max_workers=16, backlog=1024):
+        self.max_workers = max_workers
+        self.backlog = backlog
+        self.listeners = []
+        self.channels = set()
+        self._tasks = set()
+        self.loop = None
+        self.executor = None
+        self._loop_thread_id = None
+        self._servers = []
+        self._started = threading.Event()
+        self._stop_event = None
+
+    def add_listener(self, host, port, handler, on_disconnect=None, name='station'):
+        """handler(request, channel) -> dict ответа или None; on_disconnect(channel) при закрытии"""
+        self.listeners.append((host, port, handler, on_disconnect, name))
+
+    def in_loop_thread(self):
+        return threading.get_ident() == self._loop_thread_id
+
+    def run(self):
+        """Блокирующий запуск шлюза в текущем потоке"""
+        self.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._loop_thread_id = threading.get_ident()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='gateway')
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    def start(self):
+        """Запуск шлюза в фоновом потоке; возвращает управление после bind"""
+        threading.Thread(target=self.run, daemon=True).start()
+        self._started.wait()
+
+    def stop(self):
+        if self.loop and self._stop_event:
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def _serve(self):
+        self._stop_event = asyncio.Event()
+        for host, port, handler, on_disconnect, name in self.listeners:
+            server = await asyncio.start_server(
+                lambda r, w, h=handler, d=on_disconnect, n=name: self._handle_connection(r, w, h, d, n),
+                host, port, reuse_address=True, backlog=self.backlog,
+            )
+            self._servers.append(server)
+            print(f"Gateway {name} server listening on {host}:{port}")
+        self._started.set()
+
+        await self._stop_event.wait()
+
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _handle_connection(self, reader, writer, handler, on_disconnect, name):
+        channel = AsyncMessageChannel(reader, writer, self)
+        self.channels.add(channel)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            while True:
+                batch = await channel.receive_batch()
+                if batch is None:
+                    break
+                for request in batch:
+                    if request is None:
+                        channel.send({"status": "error", "message": "Invalid JSON"})
+                        continue
+                    try:
+                        response = await self.loop.run_in_executor(self.executor, handler, request, channel)
+                    except Exception as e:
+                        response = {"status": "error", "message": str(e)}
+                    # None - сообщение без ответа (например, подтверждение команды)
+                    if response is not None:
+                        channel.reply(request, response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            print(f"Client {channel.peer} ({name}) disconnected")
+        except asyncio.CancelledError:
+            # Остановка шлюза
+            pass
+        except ProtocolError as e:
+            print(f"Protocol error from {name} client {channel.peer}: {e}")
+        finally:
+            self.channels.discard(channel)
+            self._tasks.discard(task)
+            if on_disconnect:
+                await self.loop.run_in_executor(self.executor, on_disconnect, channel)
+            writer.close()
@@ -0,0 +1,63 @@
+import bisect
+import hashlib
+import os
+
+
+def gateway_list(value=None):
+    """Адреса шлюзов "host:port,host:port" из аргумента или GATEWAYS"""
+    value = value if value is not None else os.getenv('GATEWAYS', '')
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class HashRing:
+    """Консистентное хеширование station_id на шлюзы.
+
+    У каждого шлюза vnodes точек на кольце; при добавлении или удалении
+    шлюза переезжает только доля станций, попавшая на его точки.
+    """
+
+    def __init__(self, nodes=(), vnodes=64):
+        self.vnodes = vnodes
+        self._points = []  # отсортированные хеши
+        self._owners = {}  # {хеш: шлюз}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        for i in range(self.vnodes):
+            point = self._hash(f'{node}#{i}')
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node):
+        for i in range(self.vnodes):
+            point = self._hash(f'{node}#{i}')
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def nodes(self):
+        return sorted(set(self._owners.values()))
+
+    def node_for(self, station_id):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(station_id)) % len(self._points)
+        return self._owners[self._points[index]]
+
+    def preference(self, station_id):
+        """Все шлюзы в порядке обхода кольца от станции - для переподключения"""
+        if not self._points:
+            return []
+        start = bisect.bisect(self._points, self._hash(station_id))
+        order = []
+        for i in range(len(self._points)):
+            node = self._owners[self._points[(start + i) % len(self._points)]]
+            if node not in order:
+                order.append(node)
+        return order
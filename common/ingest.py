@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+# Стоимость (если ее считает TariffEngine) пишется вместе с энергией
+_UPDATE_SESSIONS = """
+    UPDATE sessions AS s
+    SET energy_consumed = v.energy,
+        cost = COALESCE(v.cost, s.cost),
+        metered_at = COALESCE(v.metered_at, s.metered_at)
+    FROM (VALUES %s) AS v(id, station_id, user_id, energy, cost, metered_at)
+    WHERE s.id = v.id AND s.station_id = v.station_id
+      AND s.user_id = v.user_id AND s.end_time IS NULL
+"""
+_ROW_TEMPLATE = '(%s::int, %s::int, %s::int, %s::float, %s::float, %s::timestamp)'
+
+
+class EnergyIngestor:
+    """Пакетная запись показаний энергии из update-кадров станций.
+
+    Для каждой сессии хранится только последнее показание, фоновый поток
+    пишет их многострочным UPDATE. Когда в очереди max_pending сессий,
+    submit ждет освобождения места (обратное давление на соединение
+    станции), а по истечении таймаута отбрасывает показание - следующий
+    кадр все равно его перекроет.
+    """
+
+    def __init__(self, db_pool, flush_interval=None, batch_size=1000, max_pending=None,
+                 submit_timeout=5.0):
+        self.db_pool = db_pool
+        self.flush_interval = float(flush_interval or os.getenv('ENERGY_FLUSH_INTERVAL', 2))
+        self.batch_size = batch_size
+        self.max_pending = int(max_pending or os.getenv('ENERGY_MAX_PENDING', 50000))
+        self.submit_timeout = submit_timeout
+
+        self._cond = threading.Condition()
+        self._pending = {}  # {session_id: (station_id, user_id, energy, cost, metered_at)}
+        self._inflight = set()  # станции, чьи показания сейчас пишутся
+        self._stopped = False
+        self._thread = None
+
+        self.accepted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.rows_written = 0
+        self.batches = 0
+
+    def submit(self, station_id, user_id, session_id, energy_consumed, cost=None, metered_at=None):
+        """Ставит показание в очередь; False - очередь переполнена и показание отброшено"""
+        if session_id is None:
+            return False
+        row = (station_id, user_id, float(energy_consumed or 0), cost, metered_at)
+        deadline = time.monotonic() + self.submit_timeout
+        with self._cond:
+            if session_id in self._pending:
+                self._pending[session_id] = row
+                self.coalesced += 1
+                return True
+            while len(self._pending) >= self.max_pending:
+                self._cond.notify_all()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self.dropped += 1
+                    return False
+            self._pending[session_id] = row
+            self.accepted += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+            return True
+
+    def _write(self, cursor, rows):
+        execute_values(cursor, _UPDATE_SESSIONS, rows, template=_ROW_TEMPLATE, page_size=self.batch_size)
+
+    def flush_station(self, station_id, cursor):
+        """Дописывает последнее показание станции в транзакции вызывающего.
+
+        Вызывается перед завершением сессии, чтобы stop_charging не прочитал
+        устаревший energy_consumed. Если пачка с этой станцией уже пишется
+        фоновым потоком, ждем ее завершения.
+        """
+        return self.flush_stations((station_id,), cursor)
+
+    def flush_stations(self, station_ids, cursor):
+        """То же, что flush_station, для набора станций одним запросом"""
+        station_ids = set(station_ids)
+        with self._cond:
+            while station_ids & self._inflight:
+                self._cond.wait()
+            rows = [
+                (session_id, *row) for session_id, row in self._pending.items()
+                if row[0] in station_ids
+            ]
+            for row in rows:
+                del self._pending[row[0]]
+            self._cond.notify_all()
+        if rows:
+            self._write(cursor, rows)
+        return len(rows)
+
+    def peek_station(self, station_id):
+        """Последнее показание станции (энергия) в очереди или None, не забирая его.
+
+        Для завершения сессии одним запросом: показание уходит аргументом
+        в stop_charging_session вместо отдельного UPDATE.
+        """
+        with self._cond:
+            while station_id in self._inflight:
+                self._cond.wait()
+            sessions = [session_id for session_id, row in self._pending.items() if row[0] == station_id]
+            return self._pending[max(sessions)][2] if sessions else None
+
+    def take_station(self, station_id):
+        """Забирает из очереди последнее показание станции (энергию) или None"""
+        with self._cond:
+            while station_id in self._inflight:
+                self._cond.wait()
+            sessions = [session_id for session_id, row in self._pending.items() if row[0] == station_id]
+            energy = None
+            for session_id in sorted(sessions):
+                energy = self._pending.pop(session_id)[2]
+            self._cond.notify_all()
+        return energy
+
+    def flush(self):
+        with self._cond:
+            if not self._pending:
+                return 0
+            batch = [(session_id, *row) for session_id, row in self._pending.items()]
+            self._pending = {}
+            self._inflight = {row[1] for row in batch}
+            self._cond.notify_all()
+
+        try:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                for i in range(0, len(batch), self.batch_size):
+                    self._write(cur, batch[i:i + self.batch_size])
+                conn.commit()
+        except Exception as e:
+            print(f"Energy ingestion flush failed: {e}")
+            # Возвращаем показания, если за это время не пришли более свежие
+            with self._cond:
+                for session_id, *row in batch:
+                    self._pending.setdefault(session_id, tuple(row))
+            return 0
+        finally:
+            with self._cond:
+                self._inflight = set()
+                self._cond.notify_all()
+
+        self.batches += 1
+        self.rows_written += len(batch)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'accepted': self.accepted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'rows_written': self.rows_written,
+        }
@@ -0,0 +1,203 @@
+import os
+import threading
+
+# Виды записей журнала; сумма со знаком: пополнение +, оплата сессии -
+DEPOSIT = 'deposit'
+SESSION = 'session'
+OPENING = 'opening'  # баланс пользователя на момент перехода на журнал
+
+# Ключ advisory-блокировки расчета: в каждый момент баланс пересчитывает
+# только один процесс, поэтому UPDATE users не взаимоблокируется
+SETTLEMENT_LOCK = 0x6c656467
+
+TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS ledger_entries (
+        id BIGSERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users(id) NOT NULL,
+        amount DECIMAL(12, 2) NOT NULL,
+        kind VARCHAR(20) NOT NULL,
+        reference_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        settled_at TIMESTAMP
+    )
+'''
+
+# Записи, еще не перенесенные в users.balance: их мало, индекс небольшой
+UNSETTLED_INDEX_SQL = '''
+    CREATE INDEX IF NOT EXISTS ledger_entries_unsettled_idx
+    ON ledger_entries (user_id) WHERE settled_at IS NULL
+'''
+
+# Одна запись на пополнение или сессию: повторная оплата не проходит
+REFERENCE_INDEX_SQL = '''
+    CREATE UNIQUE INDEX IF NOT EXISTS ledger_entries_reference_idx
+    ON ledger_entries (kind, reference_id) WHERE reference_id IS NOT NULL
+'''
+
+OPENING_SQL = '''
+    INSERT INTO ledger_entries (user_id, amount, kind, settled_at)
+    SELECT u.id, u.balance, 'opening', CURRENT_TIMESTAMP
+    FROM users u
+    WHERE COALESCE(u.balance, 0) <> 0
+      AND NOT EXISTS (SELECT 1 FROM ledger_entries le WHERE le.user_id = u.id)
+'''
+
+POST_SQL = '''
+    INSERT INTO ledger_entries (user_id, amount, kind, reference_id)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (kind, reference_id) WHERE reference_id IS NOT NULL DO NOTHING
+    RETURNING id
+'''
+
+# Рассчитанный баланс плюс еще не рассчитанные записи - одним запросом,
+# в одном снимке: запись не учитывается дважды, если расчет идет сейчас
+BALANCE_SQL = '''
+    SELECT COALESCE(u.balance, 0) + COALESCE((
+        SELECT sum(le.amount) FROM ledger_entries le
+        WHERE le.user_id = u.id AND le.settled_at IS NULL
+    ), 0)
+    FROM users u WHERE u.id = %s
+'''
+
+SETTLE_SQL = '''
+    WITH batch AS (
+        SELECT id FROM ledger_entries
+        WHERE settled_at IS NULL
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), settled AS (
+        UPDATE ledger_entries le SET settled_at = CURRENT_TIMESTAMP
+        FROM batch WHERE le.id = batch.id
+        RETURNING le.user_id, le.amount
+    ), totals AS (
+        SELECT user_id, sum(amount) AS amount, count(*) AS entries
+        FROM settled GROUP BY user_id
+    )
+    UPDATE users u SET balance = COALESCE(u.balance, 0) + totals.amount
+    FROM totals WHERE u.id = totals.user_id
+    RETURNING u.id, totals.entries
+'''
+
+# Проверка: рассчитанный баланс равен сумме рассчитанных записей
+VERIFY_SQL = '''
+    SELECT u.id, COALESCE(u.balance, 0), COALESCE(s.total, 0)
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, sum(amount) AS total FROM ledger_entries
+        WHERE settled_at IS NOT NULL GROUP BY user_id
+    ) s ON s.user_id = u.id
+    WHERE COALESCE(u.balance, 0) <> COALESCE(s.total, 0)
+'''
+
+
+def init_db(cursor):
+    """Создает журнал и переносит в него текущие балансы пользователей"""
+    cursor.execute(TABLE_SQL)
+    cursor.execute(UNSETTLED_INDEX_SQL)
+    cursor.execute(REFERENCE_INDEX_SQL)
+    cursor.execute(OPENING_SQL)
+
+
+def post(cursor, user_id, amount, kind, reference_id=None):
+    """Добавляет запись в транзакции вызывающего; id записи или None, если
+    запись с таким kind и reference_id уже есть"""
+    cursor.execute(POST_SQL, (user_id, amount, kind, reference_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def charge_session(cursor, user_id, session_id, cost):
+    """Списывает стоимость сессии (см. TariffEngine.finish)"""
+    if cost:
+        post(cursor, user_id, -cost, SESSION, session_id)
+
+
+def balance(cursor, user_id):
+    """Текущий баланс пользователя (float) или None, если пользователя нет"""
+    cursor.execute(BALANCE_SQL, (user_id,))
+    row = cursor.fetchone()
+    return float(row[0]) if row else None
+
+
+class LedgerSettlement:
+    """Периодический перенос записей журнала в users.balance.
+
+    Запросы только добавляют записи и не спорят за строку пользователя;
+    строку меняет один этот поток, пачками по batch записей. on_settle
+    (cursor, user_ids) вызывается в транзакции расчета - например, чтобы
+    разослать уведомления об изменении баланса.
+    """
+
+    def __init__(self, db_pool, on_settle=None, interval=None, batch=5000):
+        self.db_pool = db_pool
+        self.on_settle = on_settle
+        self.interval = float(interval or os.getenv('LEDGER_SETTLE_INTERVAL', 5))
+        self.batch = batch
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.settled = 0
+        self.runs = 0
+        self.skipped = 0
+
+    def settle(self):
+        """Рассчитывает все накопленные записи; возвращает их число"""
+        total = 0
+        while True:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (SETTLEMENT_LOCK,))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    self.skipped += 1
+                    break
+                cur.execute(SETTLE_SQL, (self.batch,))
+                rows = cur.fetchall()
+                if rows and self.on_settle:
+                    self.on_settle(cur, [row[0] for row in rows])
+                conn.commit()
+            entries = sum(row[1] for row in rows)
+            total += entries
+            if entries < self.batch:
+                break
+        self.runs += 1
+        self.settled += total
+        return total
+
+    def verify(self):
+        """Пользователи, у которых баланс не сходится с журналом:
+        [{'user_id', 'balance', 'ledger'}]; пустой список - все верно"""
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(VERIFY_SQL)
+            rows = cur.fetchall()
+        return [
+            {'user_id': user_id, 'balance': float(settled), 'ledger': float(total)}
+            for user_id, settled, total in rows
+        ]
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.settle()
+            except Exception as e:
+                print(f"Ledger settlement failed: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval)
+        # Последний расчет, чтобы баланс не ждал следующего запуска
+        self.settle()
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'settled': self.settled,
+            'runs': self.runs,
+            'skipped': self.skipped,
+        }
@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+
+class LivenessTable:
+    """Таблица живости станций в памяти с отложенной записью last_connection.
+
+    Heartbeat только обновляет словарь; фоновый поток раз в flush_interval
+    пишет накопленные отметки одним UPDATE ... FROM (VALUES ...). Если самая
+    старая незаписанная отметка ждет дольше max_staleness, запись
+    запускается досрочно.
+    """
+
+    def __init__(self, db_pool, flush_interval=None, max_staleness=None, max_batch=5000):
+        self.db_pool = db_pool
+        self.flush_interval = float(flush_interval or os.getenv('HEARTBEAT_FLUSH_INTERVAL', 5))
+        self.max_staleness = float(max_staleness or os.getenv('HEARTBEAT_MAX_STALENESS', 15))
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._last_seen = {}  # {station_id: datetime} - для чтения
+        self._dirty = {}  # {station_id: datetime} - еще не записано в БД
+        self._oldest_dirty = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.heartbeats = 0
+
+    def record(self, station_id, seen_at=None):
+        seen_at = seen_at or datetime.now()
+        with self._lock:
+            self.heartbeats += 1
+            self._last_seen[station_id] = seen_at
+            self._dirty[station_id] = seen_at
+            if self._oldest_dirty is None:
+                self._oldest_dirty = time.monotonic()
+            overdue = (time.monotonic() - self._oldest_dirty >= self.max_staleness
+                       or len(self._dirty) >= self.max_batch)
+        if overdue:
+            self._wake.set()
+
+    def last_seen(self, station_id):
+        return self._last_seen.get(station_id)
+
+    def forget(self, station_id):
+        with self._lock:
+            self._last_seen.pop(station_id, None)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return 0
+            pending, self._dirty = self._dirty, {}
+            self._oldest_dirty = None
+
+        rows = list(pending.items())
+        try:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                for i in range(0, len(rows), self.max_batch):
+                    execute_values(
+                        cur,
+                        """UPDATE charging_stations AS cs
+                        SET last_connection = v.seen
+                        FROM (VALUES %s) AS v(id, seen)
+                        WHERE cs.id = v.id
+                          AND (cs.last_connection IS NULL OR cs.last_connection < v.seen)""",
+                        rows[i:i + self.max_batch],
+                        template='(%s::int, %s::timestamp)',
+                        page_size=self.max_batch,
+                    )
+                conn.commit()
+        except Exception as e:
+            print(f"Heartbeat flush failed: {e}")
+            # Возвращаем отметки обратно, не затирая более свежие
+            with self._lock:
+                for station_id, seen_at in pending.items():
+                    if self._dirty.get(station_id, seen_at) <= seen_at:
+                        self._dirty[station_id] = seen_at
+                if self._oldest_dirty is None:
+                    self._oldest_dirty = time.monotonic()
+            return 0
+
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        return len(rows)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._dirty)
+        return {
+            'heartbeats': self.heartbeats,
+            'pending': pending,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+        }
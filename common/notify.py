@@ -0,0 +1,64 @@
+import json
+import select
+import threading
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class NotifyListener:
+    """Фоновый поток LISTEN на отдельном autocommit-соединении.
+
+    handler(payload) вызывается для каждого уведомления канала,
+    on_connect() - после каждого (пере)подключения: пока слушателя не было,
+    уведомления могли потеряться.
+    """
+
+    def __init__(self, db_config, channel, handler, on_connect=None, name='Notify'):
+        self.db_config = db_config
+        self.channel = channel
+        self.handler = handler
+        self.on_connect = on_connect
+        self.name = name
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {self.channel}')
+                if self.on_connect:
+                    self.on_connect()
+
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        try:
+                            self.handler(payload)
+                        except Exception as e:
+                            print(f"{self.name} handler error: {e}")
+            except psycopg2.Error as e:
+                print(f"{self.name} listener error: {e}")
+                self._stopped.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def publish(cursor, channel, message):
+    """NOTIFY с JSON-сообщением; доставляется при коммите транзакции"""
+    cursor.execute('SELECT pg_notify(%s, %s)', (channel, json.dumps(message, default=str)))
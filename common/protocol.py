@@ -0,0 +1,251 @@
+import json
+import struct
+import threading
+
+# Кодеки сообщений в канале станция <-> сервер:
+#   json - подряд идущие JSON-объекты без разделителей (старые эмуляторы)
+#   lp   - 4 байта длины (big-endian) + JSON-тело
+CODEC_JSON = 'json'
+CODEC_LENGTH_PREFIXED = 'lp'
+
+# Кодеки в порядке предпочтения сервера
+SUPPORTED_CODECS = [CODEC_LENGTH_PREFIXED, CODEC_JSON]
+
+# Первые сообщения соединения, в которых согласуется кодек
+HANDSHAKE_ACTIONS = ('init', 'register_command')
+
+MAX_FRAME_SIZE = 1024 * 1024
+RECV_SIZE = 65536
+
+_LENGTH = struct.Struct('>I')
+
+
+class ProtocolError(Exception):
+    """Поток нельзя дальше разбирать, соединение нужно закрыть"""
+
+
+def encode(message, codec=CODEC_JSON):
+    body = json.dumps(message).encode('utf-8')
+    if codec == CODEC_LENGTH_PREFIXED:
+        return _LENGTH.pack(len(body)) + body
+    return body
+
+
+def _parse(frame):
+    try:
+        return json.loads(frame.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+
+
+class FrameDecoder:
+    """Потоковый декодер: принимает байты кусками, отдает все целые сообщения.
+
+    Битые JSON-сообщения возвращаются как None, чтобы вызывающий мог
+    ответить ошибкой и продолжить разбор потока.
+    """
+
+    def __init__(self, codec=CODEC_JSON, max_frame_size=MAX_FRAME_SIZE):
+        self.codec = codec
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._reset_scanner()
+
+    def _reset_scanner(self):
+        # Состояние сканера JSON сохраняется между вызовами feed,
+        # чтобы не пересматривать уже прочитанные байты
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def set_codec(self, codec):
+        self.codec = codec
+        self._reset_scanner()
+
+    def feed(self, data, limit=None):
+        """limit ограничивает число разобранных сообщений (остаток ждет в буфере)"""
+        self._buffer += data
+        if self.codec == CODEC_LENGTH_PREFIXED:
+            return self._decode_length_prefixed(limit)
+        return self._decode_json_stream(limit)
+
+    def _decode_length_prefixed(self, limit):
+        messages = []
+        offset = 0
+        buffer = self._buffer
+        while len(buffer) - offset >= _LENGTH.size and len(messages) != limit:
+            (length,) = _LENGTH.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f'Frame of {length} bytes exceeds limit')
+            end = offset + _LENGTH.size + length
+            if end > len(buffer):
+                break
+            messages.append(_parse(bytes(buffer[offset + _LENGTH.size:end])))
+            offset = end
+        del buffer[:offset]
+        return messages
+
+    def _decode_json_stream(self, limit):
+        messages = []
+        buffer = self._buffer
+        consumed = 0
+        pos = self._pos
+        while pos < len(buffer) and len(messages) != limit:
+            byte = buffer[pos]
+            if self._start is None:
+                if byte == 0x7B:  # {
+                    self._start = pos
+                    self._depth = 1
+                elif byte not in b' \t\r\n':
+                    # Мусор между объектами - отбрасываем до следующей '{'
+                    messages.append(None)
+                    while pos + 1 < len(buffer) and buffer[pos + 1] != 0x7B:
+                        pos += 1
+                    consumed = pos + 1
+                else:
+                    consumed = pos + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif byte == 0x5C:  # \
+                    self._escape = True
+                elif byte == 0x22:  # "
+                    self._in_string = False
+            elif byte == 0x22:
+                self._in_string = True
+            elif byte == 0x7B:
+                self._depth += 1
+            elif byte == 0x7D:  # }
+                self._depth -= 1
+                if self._depth == 0:
+                    messages.append(_parse(bytes(buffer[self._start:pos + 1])))
+                    self._start = None
+                    consumed = pos + 1
+            pos += 1
+
+        del buffer[:consumed]
+        self._pos = pos - consumed
+        if self._start is not None:
+            self._start -= consumed
+        if len(buffer) > self.max_frame_size:
+            raise ProtocolError('Unterminated message exceeds frame limit')
+        return messages
+
+
+class ChannelState:
+    """Кодек, декодер и очередь разобранных сообщений канала без ввода-вывода.
+
+    Общая часть MessageChannel и асинхронных каналов: подкласс только
+    читает и пишет байты, кадрирование и согласование кодека - здесь.
+    """
+
+    def __init__(self, codec=CODEC_JSON, max_frame_size=MAX_FRAME_SIZE):
+        self.codec = codec
+        self.decoder = FrameDecoder(codec, max_frame_size)
+        self._pending = []
+
+    def set_codec(self, codec):
+        self.codec = codec
+        self.decoder.set_codec(codec)
+
+    def encode(self, message):
+        return encode(message, self.codec)
+
+    def take_pending(self):
+        """Сообщения, разобранные раньше и еще не отданные, или пустой список"""
+        batch, self._pending = self._pending, []
+        return batch
+
+    def next_message(self, batch):
+        """Первое сообщение пачки; остальные ждут следующего receive"""
+        self._pending = batch
+        return self._pending.pop(0)
+
+    def offer_codecs(self, message):
+        """Сторона станции: в рукопожатии предлагаем серверу свои кодеки"""
+        if message.get('action') in HANDSHAKE_ACTIONS:
+            return {**message, 'codecs': SUPPORTED_CODECS}, True
+        return message, False
+
+    def accept_codec(self, response):
+        """Ответ на рукопожатие: переключаем кодек, кадры после ответа
+        разбираются уже в новом"""
+        if response and response.get('codec') in SUPPORTED_CODECS:
+            self.set_codec(response['codec'])
+            self._pending += self.decoder.feed(b'')
+        return response
+
+
+class MessageChannel(ChannelState):
+    """Сокет с поддержкой кадрирования: отправка и пакетный прием сообщений"""
+
+    def __init__(self, sock, codec=CODEC_JSON, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(codec, max_frame_size)
+        self.sock = sock
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        data = self.encode(message)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def receive_batch(self, limit=None):
+        """Возвращает все сообщения, пришедшие за одно чтение, или None при закрытии"""
+        batch = self.take_pending()
+        if batch:
+            return batch
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            batch = self.decoder.feed(data, limit)
+            if batch:
+                return batch
+
+    def receive(self, limit=None):
+        """Возвращает одно сообщение (остальные из пачки остаются в очереди)"""
+        batch = self.receive_batch(limit)
+        if batch is None:
+            raise ConnectionError('Connection closed by peer')
+        return self.next_message(batch)
+
+    def request(self, message):
+        """Сторона станции: отправляет запрос и ждет ответ.
+
+        В рукопожатии предлагает серверу свои кодеки; старый сервер поле
+        codecs проигнорирует, и канал останется в режиме json.
+        """
+        message, handshake = self.offer_codecs(message)
+        self.send(message)
+        if not handshake:
+            return self.receive()
+        # Ответ на рукопожатие разбираем отдельно: следом могут идти
+        # кадры уже в новом кодеке
+        return self.accept_codec(self.receive(limit=1))
+
+    def reply(self, request, response):
+        """Сторона сервера: отправляет ответ и при успешном рукопожатии переключает кодек"""
+        codec = handshake_codec(request, response)
+        if codec:
+            response = {**response, 'codec': codec}
+        self.send(response)
+        if codec:
+            self.set_codec(codec)
+
+
+def negotiate_codec(request):
+    """Выбирает кодек по списку codecs из init/register_command; None - оставить json"""
+    offered = request.get('codecs') or []
+    for codec in SUPPORTED_CODECS:
+        if codec in offered:
+            return codec
+    return None
+
+
+def handshake_codec(request, response):
+    """Кодек, на который сервер переключается после ответа, или None"""
+    if request.get('action') in HANDSHAKE_ACTIONS and response.get('status') == 'success':
+        return negotiate_codec(request)
+    return None
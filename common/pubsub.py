@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import deque
+
+
+class Subscription:
+    """Ограниченная очередь событий одного подписчика.
+
+    При переполнении отбрасывается самое старое событие: для телеметрии
+    важнее последнее значение. Подписчик, отставший больше чем на
+    max_drops событий подряд, отключается.
+    """
+
+    def __init__(self, topic, maxsize, max_drops):
+        self.topic = topic
+        self.maxsize = maxsize
+        self.max_drops = max_drops
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._lagging = 0  # отброшено с момента последнего чтения
+        self.dropped = 0
+        self.closed = False
+        self.evicted = False
+
+    def put(self, event):
+        """False - подписчик слишком медленный и отключен"""
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+                self._lagging += 1
+                if self._lagging > self.max_drops:
+                    self.closed = self.evicted = True
+                    self._queue.clear()
+                    self._cond.notify_all()
+                    return False
+            self._queue.append(event)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Следующее событие; None - таймаут или подписка закрыта (см. closed)"""
+        with self._cond:
+            if not self._queue and not self.closed:
+                self._cond.wait(timeout)
+            self._lagging = 0
+            if self._queue:
+                return self._queue.popleft()
+            return None
+
+    def close(self, event=None):
+        """Закрывает подписку; последнее событие доставляется, даже если очередь полна"""
+        with self._cond:
+            if self.closed:
+                return
+            if event is not None:
+                if len(self._queue) >= self.maxsize:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append(event)
+            self.closed = True
+            self._cond.notify_all()
+
+
+class TelemetryHub:
+    """Рассылка событий подписчикам по темам (например, по id сессии).
+
+    publish не блокируется: события раскладываются по очередям
+    подписчиков, а читают их потоки HTTP-стримов.
+    """
+
+    def __init__(self, queue_size=None, max_drops=None):
+        self.queue_size = int(queue_size or os.getenv('STREAM_QUEUE_SIZE', 64))
+        self.max_drops = int(max_drops or os.getenv('STREAM_MAX_DROPS', 256))
+        self._lock = threading.Lock()
+        self._topics = {}  # {topic: set(Subscription)}
+
+        self.published = 0
+        self.delivered = 0
+        self.evictions = 0
+
+    def subscribe(self, topic):
+        subscription = Subscription(topic, self.queue_size, self.max_drops)
+        with self._lock:
+            self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            subscribers = self._topics.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[subscription.topic]
+
+    def has_subscribers(self, topic):
+        return topic in self._topics
+
+    def publish(self, topic, event):
+        """Возвращает число подписчиков, получивших событие"""
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+        self.published += 1
+        delivered = 0
+        for subscription in subscribers:
+            if subscription.put(event):
+                delivered += 1
+            elif subscription.evicted:
+                self.evictions += 1
+                self.unsubscribe(subscription)
+        self.delivered += delivered
+        return delivered
+
+    def close_topic(self, topic, event=None):
+        """Отправляет последнее событие и закрывает все подписки темы"""
+        with self._lock:
+            subscribers = self._topics.pop(topic, set())
+        for subscription in subscribers:
+            subscription.close(event)
+        return len(subscribers)
+
+    def stats(self):
+        with self._lock:
+            topics = len(self._topics)
+            subscribers = sum(len(s) for s in self._topics.values())
+        return {
+            'topics': topics,
+            'subscribers': subscribers,
+            'published': self.published,
+            'delivered': self.delivered,
+            'evictions': self.evictions,
+        }
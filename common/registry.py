@@ -0,0 +1,174 @@
+import math
+import os
+import threading
+import time
+
+DATA = 'data'
+COMMAND = 'command'
+
+
+class ConnectionRegistry:
+    """Реестр соединений станций: основное и командное соединение каждой станции.
+
+    Прямая ({station_id: channel}) и обратная ({channel: (station_id, вид)})
+    карты меняются вместе под одной блокировкой, поэтому при отключении
+    станция находится за O(1) без перебора.
+
+    Живость отслеживается колесом таймеров: станция лежит в ячейке тика,
+    на котором истечет ее таймаут, и каждый heartbeat переносит ее в новую
+    ячейку. Раз в tick секунд проверяется только текущая ячейка, а не вся
+    таблица; просроченные станции отключаются через on_evict.
+    """
+
+    def __init__(self, timeout=None, tick=None, on_evict=None):
+        self.timeout = float(timeout or os.getenv('STATION_TIMEOUT', 90))
+        self.tick = float(tick or os.getenv('LIVENESS_TICK', 1))
+        self.on_evict = on_evict
+
+        self._lock = threading.Lock()
+        self._channels = {DATA: {}, COMMAND: {}}  # {вид: {station_id: channel}}
+        self._owners = {}  # {channel: (station_id, вид)}
+
+        self._wheel_lock = threading.Lock()
+        self._wheel = [set() for _ in range(int(math.ceil(self.timeout / self.tick)) + 1)]
+        self._expiry = {}  # {station_id: номер тика истечения}
+        self._swept_tick = self._tick_number(time.monotonic())
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.evictions = 0
+
+    def register(self, station_id, channel, kind=DATA):
+        """Привязывает соединение к станции; прежнее соединение того же вида возвращается"""
+        with self._lock:
+            previous = self._channels[kind].get(station_id)
+            if previous is not None and previous is not channel:
+                self._owners.pop(previous, None)
+            self._channels[kind][station_id] = channel
+            self._owners[channel] = (station_id, kind)
+        self.touch(station_id)
+        return previous if previous is not channel else None
+
+    def unregister(self, channel):
+        """Отвязывает закрытое соединение; (station_id, вид) или None, если оно не зарегистрировано"""
+        with self._lock:
+            owner = self._owners.pop(channel, None)
+            if owner is None:
+                return None
+            station_id, kind = owner
+            if self._channels[kind].get(station_id) is channel:
+                del self._channels[kind][station_id]
+            connected = any(station_id in channels for channels in self._channels.values())
+        if not connected:
+            self._forget(station_id)
+        return owner
+
+    def owner(self, channel):
+        return self._owners.get(channel)
+
+    def get(self, station_id, kind=DATA):
+        return self._channels[kind].get(station_id)
+
+    def is_connected(self, station_id):
+        return station_id in self._channels[DATA]
+
+    def stations(self):
+        with self._lock:
+            return list(self._channels[DATA])
+
+    def __contains__(self, station_id):
+        return self.is_connected(station_id)
+
+    def __len__(self):
+        return len(self._channels[DATA])
+
+    def _tick_number(self, moment):
+        return int(moment / self.tick)
+
+    def touch(self, station_id):
+        """Станция подала признак жизни - переносим ее срок в новую ячейку колеса"""
+        expiry = self._tick_number(time.monotonic() + self.timeout)
+        with self._wheel_lock:
+            previous = self._expiry.get(station_id)
+            if previous == expiry:
+                return
+            if previous is not None:
+                self._wheel[previous % len(self._wheel)].discard(station_id)
+            self._expiry[station_id] = expiry
+            self._wheel[expiry % len(self._wheel)].add(station_id)
+
+    def _forget(self, station_id):
+        with self._wheel_lock:
+            expiry = self._expiry.pop(station_id, None)
+            if expiry is not None:
+                self._wheel[expiry % len(self._wheel)].discard(station_id)
+
+    def sweep(self):
+        """Проверяет ячейки, чей тик наступил; возвращает отключенные станции"""
+        now_tick = self._tick_number(time.monotonic())
+        expired = []
+        with self._wheel_lock:
+            # После долгой паузы достаточно одного оборота колеса
+            first = max(self._swept_tick + 1, now_tick - len(self._wheel) + 1)
+            for tick in range(first, now_tick + 1):
+                slot = self._wheel[tick % len(self._wheel)]
+                for station_id in [sid for sid in slot if self._expiry[sid] <= tick]:
+                    slot.discard(station_id)
+                    del self._expiry[station_id]
+                    expired.append(station_id)
+            self._swept_tick = now_tick
+
+        for station_id in expired:
+            self._evict(station_id)
+        return expired
+
+    def _evict(self, station_id):
+        self.evictions += 1
+        print(f"Station {station_id} missed heartbeats for {self.timeout:.0f}s, disconnecting")
+        self.disconnect(station_id)
+
+    def disconnect(self, station_id):
+        """Отключает станцию: соединения отвязываются и закрываются"""
+        self._forget(station_id)
+        with self._lock:
+            channels = [
+                by_kind.pop(station_id) for by_kind in self._channels.values()
+                if station_id in by_kind
+            ]
+            for channel in channels:
+                self._owners.pop(channel, None)
+        if self.on_evict:
+            try:
+                self.on_evict(station_id, channels)
+            except Exception as e:
+                print(f"Eviction handler error for station {station_id}: {e}")
+        for channel in channels:
+            try:
+                channel.close()
+            except Exception:
+                pass
+        return channels
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            self.sweep()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            data = len(self._channels[DATA])
+            command = len(self._channels[COMMAND])
+        with self._wheel_lock:
+            tracked = len(self._expiry)
+        return {
+            'connected': data,
+            'command_channels': command,
+            'tracked': tracked,
+            'evictions': self.evictions,
+        }
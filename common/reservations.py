@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+
+# Итог попытки бронирования
+RESERVED = 'reserved'
+NOT_FOUND = 'not_found'
+CONFLICT = 'conflict'
+FORBIDDEN = 'forbidden'
+NOT_RESERVED = 'not_reserved'
+CANCELLED = 'cancelled'
+
+# Бронь берется одним UPDATE: условие WHERE проверяется заново после
+# ожидания блокировки строки, поэтому из двух одновременных запросов
+# успешен только один. Своя бронь продлевается, просроченная чужая
+# перехватывается, не дожидаясь уборки.
+RESERVE_SQL = '''
+    UPDATE charging_stations
+    SET status = 'reserved', reserved_by = %(user_id)s,
+        reserved_until = LOCALTIMESTAMP + %(ttl)s * interval '1 second'
+    WHERE id = %(station_id)s
+      AND (status = 'free'
+           OR (status = 'reserved' AND (reserved_by = %(user_id)s OR reserved_until <= LOCALTIMESTAMP)))
+    RETURNING reserved_until
+'''
+
+CANCEL_SQL = '''
+    UPDATE charging_stations
+    SET status = 'free', reserved_by = NULL, reserved_until = NULL
+    WHERE id = %s AND status = 'reserved' AND reserved_by = %s
+'''
+
+# SKIP LOCKED: строки, которые сейчас бронируют или запускают, остаются
+# до следующего прохода, и уборка никого не ждет
+EXPIRE_SQL = '''
+    WITH expired AS (
+        SELECT id FROM charging_stations
+        WHERE status = 'reserved' AND reserved_until <= LOCALTIMESTAMP
+        ORDER BY reserved_until
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE charging_stations AS cs
+    SET status = 'free', reserved_by = NULL, reserved_until = NULL
+    FROM expired
+    WHERE cs.id = expired.id
+    RETURNING cs.id
+'''
+
+
+class ReservationEngine:
+    """Бронирование станций с истечением срока.
+
+    reserve() и cancel() - один UPDATE с условием (compare-and-set), без
+    предварительного SELECT ... FOR UPDATE; лишний запрос делается только
+    при отказе, чтобы назвать причину. Просроченные брони снимает фоновый
+    поток пачками: он спит до ближайшего reserved_until, но не дольше
+    sweep_interval. Изменения статуса рассылаются через кэш состояния.
+    """
+
+    def __init__(self, db_pool, station_cache, ttl=None, sweep_interval=None, batch=500):
+        self.db_pool = db_pool
+        self.station_cache = station_cache
+        self.ttl = float(ttl or os.getenv('RESERVATION_TTL', 900))
+        self.sweep_interval = float(sweep_interval or os.getenv('RESERVATION_SWEEP_INTERVAL', 30))
+        self.batch = batch
+
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._next_expiry = None  # time.monotonic() ближайшего истечения, известного процессу
+        self._thread = None
+
+        self.reserved = 0
+        self.conflicts = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.sweeps = 0
+
+    def init_db(self, cursor):
+        cursor.execute('''
+            ALTER TABLE charging_stations ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMP
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS charging_stations_reserved_until_idx
+            ON charging_stations (reserved_until) WHERE status = 'reserved'
+        ''')
+
+    def _current(self, cursor, station_id):
+        cursor.execute(
+            'SELECT status, reserved_by, reserved_until FROM charging_stations WHERE id = %s',
+            (station_id,)
+        )
+        return cursor.fetchone()
+
+    def reserve(self, station_id, user_id, ttl=None):
+        """Бронирует станцию; {'result': RESERVED | NOT_FOUND | CONFLICT, ...}"""
+        ttl = float(ttl or self.ttl)
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(RESERVE_SQL, {'station_id': station_id, 'user_id': user_id, 'ttl': ttl})
+            row = cur.fetchone()
+            if row is None:
+                current = self._current(cur, station_id)
+                conn.rollback()
+                if current is None:
+                    return {'result': NOT_FOUND}
+                self.conflicts += 1
+                return {'result': CONFLICT, 'status': current[0], 'reserved_by': current[1],
+                        'reserved_until': current[2]}
+            reserved_until = row[0]
+            self.station_cache.notify(cur, station_id, status='reserved', reserved_by=user_id,
+                                      reserved_until=reserved_until)
+            conn.commit()
+
+        self.reserved += 1
+        self.station_cache.apply(station_id, status='reserved', reserved_by=user_id)
+        self._schedule(ttl)
+        return {'result': RESERVED, 'status': 'reserved', 'reserved_by': user_id,
+                'reserved_until': reserved_until}
+
+    def cancel(self, station_id, user_id):
+        """Снимает свою бронь; {'result': CANCELLED | NOT_RESERVED | FORBIDDEN}"""
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CANCEL_SQL, (station_id, user_id))
+            if not cur.rowcount:
+                current = self._current(cur, station_id)
+                conn.rollback()
+                if current is None or current[0] != 'reserved':
+                    return {'result': NOT_RESERVED}
+                return {'result': FORBIDDEN}
+            self.station_cache.notify(cur, station_id, status='free', reserved_by=None)
+            conn.commit()
+
+        self.cancelled += 1
+        self.station_cache.apply(station_id, status='free', reserved_by=None)
+        return {'result': CANCELLED, 'status': 'free'}
+
+    def _schedule(self, delay):
+        """Будит уборку раньше, если новая бронь истекает до запланированного прохода"""
+        expires_at = time.monotonic() + delay
+        if self._next_expiry is None or expires_at < self._next_expiry:
+            self._next_expiry = expires_at
+            self._wake.set()
+
+    def sweep(self):
+        """Снимает все просроченные брони пачками по batch; возвращает их число"""
+        total = 0
+        while True:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(EXPIRE_SQL, (self.batch,))
+                ids = [row[0] for row in cur.fetchall()]
+                if ids:
+                    self.station_cache.notify_many(cur, ids, status='free', reserved_by=None)
+                conn.commit()
+            for station_id in ids:
+                self.station_cache.apply(station_id, status='free', reserved_by=None)
+            total += len(ids)
+            if len(ids) < self.batch:
+                break
+        self.sweeps += 1
+        self.expired += total
+        return total
+
+    def _seconds_to_next_expiry(self):
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                SELECT EXTRACT(EPOCH FROM min(reserved_until) - LOCALTIMESTAMP)
+                FROM charging_stations WHERE status = 'reserved'
+            ''')
+            row = cur.fetchone()
+        return float(row[0]) if row and row[0] is not None else None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # Сбрасываем до прохода: бронь, пришедшая во время него, разбудит снова
+            self._wake.clear()
+            try:
+                expired = self.sweep()
+                if expired:
+                    print(f"Released {expired} expired reservations")
+                delay = self._seconds_to_next_expiry()
+            except Exception as e:
+                print(f"Reservation sweep failed: {e}")
+                delay = None
+            delay = self.sweep_interval if delay is None else min(max(delay, 0.1), self.sweep_interval)
+            self._next_expiry = time.monotonic() + delay
+            self._wake.wait(delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'reserved': self.reserved,
+            'conflicts': self.conflicts,
+            'cancelled': self.cancelled,
+            'expired': self.expired,
+            'sweeps': self.sweeps,
+        }
@@ -0,0 +1,257 @@
+import json
+import math
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.commands import NOT_CONNECTED, TIMEOUT, PendingCommand
+from common.hashring import HashRing, gateway_list
+from common.notify import NotifyListener, publish
+
+BUS_CHANNEL = 'gateway_bus'
+
+
+class CommandBus:
+    """Доставка команд станциям, подключенным к другим шлюзам.
+
+    Владелец станции - шлюз, принявший ее командное соединение; он
+    записывается в station_owners и рассылается остальным через NOTIFY,
+    поэтому переподключение к другому шлюзу переносит владение. Если
+    владелец не записан, команда идет на шлюз станции по кольцу.
+    Команда и ответ передаются сообщениями NOTIFY в канале BUS_CHANNEL.
+
+    Шлюз раз в owner_ttl / 3 секунд продлевает свои записи в station_owners;
+    записи, не продленные owner_ttl секунд (шлюз упал), не считаются.
+    Без GATEWAY_ID идентификатор шлюза - хост, порт станций и pid, поэтому
+    два процесса на одном хосте не принимают команды друг друга за свои.
+    """
+
+    def __init__(self, db_pool, dispatcher, gateway_id=None, gateways=None, on_ownership_lost=None,
+                 port=None, owner_ttl=None):
+        self.db_pool = db_pool
+        self.dispatcher = dispatcher
+        self.gateway_id = (gateway_id or os.getenv('GATEWAY_ID')
+                           or f'{socket.gethostname()}:{port or 9090}:{os.getpid()}')
+        nodes = gateway_list(gateways)
+        if nodes and self.gateway_id not in nodes:
+            raise ValueError(f'GATEWAY_ID {self.gateway_id} must be one of GATEWAYS')
+        self.ring = HashRing(nodes or [self.gateway_id])
+        self.on_ownership_lost = on_ownership_lost
+        self.owner_ttl = float(owner_ttl or os.getenv('GATEWAY_OWNER_TTL', 30))
+        self.heartbeat_interval = self.owner_ttl / 3
+
+        self._lock = threading.Lock()
+        # Кэш station_owners: чужие записи живут до следующего продления
+        self._owners = {}  # {station_id: (gateway_id, expires_at)}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._waiting = {}  # {command_id: (PendingCommand, шлюз-владелец)} пересланных команд
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='bus')
+        self._listener = NotifyListener(
+            db_pool.db_config, BUS_CHANNEL, self._on_message,
+            on_connect=self._reset_owners, name='Gateway bus',
+        )
+
+        self.forwarded = 0
+        self.served = 0
+
+    def init_db(self):
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS station_owners (
+                    station_id INTEGER PRIMARY KEY,
+                    gateway_id VARCHAR(255) NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+            ''')
+            # Записи этого шлюза до перезапуска и шлюзов, переставших их продлевать
+            cur.execute('''
+                DELETE FROM station_owners
+                WHERE gateway_id = %s OR updated_at < now() - make_interval(secs => %s)
+            ''', (self.gateway_id, self.owner_ttl))
+            conn.commit()
+
+    def _reset_owners(self):
+        with self._lock:
+            self._owners.clear()
+
+    def _publish(self, message):
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            publish(cur, BUS_CHANNEL, message)
+            conn.commit()
+
+    def _cache_owner(self, station_id, gateway):
+        # Свои записи кэш знает точно, чужие перечитываются после продления
+        expires_at = math.inf if gateway == self.gateway_id else time.monotonic() + self.heartbeat_interval
+        self._owners[station_id] = (gateway, expires_at)
+
+    def claim(self, station_id):
+        """Станция подключилась к этому шлюзу - забираем владение"""
+        with self._lock:
+            self._cache_owner(station_id, self.gateway_id)
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO station_owners (station_id, gateway_id, updated_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (station_id) DO UPDATE
+                SET gateway_id = EXCLUDED.gateway_id, updated_at = EXCLUDED.updated_at
+            ''', (station_id, self.gateway_id))
+            publish(cur, BUS_CHANNEL, {'type': 'owner', 'station_id': station_id, 'gateway': self.gateway_id})
+            conn.commit()
+
+    def release(self, station_id):
+        """Командное соединение закрыто; запись удаляется, только если владелец все еще мы"""
+        with self._lock:
+            if self._owners.get(station_id, (None,))[0] == self.gateway_id:
+                del self._owners[station_id]
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'DELETE FROM station_owners WHERE station_id = %s AND gateway_id = %s',
+                (station_id, self.gateway_id)
+            )
+            if cur.rowcount:
+                publish(cur, BUS_CHANNEL, {'type': 'owner', 'station_id': station_id, 'gateway': None})
+            conn.commit()
+
+    def owner(self, station_id):
+        with self._lock:
+            cached = self._owners.get(station_id)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                SELECT gateway_id FROM station_owners
+                WHERE station_id = %s AND updated_at >= now() - make_interval(secs => %s)
+            ''', (station_id, self.owner_ttl))
+            row = cur.fetchone()
+        owner = row[0] if row else None
+        with self._lock:
+            if self._owners.get(station_id) is cached:
+                self._cache_owner(station_id, owner)
+        return owner
+
+    def heartbeat(self):
+        """Продлевает записи владения этого шлюза"""
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('UPDATE station_owners SET updated_at = now() WHERE gateway_id = %s', (self.gateway_id,))
+            conn.commit()
+
+    def is_connected(self, station_id):
+        if self.dispatcher.is_connected(station_id):
+            return True
+        owner = self.owner(station_id)
+        return owner is not None and owner != self.gateway_id
+
+    def connected_stations(self):
+        """Станции с командным соединением на любом шлюзе (по station_owners)"""
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                SELECT station_id FROM station_owners
+                WHERE updated_at >= now() - make_interval(secs => %s)
+            ''', (self.owner_ttl,))
+            owned = {row[0] for row in cur.fetchall()}
+        return sorted(owned | set(self.dispatcher.connected_stations()))
+
+    def dispatch(self, station_id, command, ttl=None):
+        """Как CommandDispatcher.dispatch, но для станции на любом шлюзе.
+
+        Станции этого шлюза команда ставится в очередь диспетчера, чужой -
+        пересылается владельцу; итог его ответа получает возвращенная
+        PendingCommand. Доставки не ждет.
+        """
+        if self.dispatcher.is_connected(station_id):
+            return self.dispatcher.dispatch(station_id, command, ttl)
+
+        ttl = self.dispatcher.ttl if ttl is None else ttl
+        pending = PendingCommand(station_id, command, ttl)
+        target = self.owner(station_id) or self.ring.node_for(station_id)
+        if target is None or target == self.gateway_id:
+            pending.resolve(NOT_CONNECTED, 'Station is not connected')
+            return pending
+
+        with self._lock:
+            self._waiting[pending.id] = (pending, target)
+        try:
+            self._publish({
+                'type': 'command', 'id': pending.id, 'to': target, 'from': self.gateway_id,
+                'station_id': station_id, 'command': command, 'timeout': ttl,
+            })
+        except Exception:
+            with self._lock:
+                self._waiting.pop(pending.id, None)
+            raise
+        self.forwarded += 1
+        return pending
+
+    def expire(self, pending):
+        """Как CommandDispatcher.expire; пересланная команда без ответа получает TIMEOUT"""
+        with self._lock:
+            forwarded = self._waiting.pop(pending.id, None)
+        if forwarded is None:
+            return self.dispatcher.expire(pending)
+        pending.resolve(TIMEOUT, f'No reply from gateway {forwarded[1]}')
+        return True
+
+    def send(self, station_id, command, timeout=None):
+        """Как CommandDispatcher.send, но для станции на любом шлюзе"""
+        timeout = timeout if timeout is not None else self.dispatcher.ttl
+        local = self.dispatcher.is_connected(station_id)
+        pending = self.dispatch(station_id, command, ttl=timeout)
+        # Шлюз-владелец сам ждет до timeout - даем запас на доставку ответа
+        if pending.wait(timeout if local else timeout + 1.0) is None:
+            self.expire(pending)
+        return pending.result
+
+    def _on_message(self, payload):
+        message = json.loads(payload)
+        kind = message.get('type')
+        if kind == 'owner':
+            station_id, gateway = message['station_id'], message['gateway']
+            with self._lock:
+                self._cache_owner(station_id, gateway)
+            # Станция переподключилась к другому шлюзу - старое соединение больше не нужно
+            if gateway not in (None, self.gateway_id) and self.dispatcher.is_connected(station_id):
+                if self.on_ownership_lost:
+                    self.on_ownership_lost(station_id)
+        elif kind == 'command' and message.get('to') == self.gateway_id:
+            self._executor.submit(self._serve, message)
+        elif kind == 'result' and message.get('to') == self.gateway_id:
+            with self._lock:
+                forwarded = self._waiting.pop(message['id'], None)
+            if forwarded is not None:
+                forwarded[0].resolve(message['result']['status'], message['result']['message'])
+
+    def _serve(self, message):
+        result = self.dispatcher.send(message['station_id'], message['command'], message.get('timeout'))
+        self.served += 1
+        try:
+            self._publish({'type': 'result', 'id': message['id'], 'to': message['from'], 'result': result})
+        except Exception as e:
+            print(f"Gateway bus reply failed: {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"Gateway bus heartbeat failed: {e}")
+
+    def start(self):
+        self._listener.start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._listener.stop()
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'gateway_id': self.gateway_id,
+            'gateways': self.ring.nodes(),
+            'forwarded': self.forwarded,
+            'served': self.served,
+        }
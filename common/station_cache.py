@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from common.notify import NotifyListener, publish
+
+NOTIFY_CHANNEL = 'station_state'
+STATE_FIELDS = ('status', 'reserved_by', 'using_by', 'power', 'last_connection', 'tariff_id')
+# Число id в одном уведомлении: payload NOTIFY ограничен 8000 байт
+NOTIFY_BATCH = 500
+
+
+class StationStateCache:
+    """Кэш состояния станций в памяти процесса.
+
+    Процесс, меняющий состояние станции, вызывает notify() в своей
+    транзакции и apply() после коммита. Остальные процессы получают
+    изменение через LISTEN/NOTIFY; если событие потерялось, запись
+    перечитывается из БД по истечении ttl.
+    """
+
+    def __init__(self, db_pool, ttl=None):
+        self.db_pool = db_pool
+        self.ttl = float(ttl or os.getenv('STATION_CACHE_TTL', 30))
+        self.origin = uuid.uuid4().hex  # свои уведомления не применяем повторно
+
+        self._lock = threading.Lock()
+        self._entries = {}  # {station_id: (state, expires_at)}
+        # Загрузки из БД в процессе: [число загрузок, было ли изменение за это время]
+        self._loads = {}  # {station_id: [loaders, changed]}
+        self._subscribers = []
+        # Пока слушателя не было, события могли потеряться - сбрасываем кэш
+        self._listener = NotifyListener(
+            db_pool.db_config, NOTIFY_CHANNEL, self._on_notify,
+            on_connect=self.invalidate, name='Station cache',
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.updates = 0
+        self.notifications = 0
+
+    def subscribe(self, callback):
+        """callback(station_id, fields) вызывается при каждом изменении состояния"""
+        self._subscribers.append(callback)
+
+    def get(self, station_id):
+        """Состояние станции (dict) или None, если станции нет"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(station_id)
+            if entry and entry[1] > now:
+                self.hits += 1
+                return dict(entry[0])
+            self.misses += 1
+            load = self._loads.setdefault(station_id, [0, False])
+            load[0] += 1
+
+        row = None
+        try:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT {', '.join(STATE_FIELDS)} FROM charging_stations WHERE id=%s",
+                    (station_id,)
+                )
+                row = cur.fetchone()
+        finally:
+            with self._lock:
+                load[0] -= 1
+                if not load[0]:
+                    del self._loads[station_id]
+                # apply() во время чтения мог принести более новые поля - прочитанная
+                # строка тогда устарела и в кэш не попадает
+                if row is not None and not load[1]:
+                    self._entries[station_id] = (dict(zip(STATE_FIELDS, row)), time.monotonic() + self.ttl)
+        if row is None:
+            return None
+        return dict(zip(STATE_FIELDS, row))
+
+    def _mark_changed(self, station_id=None):
+        # Вызывается под self._lock
+        for loaded_id, load in self._loads.items():
+            if station_id is None or loaded_id == station_id:
+                load[1] = True
+
+    def apply(self, station_id, **fields):
+        """Применяет изменение, выполненное этим процессом (после коммита)"""
+        fields = {key: value for key, value in fields.items() if key in STATE_FIELDS}
+        with self._lock:
+            entry = self._entries.get(station_id)
+            if entry:
+                entry[0].update(fields)
+                self._entries[station_id] = (entry[0], time.monotonic() + self.ttl)
+            self._mark_changed(station_id)
+            self.updates += 1
+        for callback in self._subscribers:
+            try:
+                callback(station_id, fields)
+            except Exception as e:
+                print(f"Station cache subscriber error: {e}")
+
+    def notify(self, cursor, station_id, **fields):
+        """Сообщает другим процессам об изменении; доставляется при коммите транзакции"""
+        publish(cursor, NOTIFY_CHANNEL, {'id': station_id, 'origin': self.origin, 'fields': fields})
+
+    def notify_many(self, cursor, station_ids, **fields):
+        """Одинаковое изменение множества станций - одно уведомление на NOTIFY_BATCH станций"""
+        station_ids = list(station_ids)
+        for i in range(0, len(station_ids), NOTIFY_BATCH):
+            publish(cursor, NOTIFY_CHANNEL, {
+                'ids': station_ids[i:i + NOTIFY_BATCH], 'origin': self.origin, 'fields': fields,
+            })
+
+    def invalidate(self, station_id=None):
+        with self._lock:
+            self._mark_changed(station_id)
+            if station_id is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            elif self._entries.pop(station_id, None) is not None:
+                self.invalidations += 1
+
+    def _on_notify(self, payload):
+        self.notifications += 1
+        try:
+            message = json.loads(payload)
+        except json.JSONDecodeError:
+            self.invalidate()
+            return
+        if message.get('origin') == self.origin:
+            return
+        for station_id in message.get('ids') or [message.get('id')]:
+            if message.get('fields'):
+                self.apply(station_id, **message['fields'])
+            else:
+                self.invalidate(station_id)
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'updates': self.updates,
+            'notifications': self.notifications,
+        }
@@ -0,0 +1,91 @@
+import math
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Перцентили по методу ближайшего ранга и максимум; для пустого списка - None"""
+    if not values:
+        result = {f'p{point}': None for point in points}
+        result['max'] = None
+        return result
+    ordered = sorted(values)
+    result = {
+        f'p{point}': ordered[max(0, math.ceil(point / 100 * len(ordered)) - 1)]
+        for point in points
+    }
+    result['max'] = ordered[-1]
+    return result
+
+
+class LatencyHistogram:
+    """Гистограмма задержек (мс) в логарифмических корзинах.
+
+    Память не зависит от числа замеров; перцентиль берется по верхней
+    границе корзины, относительная погрешность - не больше growth.
+    """
+
+    def __init__(self, min_ms=0.01, growth=0.02):
+        self.min_ms = min_ms
+        self._log_growth = math.log1p(growth)
+        self._counts = {}  # {номер корзины: число замеров}
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= self.min_ms:
+            return 0
+        return int(math.log(value / self.min_ms) / self._log_growth) + 1
+
+    def _upper(self, bucket):
+        return self.min_ms * math.exp(bucket * self._log_growth)
+
+    def record(self, value):
+        bucket = self._bucket(value)
+        self._counts[bucket] = self._counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other._counts.items():
+            self._counts[bucket] = self._counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentiles(self, points=(50, 90, 99)):
+        """Как percentiles(), но по корзинам"""
+        result = {f'p{point}': None for point in points}
+        result['max'] = round(self.max, 3) if self.max is not None else None
+        if not self.count:
+            return result
+        ordered = sorted(self._counts.items())
+        for point in points:
+            rank = max(1, math.ceil(point / 100 * self.count))
+            seen = 0
+            for bucket, count in ordered:
+                seen += count
+                if seen >= rank:
+                    result[f'p{point}'] = round(min(self._upper(bucket), self.max), 3)
+                    break
+        return result
+
+    def distribution(self, edges):
+        """Число замеров между соседними границами edges (мс); последний интервал открыт"""
+        counts = [0] * len(edges)
+        for bucket, count in self._counts.items():
+            upper = self._upper(bucket)
+            index = 0
+            while index + 1 < len(edges) and upper > edges[index + 1]:
+                index += 1
+            counts[index] += count
+        return counts
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            **self.percentiles(),
+        }
@@ -0,0 +1,342 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+from common.station_cache import NOTIFY_CHANNEL
+
+MINUTES_PER_DAY = 24 * 60
+# Время сессий - LOCALTIMESTAMP сервера БД; позиция счетчика - минуты
+# местного времени от этой точки, остаток от деления на сутки - минута дня
+LOCAL_EPOCH = datetime(1970, 1, 1)
+
+# Станции без тарифа оплачиваются по ENERGY_PRICE, ₽/кВт·ч
+DEFAULT_PRICE_PER_KWH = float(os.getenv('ENERGY_PRICE', 15))
+
+
+def local_minutes(moment=None):
+    """Минуты местного времени (float) для datetime без часового пояса"""
+    return ((moment or datetime.now()) - LOCAL_EPOCH).total_seconds() / 60
+
+
+def from_local_minutes(position):
+    return LOCAL_EPOCH + timedelta(minutes=position)
+
+
+class CompiledTariff:
+    """Тариф, развернутый в таблицы по минутам суток.
+
+    kwh[m] и per_minute[m] - цены в минуту дня m, prefix[m] - стоимость
+    поминутной оплаты от начала суток до минуты m. Цена кВт·ч - одно
+    обращение к таблице, стоимость времени за любой интервал - разность
+    двух накопленных сумм: O(1) независимо от длины интервала и числа
+    периодов тарифа.
+    """
+
+    __slots__ = ('id', 'kwh', 'per_minute', 'prefix', 'day_cost')
+
+    def __init__(self, tariff_id, kwh, per_minute):
+        self.id = tariff_id
+        self.kwh = kwh
+        self.per_minute = per_minute
+        self.prefix = [0.0]
+        for price in per_minute:
+            self.prefix.append(self.prefix[-1] + price)
+        self.day_cost = self.prefix[-1]
+
+    def kwh_price(self, position):
+        return self.kwh[int(position % MINUTES_PER_DAY)]
+
+    def _accrued(self, position):
+        # Поминутная оплата от LOCAL_EPOCH до position
+        days, minute = divmod(position, MINUTES_PER_DAY)
+        index = int(minute)
+        return days * self.day_cost + self.prefix[index] + (minute - index) * self.per_minute[index]
+
+    def time_cost(self, start, end):
+        if end <= start:
+            return 0.0
+        return self._accrued(end) - self._accrued(start)
+
+
+def compile_tariff(tariff_id, price_per_kwh, price_per_minute, periods=()):
+    """Строит таблицы тарифа; periods - (start_time, end_time, kwh, minute),
+    цены периода без значения (None) берутся из базовых. Период с end_time
+    раньше start_time переходит через полночь, с равными - на все сутки."""
+    kwh = [float(price_per_kwh or 0)] * MINUTES_PER_DAY
+    per_minute = [float(price_per_minute or 0)] * MINUTES_PER_DAY
+    for start_time, end_time, period_kwh, period_minute in periods:
+        start = start_time.hour * 60 + start_time.minute
+        end = end_time.hour * 60 + end_time.minute
+        length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        for offset in range(length):
+            minute = (start + offset) % MINUTES_PER_DAY
+            if period_kwh is not None:
+                kwh[minute] = float(period_kwh)
+            if period_minute is not None:
+                per_minute[minute] = float(period_minute)
+    return CompiledTariff(tariff_id, kwh, per_minute)
+
+
+class SessionMeter:
+    """Стоимость идущей сессии: каждое показание добавляет стоимость энергии
+    с прошлого показания и времени с прошлой позиции. Показания одной
+    сессии могут прийти в разных потоках - advance() под блокировкой счетчика"""
+
+    __slots__ = ('session_id', 'station_id', 'user_id', 'tariff', 'energy', 'position', 'cost', '_lock')
+
+    def __init__(self, session_id, station_id, user_id, tariff, position, energy=0.0, cost=0.0):
+        self.session_id = session_id
+        self.station_id = station_id
+        self.user_id = user_id
+        self.tariff = tariff
+        self.position = position
+        self.energy = float(energy or 0)
+        self.cost = float(cost or 0)
+        self._lock = threading.Lock()
+
+    def advance(self, energy, position):
+        with self._lock:
+            if position > self.position:
+                self.cost += self.tariff.time_cost(self.position, position)
+                self.position = position
+            # Энергия сессии растет; меньшее значение (сброс счетчика) не оплачивается
+            if energy is not None and energy > self.energy:
+                self.cost += (energy - self.energy) * self.tariff.kwh_price(position)
+                self.energy = energy
+            return self.cost
+
+    @property
+    def metered_at(self):
+        """Момент, по который посчитана стоимость (для sessions.metered_at)"""
+        return from_local_minutes(self.position)
+
+
+class TariffEngine:
+    """Тарификация сессий: кВт·ч, минуты и цены по времени суток.
+
+    Тарифы компилируются при первом обращении и кэшируются. Счетчик сессии
+    живет в процессе, который принимает update-кадры ее станции; текущая
+    стоимость пишется в sessions.cost вместе с энергией (EnergyIngestor),
+    поэтому сессию может завершить и другой процесс.
+
+    Словари движка общие для потоков шлюза и HTTP - они под self._lock,
+    запросы к БД выполняются без него. Смену тарифа станции триггер БД
+    рассылает в канал кэша состояния станций; on_state_change (подписчик
+    кэша) забывает тариф станции, новые сессии берут новый.
+    """
+
+    def __init__(self, db_pool, default_price=None):
+        self.db_pool = db_pool
+        self.default = compile_tariff(None, default_price or DEFAULT_PRICE_PER_KWH, 0)
+        self._lock = threading.Lock()
+        self._tariffs = {}  # {tariff_id: CompiledTariff}
+        self._stations = {}  # {station_id: tariff_id}
+        self._meters = {}  # {station_id: SessionMeter}
+        self._unknown = {}  # {station_id: session_id} - кадры закрытых или чужих сессий
+        # Растет при каждом сбросе: прочитанное из БД до сброса в кэш не попадает
+        self._generation = 0
+
+        self.updates = 0
+        self.restored = 0
+
+    def init_db(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tariffs (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100)
+            )
+        ''')
+        cursor.execute('''
+            ALTER TABLE tariffs
+            ADD COLUMN IF NOT EXISTS price_per_kwh DECIMAL(10, 2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS price_per_minute DECIMAL(10, 2) NOT NULL DEFAULT 0
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tariff_periods (
+                id SERIAL PRIMARY KEY,
+                tariff_id INTEGER REFERENCES tariffs(id) ON DELETE CASCADE NOT NULL,
+                start_time TIME NOT NULL,
+                end_time TIME NOT NULL,
+                price_per_kwh DECIMAL(10, 2),
+                price_per_minute DECIMAL(10, 2)
+            )
+        ''')
+        cursor.execute('''
+            ALTER TABLE sessions
+            ADD COLUMN IF NOT EXISTS cost FLOAT,
+            ADD COLUMN IF NOT EXISTS metered_at TIMESTAMP
+        ''')
+        # Смена тарифа станции - событие кэша состояния станций во всех процессах,
+        # в т.ч. при правке из консоли БД (origin 'db' ни одному процессу не свой)
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION charging_stations_notify_tariff() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify(%s, json_build_object(
+                    'id', NEW.id, 'origin', 'db', 'fields', json_build_object('tariff_id', NEW.tariff_id)
+                )::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        ''', (NOTIFY_CHANNEL,))
+        cursor.execute('DROP TRIGGER IF EXISTS charging_stations_tariff_trg ON charging_stations')
+        cursor.execute('''
+            CREATE TRIGGER charging_stations_tariff_trg
+            AFTER UPDATE OF tariff_id ON charging_stations
+            FOR EACH ROW WHEN (OLD.tariff_id IS DISTINCT FROM NEW.tariff_id)
+            EXECUTE FUNCTION charging_stations_notify_tariff()
+        ''')
+
+    def _load_tariff(self, cursor, tariff_id):
+        cursor.execute('SELECT price_per_kwh, price_per_minute FROM tariffs WHERE id = %s', (tariff_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return self.default
+        cursor.execute('''
+            SELECT start_time, end_time, price_per_kwh, price_per_minute
+            FROM tariff_periods WHERE tariff_id = %s ORDER BY id
+        ''', (tariff_id,))
+        return compile_tariff(tariff_id, row[0], row[1], cursor.fetchall())
+
+    def tariff_for_station(self, cursor, station_id):
+        with self._lock:
+            generation = self._generation
+            known = station_id in self._stations
+            tariff_id = self._stations.get(station_id)
+        if not known:
+            cursor.execute('SELECT tariff_id FROM charging_stations WHERE id = %s', (station_id,))
+            row = cursor.fetchone()
+            tariff_id = row[0] if row else None
+            with self._lock:
+                if self._generation == generation:
+                    self._stations[station_id] = tariff_id
+        if tariff_id is None:
+            return self.default
+        with self._lock:
+            tariff = self._tariffs.get(tariff_id)
+        if tariff is None:
+            tariff = self._load_tariff(cursor, tariff_id)
+            with self._lock:
+                if self._generation == generation:
+                    self._tariffs.setdefault(tariff_id, tariff)
+        return tariff
+
+    def reload(self):
+        """Сбрасывает скомпилированные тарифы; идущие сессии досчитываются по старым"""
+        with self._lock:
+            self._generation += 1
+            self._tariffs.clear()
+            self._stations.clear()
+
+    def forget_station(self, station_id):
+        """Тариф станции сменился: следующая сессия прочитает его заново"""
+        with self._lock:
+            self._generation += 1
+            self._stations.pop(station_id, None)
+
+    def on_state_change(self, station_id, fields):
+        """Подписчик кэша состояния станций"""
+        if 'tariff_id' in fields:
+            self.forget_station(station_id)
+
+    def begin(self, cursor, station_id, session_id, user_id, started_at):
+        """Счетчик сессии, открытой этим процессом"""
+        meter = SessionMeter(session_id, station_id, user_id,
+                             self.tariff_for_station(cursor, station_id), local_minutes(started_at))
+        with self._lock:
+            self._meters[station_id] = meter
+            self._unknown.pop(station_id, None)
+        return meter
+
+    def _restore(self, cursor, station_id, session_id=None, user_id=None):
+        """Счетчик открытой сессии по сохраненным стоимости и энергии"""
+        cursor.execute('''
+            SELECT id, user_id, start_time, energy_consumed, cost, metered_at FROM sessions
+            WHERE station_id = %s AND end_time IS NULL
+              AND (%s::int IS NULL OR id = %s) AND (%s::int IS NULL OR user_id = %s)
+            ORDER BY id DESC
+            LIMIT 1
+        ''', (station_id, session_id, session_id, user_id, user_id))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        session_id, user_id, started_at, energy, cost, metered_at = row
+        with self._lock:
+            self.restored += 1
+        if metered_at is None:
+            # Стоимость еще не сохранялась - считаем с начала сессии
+            energy, cost, metered_at = 0, 0, started_at
+        return SessionMeter(session_id, station_id, user_id, self.tariff_for_station(cursor, station_id),
+                            local_minutes(metered_at), energy, cost)
+
+    def update(self, station_id, session_id, energy):
+        """Учитывает показание update-кадра; счетчик сессии или None"""
+        with self._lock:
+            meter = self._meters.get(station_id)
+            # Открытой сессии нет - не ищем ее заново на каждом кадре
+            if (meter is None or meter.session_id != session_id) and self._unknown.get(station_id) == session_id:
+                return None
+        if meter is None or meter.session_id != session_id:
+            with self.db_pool.connection() as conn, conn.cursor() as cur:
+                restored = self._restore(cur, station_id, session_id=session_id)
+                conn.rollback()
+            with self._lock:
+                meter = self._meters.get(station_id)
+                if meter is None or meter.session_id != session_id:
+                    # Другой поток мог восстановить счетчик раньше - считаем по его
+                    meter = restored
+                    if meter is None:
+                        self._unknown[station_id] = session_id
+                        return None
+                    self._meters[station_id] = meter
+                self._unknown.pop(station_id, None)
+        meter.advance(float(energy or 0), local_minutes())
+        with self._lock:
+            self.updates += 1
+        return meter
+
+    def current(self, station_id, session_id):
+        """Текущая стоимость сессии, если ее считает этот процесс"""
+        with self._lock:
+            meter = self._meters.get(station_id)
+        if meter is None or meter.session_id != session_id:
+            return None
+        return round(meter.cost, 2)
+
+    def meter_for(self, cursor, station_id, user_id):
+        """Счетчик открытой сессии пользователя на станции перед ее завершением"""
+        with self._lock:
+            meter = self._meters.get(station_id)
+        if meter is not None and meter.user_id == user_id:
+            return meter
+        return self._restore(cursor, station_id, user_id=user_id)
+
+    def finish(self, cursor, station_id, meter, stopped):
+        """Итоговая стоимость завершенной сессии (stopped - итог stop_charging_session)"""
+        if meter is None or meter.session_id != stopped['session_id']:
+            meter = SessionMeter(stopped['session_id'], station_id, None,
+                                 self.tariff_for_station(cursor, station_id),
+                                 local_minutes(stopped['started_at']))
+        meter.advance(stopped['energy'], local_minutes(stopped['ended_at']))
+        cost = round(meter.cost, 2)
+        self.discard(station_id, meter.session_id)
+        cursor.execute(
+            'UPDATE sessions SET cost = %s, metered_at = %s WHERE id = %s',
+            (cost, stopped['ended_at'], stopped['session_id'])
+        )
+        return cost
+
+    def discard(self, station_id, session_id):
+        with self._lock:
+            meter = self._meters.get(station_id)
+            if meter is not None and meter.session_id == session_id:
+                del self._meters[station_id]
+
+    def stats(self):
+        with self._lock:
+            tariffs, meters = len(self._tariffs), len(self._meters)
+        return {
+            'tariffs': tariffs,
+            'meters': meters,
+            'updates': self.updates,
+            'restored': self.restored,
+        }
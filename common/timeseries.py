@@ -0,0 +1,301 @@
+import io
+import math
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+# Сырые показания: одна секция на сутки, старые секции удаляются целиком
+SAMPLES_TABLE = 'meter_samples'
+
+# Свертки: имя -> (таблица, шаг, срок хранения в днях; None - без срока)
+ROLLUPS = {
+    '1m': ('meter_rollup_1m', timedelta(minutes=1), 14),
+    '1h': ('meter_rollup_1h', timedelta(hours=1), 400),
+    '1d': ('meter_rollup_1d', timedelta(days=1), None),
+}
+# Самая мелкая свертка, в которой в окне не больше MAX_POINTS точек
+MAX_POINTS = 1500
+
+_COPY_COLUMNS = ('recorded_at', 'station_id', 'session_id', 'user_id', 'energy', 'delta')
+
+_UPSERT_ROLLUP = """
+    INSERT INTO {table} AS r (station_id, user_id, bucket, energy, samples)
+    VALUES %s
+    ON CONFLICT (station_id, user_id, bucket) DO UPDATE
+    SET energy = r.energy + EXCLUDED.energy,
+        samples = r.samples + EXCLUDED.samples
+"""
+
+
+def truncate(moment, step):
+    """Начало интервала свертки, в который попадает moment"""
+    if step == timedelta(days=1):
+        return datetime(moment.year, moment.month, moment.day)
+    if step == timedelta(hours=1):
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(second=0, microsecond=0)
+
+
+def partition_name(day):
+    return f"{SAMPLES_TABLE}_{day:%Y%m%d}"
+
+
+def retained_since(keep_days, today=None):
+    """Начало данных свертки со сроком хранения keep_days (см. MeterSeries.maintain)"""
+    if keep_days is None:
+        return None
+    day = (today or date.today()) - timedelta(days=keep_days)
+    return datetime(day.year, day.month, day.day)
+
+
+def choose_resolution(start, end):
+    """Свертка для окна [start, end): самая подробная, что дает не больше
+    MAX_POINTS точек и еще хранит данные с начала окна"""
+    span = end - start
+    for name, (_, step, keep_days) in ROLLUPS.items():
+        since = retained_since(keep_days)
+        if span / step <= MAX_POINTS and (since is None or start >= since):
+            return name
+    return '1d'
+
+
+class MeterSeries:
+    """Временной ряд показаний счетчиков по станциям и сессиям.
+
+    Каждый update-кадр добавляет строку в память; фоновый поток пишет
+    пачку через COPY в секционированную по суткам таблицу и в той же
+    транзакции прибавляет ее к сверткам 1m/1h/1d (энергия за интервал,
+    число показаний). Энергия за интервал - разность показаний сессии,
+    поэтому свертки не пересчитываются по сырым данным. Сырые секции
+    старше retention_days удаляются DROP TABLE, свертки - по своим срокам.
+    """
+
+    def __init__(self, db_pool, flush_interval=None, retention_days=None, max_pending=None):
+        self.db_pool = db_pool
+        self.flush_interval = float(flush_interval or os.getenv('METER_FLUSH_INTERVAL', 5))
+        self.retention_days = int(retention_days or os.getenv('METER_RETENTION_DAYS', 7))
+        self.max_pending = int(max_pending or os.getenv('METER_MAX_PENDING', 200000))
+        self.maintenance_interval = 3600
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []  # [(recorded_at, station_id, session_id, user_id, energy, delta)]
+        self._last = {}  # {session_id: (последнее показание энергии, time.monotonic())}
+        self._partitions = set()  # дни, для которых секция точно есть
+        self._stopped = threading.Event()
+        self._thread = None
+        self._maintained_at = 0
+
+        self.recorded = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.rows_written = 0
+        self.batches = 0
+        self.partitions_dropped = 0
+
+    def init_db(self, cursor):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {SAMPLES_TABLE} (
+                recorded_at TIMESTAMP NOT NULL,
+                station_id INTEGER NOT NULL,
+                session_id INTEGER,
+                user_id INTEGER,
+                energy FLOAT NOT NULL,
+                delta FLOAT NOT NULL
+            ) PARTITION BY RANGE (recorded_at)
+        ''')
+        # Индекс на родительской таблице создается и во всех секциях
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {SAMPLES_TABLE}_session_idx
+            ON {SAMPLES_TABLE} (session_id, recorded_at)
+        ''')
+        for table, _, _ in ROLLUPS.values():
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    station_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    bucket TIMESTAMP NOT NULL,
+                    energy FLOAT NOT NULL,
+                    samples INTEGER NOT NULL,
+                    PRIMARY KEY (station_id, user_id, bucket)
+                )
+            ''')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_user_idx ON {table} (user_id, bucket)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_bucket_idx ON {table} (bucket)')
+        today = date.today()
+        self._ensure_partitions(cursor, {today, today + timedelta(days=1)})
+
+    def record(self, station_id, session_id, user_id, energy_consumed):
+        """Добавляет показание; False - показание отброшено (буфер переполнен
+        или кадр с неверными полями: такая строка сорвала бы COPY всей пачки)"""
+        if session_id is None:
+            return False
+        try:
+            station_id, session_id = int(station_id), int(session_id)
+            user_id = int(user_id or 0)
+            energy = float(energy_consumed or 0)
+        except (TypeError, ValueError):
+            self.invalid += 1
+            return False
+        if not math.isfinite(energy):
+            self.invalid += 1
+            return False
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            # Первое показание сессии в этом процессе - только точка отсчета:
+            # энергию до него мог учесть процесс, принимавший кадры раньше.
+            # Показание меньше прошлого - сброс счетчика, энергии за интервал нет
+            previous = self._last.get(session_id)
+            delta = max(energy - previous[0], 0.0) if previous else 0.0
+            self._last[session_id] = (energy, time.monotonic())
+            self._pending.append((datetime.now(), station_id, session_id, user_id, energy, delta))
+            self.recorded += 1
+        return True
+
+    def end_session(self, session_id):
+        """Забывает последнее показание завершенной сессии"""
+        with self._lock:
+            self._last.pop(session_id, None)
+
+    def _ensure_partitions(self, cursor, days):
+        for day in sorted(days - self._partitions):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {partition_name(day)}
+                PARTITION OF {SAMPLES_TABLE}
+                FOR VALUES FROM (%s) TO (%s)
+            ''', (datetime(day.year, day.month, day.day), datetime(day.year, day.month, day.day) + timedelta(days=1)))
+            self._partitions.add(day)
+
+    def _copy(self, cursor, rows):
+        buffer = io.StringIO()
+        for recorded_at, station_id, session_id, user_id, energy, delta in rows:
+            buffer.write(f"{recorded_at.isoformat(' ')}\t{station_id}\t{session_id}\t{user_id}\t{energy!r}\t{delta!r}\n")
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {SAMPLES_TABLE} ({', '.join(_COPY_COLUMNS)}) FROM STDIN", buffer)
+
+    def _rollup(self, cursor, rows):
+        for table, step, _ in ROLLUPS.values():
+            buckets = {}
+            for recorded_at, station_id, _, user_id, _, delta in rows:
+                key = (station_id, user_id, truncate(recorded_at, step))
+                total, samples = buckets.get(key, (0.0, 0))
+                buckets[key] = (total + delta, samples + 1)
+            # Ключи по порядку: параллельные записи из разных процессов
+            # блокируют строки в одной последовательности и не взаимоблокируются
+            values = [(*key, *buckets[key]) for key in sorted(buckets)]
+            execute_values(cursor, _UPSERT_ROLLUP.format(table=table), values, page_size=1000)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+
+        with self._flush_lock:
+            try:
+                with self.db_pool.connection() as conn, conn.cursor() as cur:
+                    self._ensure_partitions(cur, {row[0].date() for row in batch})
+                    self._copy(cur, batch)
+                    self._rollup(cur, batch)
+                    conn.commit()
+            except Exception as e:
+                print(f"Meter samples flush failed: {e}")
+                # Секции могли не создаться вместе с откатом транзакции
+                self._partitions.clear()
+                with self._lock:
+                    if len(self._pending) + len(batch) <= self.max_pending:
+                        self._pending[:0] = batch
+                    else:
+                        self.dropped += len(batch)
+                return 0
+
+        self.batches += 1
+        self.rows_written += len(batch)
+        return len(batch)
+
+    def maintain(self):
+        """Секции на сегодня и завтра, удаление старых секций и строк сверток"""
+        today = date.today()
+        cutoff = today - timedelta(days=self.retention_days)
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            self._ensure_partitions(cur, {today, today + timedelta(days=1)})
+            cur.execute('''
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = %s
+            ''', (SAMPLES_TABLE,))
+            for (name,) in cur.fetchall():
+                try:
+                    day = datetime.strptime(name[len(SAMPLES_TABLE) + 1:], '%Y%m%d').date()
+                except ValueError:
+                    continue
+                if day < cutoff:
+                    # Секция удаляется целиком, без DELETE и VACUUM
+                    cur.execute(f'DROP TABLE IF EXISTS {name}')
+                    self._partitions.discard(day)
+                    self.partitions_dropped += 1
+            for table, _, keep_days in ROLLUPS.values():
+                if keep_days is not None:
+                    cur.execute(f'DELETE FROM {table} WHERE bucket < %s', (retained_since(keep_days, today),))
+            conn.commit()
+        # Сессии без кадров больше суток завершены (возможно, другим процессом)
+        expired = time.monotonic() - 86400
+        with self._lock:
+            for session_id in [key for key, (_, seen) in self._last.items() if seen < expired]:
+                del self._last[session_id]
+
+    def curve(self, start, end, station_id=None, user_id=None, resolution=None):
+        """Энергия по интервалам свертки: (resolution, [{'time', 'energy', 'samples'}])"""
+        resolution = resolution or choose_resolution(start, end)
+        table, step, _ = ROLLUPS[resolution]
+        column, key = ('station_id', station_id) if station_id is not None else ('user_id', user_id)
+        with self.db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f'''
+                SELECT bucket, sum(energy), sum(samples) FROM {table}
+                WHERE {column} = %s AND bucket >= %s AND bucket < %s
+                GROUP BY bucket ORDER BY bucket
+            ''', (key, truncate(start, step), end))
+            rows = cur.fetchall()
+        return resolution, [
+            {'time': bucket.isoformat(), 'energy': round(energy, 6), 'samples': int(samples)}
+            for bucket, energy, samples in rows
+        ]
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() - self._maintained_at >= self.maintenance_interval:
+                try:
+                    self.maintain()
+                except Exception as e:
+                    print(f"Meter samples maintenance failed: {e}")
+                self._maintained_at = time.monotonic()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'pending': pending,
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+            'batches': self.batches,
+            'rows_written': self.rows_written,
+            'partitions_dropped': self.partitions_dropped,
+        }
@@ -1,16 +1,26 @@
 import socket
-import json
 import time
 import threading
+import os
+import sys
+from collections import OrderedDict
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.hashring import HashRing, gateway_list
+from common.protocol import MessageChannel
+
 class ChargingStation:
     def __init__(self, station_id, server_host='localhost', server_port=9090):
         self.station_id = station_id
         self.server_host = server_host
         self.server_port = server_port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Несколько шлюзов (GATEWAYS) - станция идет на свой по кольцу, при отказе на следующий
+        self.gateways = gateway_list()
+        self.socket = None
         self.command_socket = None
+        self.channel = None
+        self.command_channel = None
         self.power = 0  # kW
         self.power_consumption = 0  # kWh
         self.status = "offline"
@@ -22,6 +32,7 @@ class ChargingStation:
         self.socket_lock = threading.Lock()
         self.energy_thread_active = False
         self.energy_thread = None
+        self.recent_commands = OrderedDict()  # {command_id: подтверждение} - для повторов сервера
 
     def energy_counter(self, session_id):
         """Метод для подсчета потребленной энергии в отдельном потоке"""
@@ -39,19 +50,39 @@ class ChargingStation:
             time.sleep(1)  # Обновляем каждую секунду
 
 
+    def gateway_candidates(self):
+        if not self.gateways:
+            return [(self.server_host, self.server_port)]
+        candidates = []
+        for gateway in HashRing(self.gateways).preference(self.station_id):
+            host, _, port = gateway.rpartition(':')
+            candidates.append((host, int(port)))
+        return candidates
+
     def connect_to_server(self):
+        for host, port in self.gateway_candidates():
+            if self.connect_to_gateway(host, port):
+                return True
+            for sock in (self.socket, self.command_socket):
+                if sock:
+                    sock.close()
+        return False
+
+    def connect_to_gateway(self, host, port):
         try:
             # Основное соединение для heartbeat и команд
-            self.socket.connect((self.server_host, self.server_port))
+            self.socket = socket.create_connection((host, port))
+            self.channel = MessageChannel(self.socket)
             
             # Отдельное соединение для получения команд от сервера
-            self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.command_socket.connect((self.server_host, self.server_port))
+            self.command_socket = socket.create_connection((host, port))
+            self.command_channel = MessageChannel(self.command_socket)
             
             response = self.send_request({
                 "action": "register_command",
-                "station_id": self.station_id
-            }, sock=self.command_socket)
+                "station_id": self.station_id,
+                "acks": True,
+            }, channel=self.command_channel)
             
 
             print(response)
@@ -65,7 +96,7 @@ class ChargingStation:
                 return True
             return False
         except Exception as e:
-            print(f"Connection error: {e}")
+            print(f"Connection error ({host}:{port}): {e}")
             return False
 
     def initialize_station(self):
@@ -143,14 +174,12 @@ class ChargingStation:
         threading.Thread(target=heartbeat_loop, daemon=True).start()
 
 
-    def send_request(self, request, sock=None):
-        if sock is None:
-            sock = self.socket
+    def send_request(self, request, channel=None):
+        if channel is None:
+            channel = self.channel
         try:
             with self.socket_lock:
-                sock.sendall(json.dumps(request).encode('utf-8'))
-                response = sock.recv(1024)
-                return json.loads(response.decode('utf-8'))
+                return channel.request(request)
         except Exception as e:
             print(f"Request error: {e}")
             return None
@@ -224,19 +253,23 @@ class ChargingStation:
         #     return False    
 
     def process_command(self, command):
+        """Выполняет команду сервера; возвращает (успех, сообщение) для подтверждения"""
         action = command.get("action")
         
         if action == "start_charging":
             print("\nReceived START CHARGING command from server")
+            session_id = command.get("session_id")
             if not self.current_session:
-                session_id = command.get("session_id")
                 user_id = command.get("user_id")
                 if self.start_charging_local(session_id, user_id):
                     print("Charging started successfully")
-                else:
-                    print("Failed to start charging")
-            else:
-                print("Already charging - ignoring command")
+                    return True, None
+                print("Failed to start charging")
+                return False, "Failed to start charging"
+            if self.current_session["id"] == session_id:
+                return True, None
+            print("Already charging - ignoring command")
+            return False, "Already charging"
         
         elif action == "stop_charging":
             print("\nReceived STOP CHARGING command from server")
@@ -244,10 +277,11 @@ class ChargingStation:
             if self.current_session:
                 if self.stop_charging_local(user_id):
                     print(f"Charging stopped.")
-                else:
-                    print("Failed to stop charging")
-            else:
-                print("Not charging - ignoring command")
+                    return True, None
+                print("Failed to stop charging")
+                return False, "Failed to stop charging"
+            print("Not charging - ignoring command")
+            return True, "Not charging"
         
 
         elif action == "set_power":
@@ -255,9 +289,34 @@ class ChargingStation:
             if new_power is not None:
                 self.power = new_power
                 print(f"\nPower updated to {new_power} kW by server command")
+                return True, None
+            return False, "Power is missing"
         
         else:
             print(f"Unknown command: {action}")
+            return False, f"Unknown command: {action}"
+
+    def handle_command(self, command):
+        """Выполняет команду и подтверждает ее по command_id; повтор получает прежний ответ"""
+        command_id = command.get("command_id")
+        if command_id is None:
+            self.process_command(command)
+            return
+        
+        ack = self.recent_commands.get(command_id)
+        if ack is None:
+            ok, message = self.process_command(command)
+            ack = {
+                "action": "command_ack",
+                "station_id": self.station_id,
+                "command_id": command_id,
+                "status": "success" if ok else "error",
+                "message": message,
+            }
+            self.recent_commands[command_id] = ack
+            while len(self.recent_commands) > 64:
+                self.recent_commands.popitem(last=False)
+        self.command_channel.send(ack)
 
     
 
@@ -265,14 +324,17 @@ class ChargingStation:
         """Слушает команды от сервера на отдельном соединении"""
         while self.connected:
             try:
-                data = self.command_socket.recv(1024)
-                if not data:
+                commands = self.command_channel.receive_batch()
+                if commands is None:
                     print("Command connection closed by server")
                     self.connected = False
                     break
                     
-                command = json.loads(data.decode('utf-8'))
-                self.process_command(command)
+                for command in commands:
+                    if command is None:
+                        print("Received malformed command")
+                        continue
+                    self.handle_command(command)
             except ConnectionResetError:
                 print(f"Command listener error: connection lost")
                 self.connected = False
@@ -0,0 +1,541 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.hashring import HashRing, gateway_list
+from common.protocol import CODEC_JSON, RECV_SIZE, ChannelState
+from common.stats import LatencyHistogram
+
+# Замеры задержек, мс:
+#   init, register_command, heartbeat, update - ответ шлюза на запрос станции
+#   command     - от запроса к REST API до прихода команды на станцию
+#   reconnect   - от потери соединения до успешного init
+#   api_start, api_stop - ответ REST API на запуск/остановку зарядки
+METRICS = ('init', 'register_command', 'heartbeat', 'update', 'command', 'reconnect', 'api_start', 'api_stop')
+
+HISTOGRAM_EDGES = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class AsyncChannel(ChannelState):
+    """MessageChannel поверх потоков asyncio"""
+
+    def __init__(self, reader, writer):
+        super().__init__(CODEC_JSON)
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, message):
+        self.writer.write(self.encode(message))
+        await self.writer.drain()
+
+    async def receive_batch(self, limit=None):
+        batch = self.take_pending()
+        if batch:
+            return batch
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            batch = self.decoder.feed(data, limit)
+            if batch:
+                return batch
+
+    async def receive(self, limit=None):
+        batch = await self.receive_batch(limit)
+        if batch is None:
+            raise ConnectionError('Connection closed by peer')
+        return self.next_message(batch)
+
+    async def request(self, message):
+        """Как MessageChannel.request: в рукопожатии предлагаем кодеки"""
+        message, handshake = self.offer_codecs(message)
+        await self.send(message)
+        if not handshake:
+            return await self.receive()
+        return self.accept_codec(await self.receive(limit=1))
+
+    def close(self):
+        self.writer.close()
+
+
+class VirtualStation:
+    """Станция без потоков и input(): соединения, heartbeat/update и команды.
+
+    Энергия считается по времени при отправке update, а не отдельным
+    счетчиком, поэтому станция между запросами ничего не стоит.
+    """
+
+    def __init__(self, station_id, fleet):
+        self.station_id = station_id
+        self.fleet = fleet
+        self.data = None
+        self.command = None
+        self.online = False
+        self.power = 0
+        self.meter = 0
+        self.status = 'offline'
+        self.session = None  # {'id', 'user_id', 'started'}
+        self.dropped_at = None
+        self.recent_commands = OrderedDict()
+
+    def energy(self):
+        if not self.session:
+            return 0
+        return self.power * (time.time() - self.session['started']) / 3600
+
+    async def timed(self, metric, channel, request):
+        started = time.perf_counter()
+        response = await asyncio.wait_for(channel.request(request), self.fleet.options.request_timeout)
+        self.fleet.record(metric, (time.perf_counter() - started) * 1000)
+        if not response or response.get('status') != 'success':
+            self.fleet.errors[metric] += 1
+            return None
+        return response
+
+    async def connect(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        self.data = AsyncChannel(reader, writer)
+        reader, writer = await asyncio.open_connection(host, port)
+        self.command = AsyncChannel(reader, writer)
+
+        if not await self.timed('register_command', self.command,
+                                {'action': 'register_command', 'station_id': self.station_id, 'acks': True}):
+            return False
+        response = await self.timed('init', self.data, {'action': 'init', 'station_id': self.station_id})
+        if not response:
+            return False
+
+        self.power = response.get('power') or 0
+        self.meter = response.get('power_consumption') or 0
+        self.status = response.get('station_status')
+        session = response.get('current_session')
+        if self.status == 'busy' and session:
+            started = datetime.strptime(session['start_time'], '%Y-%m-%d %H:%M:%S').timestamp()
+            self.session = {'id': session['id'], 'user_id': session['user_id'], 'started': started}
+        else:
+            self.session = None
+        return True
+
+    def close(self):
+        self.online = False
+        for channel in (self.data, self.command):
+            if channel:
+                channel.close()
+        self.data = self.command = None
+
+    def drop(self):
+        """Обрыв соединений для шторма переподключений"""
+        if self.online:
+            self.dropped_at = time.perf_counter()
+            self.close()
+
+    async def heartbeat_loop(self):
+        options = self.fleet.options
+        # Первый запрос в случайный момент интервала, чтобы станции не шли строем
+        await asyncio.sleep(random.uniform(0, options.heartbeat))
+        while True:
+            if self.session:
+                response = await self.timed('update', self.data, {
+                    'action': 'update',
+                    'station_id': self.station_id,
+                    'user_id': self.session['user_id'],
+                    'session_id': self.session['id'],
+                    'energy_consumed': self.energy(),
+                })
+                interval = options.update
+            else:
+                response = await self.timed('heartbeat', self.data, {
+                    'action': 'heartbeat',
+                    'station_id': self.station_id,
+                })
+                interval = options.heartbeat
+            if response is None:
+                return
+            await asyncio.sleep(interval)
+
+    async def command_loop(self):
+        while True:
+            commands = await self.command.receive_batch()
+            if commands is None:
+                return
+            for command in commands:
+                if command:
+                    await self.handle_command(command)
+
+    def process_command(self, command):
+        action = command.get('action')
+        if action == 'start_charging':
+            if self.session and self.session['id'] != command.get('session_id'):
+                return False, 'Already charging'
+            if not self.session:
+                self.session = {'id': command.get('session_id'), 'user_id': command.get('user_id'),
+                                'started': time.time()}
+                self.status = 'busy'
+            return True, None
+        if action == 'stop_charging':
+            if self.session:
+                self.meter += self.energy()
+                self.session = None
+                self.status = 'free'
+            return True, None
+        if action == 'set_power':
+            if command.get('power') is None:
+                return False, 'Power is missing'
+            self.power = command['power']
+            return True, None
+        return False, f'Unknown command: {action}'
+
+    async def handle_command(self, command):
+        self.fleet.command_received(self.station_id, command.get('action'))
+        command_id = command.get('command_id')
+        if command_id is None:
+            self.process_command(command)
+            return
+        ack = self.recent_commands.get(command_id)
+        if ack is None:
+            ok, message = self.process_command(command)
+            ack = {
+                'action': 'command_ack',
+                'station_id': self.station_id,
+                'command_id': command_id,
+                'status': 'success' if ok else 'error',
+                'message': message,
+            }
+            self.recent_commands[command_id] = ack
+            while len(self.recent_commands) > 64:
+                self.recent_commands.popitem(last=False)
+        await self.command.send(ack)
+
+    async def serve(self):
+        tasks = [asyncio.ensure_future(self.heartbeat_loop()), asyncio.ensure_future(self.command_loop())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, delay):
+        options = self.fleet.options
+        await asyncio.sleep(delay)
+        candidates = self.fleet.gateways_for(self.station_id)
+        attempt = 0
+        while not self.fleet.stopping:
+            host, port = candidates[attempt % len(candidates)]
+            try:
+                async with self.fleet.connect_slots:
+                    connected = await self.connect(host, port)
+            except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                self.fleet.errors['connect'] += 1
+                self.fleet.last_error = f'{host}:{port}: {e!r}'
+                connected = False
+
+            if connected:
+                attempt = 0
+                self.online = True
+                if self.dropped_at is not None:
+                    self.fleet.record('reconnect', (time.perf_counter() - self.dropped_at) * 1000)
+                self.dropped_at = None
+                try:
+                    await self.serve()
+                except (OSError, ConnectionError, asyncio.TimeoutError):
+                    pass
+                if self.online:
+                    self.fleet.errors['disconnect'] += 1
+                    self.dropped_at = time.perf_counter()
+            else:
+                attempt += 1
+            self.close()
+            if self.fleet.stopping:
+                break
+            # Экспоненциальная задержка с полным джиттером; backoff 0 - все разом
+            backoff = min(options.max_backoff, options.backoff * 2 ** min(attempt, 10))
+            await asyncio.sleep(random.uniform(0, backoff))
+
+
+class FleetSimulator:
+    """Тысячи виртуальных станций в одном процессе на asyncio.
+
+    Запуски и остановки зарядок приходят пуассоновским потоком через REST
+    API, шторм переподключений разом обрывает соединения доли станций.
+    Задержки собираются в гистограммы по видам запросов.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.metrics = {metric: LatencyHistogram() for metric in METRICS}
+        self.errors = Counter()
+        self.last_error = None
+        self.stopping = False
+        self.stations = [VirtualStation(options.first_id + i, self) for i in range(options.stations)]
+        self.charging = set()
+        self.issued = {}  # {(station_id, action): время запроса к API}
+        self.ring = HashRing(options.gateways) if options.gateways else None
+        self.connect_slots = None
+        self.api_pool = ThreadPoolExecutor(max_workers=options.api_workers)
+        self.token = options.token
+
+    def gateways_for(self, station_id):
+        if self.ring is None:
+            return [(self.options.host, self.options.port)]
+        candidates = []
+        for gateway in self.ring.preference(station_id):
+            host, _, port = gateway.rpartition(':')
+            candidates.append((host, int(port)))
+        return candidates
+
+    def record(self, metric, value):
+        self.metrics[metric].record(value)
+
+    def command_received(self, station_id, action):
+        issued = self.issued.pop((station_id, action), None)
+        if issued is not None:
+            self.record('command', (time.perf_counter() - issued) * 1000)
+
+    def _http(self, method, path, body=None):
+        request = urllib.request.Request(
+            self.options.api.rstrip('/') + path,
+            data=json.dumps(body or {}).encode(),
+            method=method,
+            headers={'Content-Type': 'application/json'},
+        )
+        if self.token:
+            request.add_header('Authorization', f'Bearer {self.token}')
+        try:
+            with urllib.request.urlopen(request, timeout=self.options.request_timeout) as response:
+                return response.status, json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            return e.code, {}
+        except (OSError, ValueError) as e:
+            return None, {'message': str(e)}
+
+    async def api(self, metric, method, path, body=None):
+        """Запрос к REST API в пуле потоков; metric None - без замера"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        status, response = await loop.run_in_executor(self.api_pool, self._http, method, path, body)
+        if metric is None:
+            return response if status == 200 else None
+        self.record(metric, (time.perf_counter() - started) * 1000)
+        if status not in (200, 202):
+            self.errors[metric] += 1
+            return None
+        return response
+
+    async def login(self):
+        if self.token or not self.options.email:
+            return
+        response = await self.api(None, 'POST', '/api/auth/login', {
+            'email': self.options.email, 'password': self.options.password,
+        })
+        if not response:
+            raise SystemExit('Login failed')
+        self.token = response['token']
+
+    async def charge(self, station):
+        station_id = station.station_id
+        self.charging.add(station_id)
+        try:
+            self.issued[(station_id, 'start_charging')] = time.perf_counter()
+            if not await self.api('api_start', 'POST', f'/api/stations/{station_id}/start'):
+                self.issued.pop((station_id, 'start_charging'), None)
+                return
+            await asyncio.sleep(random.expovariate(1 / self.options.session_mean))
+            self.issued[(station_id, 'stop_charging')] = time.perf_counter()
+            if not await self.api('api_stop', 'POST', f'/api/stations/{station_id}/stop'):
+                self.issued.pop((station_id, 'stop_charging'), None)
+        finally:
+            self.charging.discard(station_id)
+
+    async def session_arrivals(self):
+        """Пуассоновский поток запусков: session_rate в секунду по всему парку"""
+        tasks = set()
+        while not self.stopping:
+            await asyncio.sleep(random.expovariate(self.options.session_rate))
+            for _ in range(20):
+                station = random.choice(self.stations)
+                if station.online and station.session is None and station.station_id not in self.charging:
+                    task = asyncio.ensure_future(self.charge(station))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    break
+        for task in list(tasks):
+            task.cancel()
+
+    async def reconnect_storms(self):
+        options = self.options
+        await asyncio.sleep(options.storm_at)
+        while not self.stopping:
+            online = [station for station in self.stations if station.online]
+            victims = random.sample(online, int(len(online) * options.storm_fraction))
+            print(f"Reconnect storm: dropping {len(victims)} of {len(online)} stations")
+            for station in victims:
+                station.drop()
+            if not options.storm_every:
+                return
+            await asyncio.sleep(options.storm_every)
+
+    def progress(self, elapsed):
+        online = self.online()
+        charging = sum(1 for station in self.stations if station.session)
+        heartbeat = self.metrics['heartbeat'].percentiles()
+        print(f"[{elapsed:6.0f}s] online {online}/{len(self.stations)}, charging {charging}, "
+              f"heartbeat p99 {heartbeat['p99']} ms, errors {sum(self.errors.values())}")
+
+    async def run(self):
+        options = self.options
+        self.connect_slots = asyncio.Semaphore(options.connect_concurrency)
+        await self.login()
+
+        tasks = [
+            asyncio.ensure_future(station.run(options.ramp * i / len(self.stations)))
+            for i, station in enumerate(self.stations)
+        ]
+        if options.api and options.session_rate > 0:
+            tasks.append(asyncio.ensure_future(self.session_arrivals()))
+        if options.storm_fraction > 0:
+            tasks.append(asyncio.ensure_future(self.reconnect_storms()))
+
+        started = time.monotonic()
+        next_progress = options.progress
+        try:
+            while not self.stopping:
+                elapsed = time.monotonic() - started
+                if elapsed >= options.duration:
+                    break
+                await asyncio.sleep(min(1.0, options.duration - elapsed))
+                elapsed = time.monotonic() - started
+                if options.progress and elapsed >= next_progress:
+                    self.progress(elapsed)
+                    next_progress += options.progress
+        finally:
+            self.stopping = True
+            for station in self.stations:
+                station.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.api_pool.shutdown(wait=False)
+
+    def stop(self):
+        """Досрочная остановка (можно вызывать из другого потока)"""
+        self.stopping = True
+
+    def online(self):
+        return sum(1 for station in self.stations if station.online)
+
+    def report(self):
+        return {
+            'stations': len(self.stations),
+            'duration': self.options.duration,
+            'latency_ms': {metric: histogram.summary() for metric, histogram in self.metrics.items()},
+            'histograms': {
+                metric: dict(zip(map(str, HISTOGRAM_EDGES), histogram.distribution(HISTOGRAM_EDGES)))
+                for metric, histogram in self.metrics.items() if histogram.count
+            },
+            'errors': dict(self.errors),
+        }
+
+
+def print_report(report):
+    print(f"\nStations: {report['stations']}, duration: {report['duration']}s")
+    print(f"{'metric':<18}{'count':>9}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for metric, summary in report['latency_ms'].items():
+        if not summary['count']:
+            continue
+        values = [summary[key] for key in ('mean', 'p50', 'p90', 'p99', 'max')]
+        print(f"{metric:<18}{summary['count']:>9}" + ''.join(f"{value:>10.2f}" for value in values))
+
+    for metric, buckets in report['histograms'].items():
+        total = sum(buckets.values()) or 1
+        print(f"\n{metric} (ms)")
+        edges = list(buckets)
+        for i, edge in enumerate(edges):
+            label = f"{edge}-{edges[i + 1]}" if i + 1 < len(edges) else f">{edge}"
+            share = buckets[edge] / total
+            print(f"  {label:>11} {buckets[edge]:>9} {'#' * round(share * 50)}")
+
+    if report['errors']:
+        print("\nErrors:", ', '.join(f"{name}={count}" for name, count in sorted(report['errors'].items())))
+
+
+def raise_file_limit(needed):
+    """Каждая станция держит два сокета - поднимаем лимит дескрипторов до жесткого"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        print(f"Warning: open file limit {soft} is below {needed}, some stations will fail to connect")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Headless load generator: many virtual stations in one process')
+    parser.add_argument('--stations', type=int, default=int(os.getenv('LOADGEN_STATIONS', 1000)))
+    parser.add_argument('--first-id', type=int, default=1, help='ID of the first station (stations must exist)')
+    parser.add_argument('--host', default=os.getenv('GATEWAY_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('GATEWAY_PORT', 9090)))
+    parser.add_argument('--gateways', default=None, help='host:port,... (default: GATEWAYS env)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--ramp', type=float, default=10, help='seconds to spread initial connects over')
+    parser.add_argument('--connect-concurrency', type=int, default=500)
+    parser.add_argument('--heartbeat', type=float, default=30, help='heartbeat interval, seconds')
+    parser.add_argument('--update', type=float, default=15, help='update interval while charging, seconds')
+    parser.add_argument('--request-timeout', type=float, default=10)
+    parser.add_argument('--backoff', type=float, default=1, help='base reconnect backoff, seconds')
+    parser.add_argument('--max-backoff', type=float, default=30)
+    parser.add_argument('--api', default=os.getenv('LOADGEN_API'), help='REST API base URL for sessions')
+    parser.add_argument('--token', default=os.getenv('LOADGEN_TOKEN'))
+    parser.add_argument('--email', default=os.getenv('LOADGEN_EMAIL'))
+    parser.add_argument('--password', default=os.getenv('LOADGEN_PASSWORD'))
+    parser.add_argument('--api-workers', type=int, default=32)
+    parser.add_argument('--session-rate', type=float, default=1, help='session starts per second, fleet-wide')
+    parser.add_argument('--session-mean', type=float, default=120, help='mean session length, seconds')
+    parser.add_argument('--storm-at', type=float, default=30, help='seconds before the first reconnect storm')
+    parser.add_argument('--storm-every', type=float, default=0, help='repeat storms every N seconds (0 - once)')
+    parser.add_argument('--storm-fraction', type=float, default=0, help='share of stations dropped per storm')
+    parser.add_argument('--progress', type=float, default=10, help='progress line interval, seconds (0 - off)')
+    parser.add_argument('--report', help='write the JSON report to this file')
+    options = parser.parse_args(argv)
+    options.gateways = gateway_list(options.gateways)
+    return options
+
+
+def main():
+    options = parse_args()
+    raise_file_limit(options.stations * 2 + 256)
+    fleet = FleetSimulator(options)
+    try:
+        asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        print("Interrupted")
+
+    report = fleet.report()
+    print_report(report)
+    if fleet.last_error:
+        print(f"Last connection error: {fleet.last_error}")
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {options.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import math
+import time
+
+from psycopg2 import sql
+
+from common.charging import STARTED, STOPPED, cancel_session, start_session, stop_session
+from common.commands import ACK
+from common.stats import percentiles
+
+# Итоги станций без команды: переход не выполнен (нет сессии, станция занята и т.п.)
+# или мощность заряжающейся станции выставил балансировщик
+SKIPPED = 'skipped'
+BALANCED = 'balanced'
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+FILTER_FIELDS = ('status', 'connector_type', 'current_type')
+
+# Одна команда - один set-based запрос; {selector} - условие выборки станций
+_SET_POWER = """
+    UPDATE charging_stations cs SET power = %(power)s
+    WHERE {selector}
+    RETURNING cs.id
+"""
+
+# Станции для запуска и остановки: переходы выполняют функции БД из
+# common.charging - по одной на станцию, все в одной транзакции, в порядке id.
+# using_by пуст у сессий, открытых до его появления, - пользователь тогда
+# берется из открытой сессии станции
+_CHARGING = """
+    SELECT cs.id, COALESCE(cs.using_by, (
+        SELECT s.user_id FROM sessions s
+        WHERE s.station_id = cs.id AND s.end_time IS NULL
+        ORDER BY s.id DESC LIMIT 1
+    )) FROM charging_stations cs
+    WHERE {selector}
+    ORDER BY cs.id
+"""
+
+
+def build_selector(selector):
+    """Условие WHERE по селектору {ids, filter, area}; части объединяются через AND"""
+    if not isinstance(selector, dict) or not selector:
+        raise ValueError('selector must contain ids, filter or area')
+
+    conditions = []
+    params = {}
+
+    if 'ids' in selector:
+        params['ids'] = [int(station_id) for station_id in selector['ids']]
+        conditions.append(sql.SQL('cs.id = ANY(%(ids)s)'))
+
+    for key, value in (selector.get('filter') or {}).items():
+        if key == 'min_power':
+            params['min_power'] = float(value)
+            conditions.append(sql.SQL('cs.power >= %(min_power)s'))
+        elif key in FILTER_FIELDS:
+            params[key] = value
+            conditions.append(sql.SQL('cs.{} = %({})s').format(sql.Identifier(key), sql.SQL(key)))
+        else:
+            raise ValueError(f'Unknown filter: {key}')
+
+    area = selector.get('area')
+    if area:
+        if 'bbox' in area:
+            min_lon, min_lat, max_lon, max_lat = map(float, area['bbox'])
+        else:
+            lat, lon, radius = float(area['lat']), float(area['lon']), float(area['radius_km'])
+            # Прямоугольник отсекает лишнее по индексу, расстояние проверяется точно
+            d_lat = radius / KM_PER_DEGREE
+            d_lon = radius / (KM_PER_DEGREE * max(0.01, math.cos(math.radians(lat))))
+            min_lat, max_lat, min_lon, max_lon = lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon
+            params.update(center_lat=lat, center_lon=lon, radius_km=radius, earth_radius=EARTH_RADIUS_KM)
+            conditions.append(sql.SQL(
+                '2 * %(earth_radius)s * asin(sqrt('
+                'power(sin(radians(cs.latitude - %(center_lat)s) / 2), 2) + '
+                'cos(radians(%(center_lat)s)) * cos(radians(cs.latitude)) * '
+                'power(sin(radians(cs.longitude - %(center_lon)s) / 2), 2))) <= %(radius_km)s'
+            ))
+        params.update(min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon)
+        conditions.append(sql.SQL(
+            'cs.latitude BETWEEN %(min_lat)s AND %(max_lat)s '
+            'AND cs.longitude BETWEEN %(min_lon)s AND %(max_lon)s'
+        ))
+
+    if not conditions:
+        raise ValueError('selector must contain ids, filter or area')
+    return sql.SQL(' AND ').join(conditions), params
+
+
+class FleetCommander:
+    """Массовые команды станциям: одна транзакция в БД и параллельная рассылка.
+
+    Мощность меняется одним set-based запросом по селектору; запуск и
+    остановка - теми же функциями БД, что и одиночные, со стоимостью по
+    тарифу и списанием в журнал. Команды ставятся в очереди всех
+    затронутых станций сразу, после чего итоги собираются с общим дедлайном.
+    """
+
+    ACTIONS = ('set_power', 'stop_charging', 'start_charging')
+
+    def __init__(self, db_pool, commands, station_cache, ingestor, tariffs, meter_series, deadline=10.0,
+                 balancer=None):
+        self.db_pool = db_pool
+        self.commands = commands
+        self.station_cache = station_cache
+        self.ingestor = ingestor
+        self.tariffs = tariffs
+        self.meter_series = meter_series
+        self.deadline = deadline
+        # Заряжающимся станциям мощность выставляет балансировщик (подписан на кэш)
+        self.balancer = balancer
+
+    def execute(self, action, selector, power=None, user_id=None, deadline=None):
+        if action not in self.ACTIONS:
+            raise ValueError(f'Unknown bulk action: {action}')
+        started = time.monotonic()
+        condition, params = build_selector(selector)
+
+        db_started = time.monotonic()
+        balanced = []
+        skipped = []
+        if action == 'set_power':
+            if power is None:
+                raise ValueError('power is required')
+            fields = {'power': float(power)}
+            rows = self._run(_SET_POWER, condition, {**params, 'power': float(power)}, fields)
+            commands = {}
+            for (station_id,) in rows:
+                self.station_cache.apply(station_id, **fields)
+                if self.balancer is not None and self.balancer.balances(station_id):
+                    # Новая мощность стала запросом: станция уже получила свою долю
+                    balanced.append({'station_id': station_id, 'status': BALANCED,
+                                     'power': self.balancer.allocation(station_id)})
+                else:
+                    commands[station_id] = {'action': 'set_power', 'power': float(power)}
+        elif action == 'stop_charging':
+            fields = {'status': 'free', 'reserved_by': None, 'using_by': None}
+            condition = sql.SQL("cs.status = 'busy' AND {}").format(condition)
+            stopped, skipped = self._transition(condition, params, self._stop)
+            commands = {
+                station_id: {'action': 'stop_charging', 'user_id': user}
+                for station_id, user, _ in stopped
+            }
+            for station_id, _, result in stopped:
+                self.station_cache.apply(station_id, **fields)
+                self.meter_series.end_session(result['session_id'])
+        else:
+            if user_id is None:
+                raise ValueError('user_id is required')
+            # Запускаем только свободные станции, подключенные к какому-либо шлюзу
+            # (commands - CommandBus) - остальным команду не доставить
+            condition = sql.SQL("cs.status = 'free' AND cs.id = ANY(%(connected)s) AND {}").format(condition)
+            params = {**params, 'connected': self.commands.connected_stations()}
+            transitions, skipped = self._transition(
+                condition, params, lambda cur, station_id, _: self._start(cur, station_id, user_id)
+            )
+            commands = {
+                station_id: {'action': 'start_charging', 'session_id': result['session_id'],
+                             'status': 'busy', 'user_id': user_id}
+                for station_id, _, result in transitions
+            }
+            for station_id in commands:
+                self.station_cache.apply(station_id, status='busy', using_by=user_id)
+        db_ms = (time.monotonic() - db_started) * 1000
+
+        # Срок команд - дедлайн операции: не подтвержденные к нему снимаются
+        deadline = deadline or self.deadline
+        pending = {
+            station_id: self.commands.dispatch(station_id, command, ttl=deadline)
+            for station_id, command in commands.items()
+        }
+        wait_until = time.monotonic() + deadline
+        # Станции, для которых переход не выполнен, - в итоге со статусом skipped
+        results = balanced + skipped
+        for station_id, command in pending.items():
+            if command.wait(max(0.0, wait_until - time.monotonic())) is None:
+                self.commands.expire(command)
+            results.append({'station_id': station_id, **command.result})
+
+        if action == 'start_charging':
+            self._cancel_rejected(results, commands)
+
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+        acked = [result['latency_ms'] for result in results if result['status'] == ACK]
+        return {
+            'status': 'success',
+            'action': action,
+            'matched': len(results),
+            'summary': summary,
+            'latency_ms': percentiles(acked),
+            'db_ms': round(db_ms, 2),
+            'total_ms': round((time.monotonic() - started) * 1000, 2),
+            'results': results,
+        }
+
+    def _run(self, statement, condition, params, fields):
+        query = sql.SQL(statement).format(selector=condition)
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+                self.station_cache.notify_many(cur, [row[0] for row in rows], **fields)
+                conn.commit()
+                return rows
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def _transition(self, condition, params, transition):
+        """Переход для каждой станции по селектору в одной транзакции:
+        ([(station_id, using_by, итог функции)] успешных, [итог] пропущенных)"""
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL(_CHARGING).format(selector=condition), params)
+                done, skipped = [], []
+                for station_id, using_by in cur.fetchall():
+                    result, reason = transition(cur, station_id, using_by)
+                    if reason is None:
+                        done.append((station_id, using_by, result))
+                    else:
+                        skipped.append({'station_id': station_id, 'status': SKIPPED, 'message': reason})
+                conn.commit()
+                return done, skipped
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def _stop(self, cur, station_id, using_by):
+        """(итог, None) или (None, причина пропуска)"""
+        if using_by is None:
+            return None, 'No open session on the station'
+        stopped = stop_session(cur, self.station_cache, self.ingestor, self.tariffs, station_id, using_by)
+        if stopped['result'] != STOPPED:
+            return None, stopped['result']
+        return stopped, None
+
+    def _start(self, cur, station_id, user_id):
+        started = start_session(cur, self.station_cache, self.tariffs, station_id, user_id)
+        if started['result'] != STARTED:
+            return None, started['result']
+        return started, None
+
+    def _cancel_rejected(self, results, commands):
+        """Запуски, отклоненные станциями, откатываются в одной транзакции"""
+        rejected = [result['station_id'] for result in results
+                    if result['station_id'] in commands and result['status'] != ACK]
+        if not rejected:
+            return
+        cancelled = []
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                for station_id in rejected:
+                    session_id = commands[station_id]['session_id']
+                    if cancel_session(cur, self.station_cache, self.tariffs, station_id, session_id, 'free'):
+                        cancelled.append(station_id)
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error cancelling rejected bulk starts: {e}")
+            return
+        finally:
+            self.db_pool.putconn(conn)
+        for station_id in cancelled:
+            self.station_cache.apply(station_id, status='free', using_by=None)
@@ -1,10 +1,26 @@
-import socket
-import threading
-import json
-import psycopg2
-from psycopg2 import pool
+import os
+import sys
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.charging import (
+    NO_SESSION, NO_STATION, NOT_CHARGING, RESERVED_BY_OTHER, UNAVAILABLE,
+    cancel_session, install as install_charging_functions, start_session, stop_session,
+)
+from common.commands import ACK, ACK_ACTION, ACKS_CAPABILITY, EXPIRED, NACK, NOT_CONNECTED, CommandDispatcher
+from common.db import DatabasePool
+from common.gateway import StationGateway
+from common.ingest import EnergyIngestor
+from common.ledger import init_db as init_ledger
+from common.registry import COMMAND, ConnectionRegistry
+from common.routing import CommandBus
+from common.liveness import LivenessTable
+from common.station_cache import StationStateCache
+from common.tariffs import TariffEngine
+from common.timeseries import MeterSeries
+from fleet import FleetCommander
+from scheduler import LoadBalancer
+
 class ChargingServer:
     def __init__(self):
          # Основной порт для станций
@@ -15,23 +31,45 @@ class ChargingServer:
         self.api_host = '0.0.0.0'
         self.api_port = 9091
 
-        self.station_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.station_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
-        self.api_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.api_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
-        self.connections = {}  
-        self.command_sockets = {}  
-        # Пул соединений PostgreSQL
-        self.db_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
-            host="localhost",
-            database="postgres",
-            user="postgres",
-            password="postgres"
+        # Основное и командное соединения станций с обратным поиском по соединению;
+        # станции без heartbeat дольше STATION_TIMEOUT отключаются
+        self.connections = ConnectionRegistry(on_evict=self.on_station_evicted)
+        # Очереди команд станциям с подтверждениями и повторами
+        self.commands = CommandDispatcher()
+        self.command_deadline = float(os.getenv('COMMAND_DEADLINE', 10))
+        # Потокобезопасный пул соединений PostgreSQL
+        self.db_pool = DatabasePool(minconn=1, maxconn=10)
+        # Команды станциям на других экземплярах шлюза - через NOTIFY
+        self.bus = CommandBus(
+            self.db_pool, self.commands, on_ownership_lost=self.connections.disconnect, port=self.station_port,
+        )
+
+        # Heartbeat пишутся в память и сбрасываются в БД пачками
+        self.liveness = LivenessTable(self.db_pool)
+        # Показания энергии из update-кадров пишутся пачками
+        self.ingestor = EnergyIngestor(self.db_pool)
+        # Стоимость сессий по тарифам станций, считается на каждом update-кадре
+        self.tariffs = TariffEngine(self.db_pool)
+        # История показаний сессий: сырые кадры по суткам и свертки 1m/1h/1d
+        self.meter_series = MeterSeries(self.db_pool)
+        # Кэш состояния станций, синхронизируется с бэкендом через NOTIFY
+        self.station_cache = StationStateCache(self.db_pool)
+        self.station_cache.subscribe(self.tariffs.on_state_change)
+
+        # Распределение бюджета мощности фидеров между заряжающимися станциями;
+        # начало и конец сессий приходят через кэш состояния (в т.ч. от бэкенда)
+        self.balancer = LoadBalancer(self.db_pool, self.bus)
+        self.station_cache.subscribe(self.balancer.on_state_change)
+
+        # Массовые команды (ограничение мощности при пиках сети и т.п.)
+        self.fleet = FleetCommander(
+            self.db_pool, self.bus, self.station_cache, self.ingestor,
+            self.tariffs, self.meter_series, deadline=self.command_deadline, balancer=self.balancer,
         )
+
+        # Один цикл событий на все соединения; работа с БД - в пуле потоков
+        # того же размера, что и пул соединений
+        self.gateway = StationGateway(max_workers=self.db_pool.maxconn)
         
         self.init_db()
 
@@ -51,41 +89,52 @@ class ChargingServer:
 						end_electricity_meter FLOAT
                     );
                 """)
+                # Фидеры (линии питания) с бюджетом мощности для балансировки
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS feeders (
+                        id SERIAL PRIMARY KEY,
+                        name VARCHAR(100),
+                        power_budget FLOAT NOT NULL
+                    );
+                """)
+                cur.execute("""
+                    ALTER TABLE charging_stations
+                    ADD COLUMN IF NOT EXISTS feeder_id INTEGER REFERENCES feeders(id)
+                """)
+                # Срок брони (бронирует и снимает просроченные брони бэкенд)
+                cur.execute("""
+                    ALTER TABLE charging_stations
+                    ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMP
+                """)
+                # Журнал баланса: остановка сессии списывает ее стоимость
+                init_ledger(cur)
+                self.tariffs.init_db(cur)
+                self.meter_series.init_db(cur)
+                install_charging_functions(cur)
                 conn.commit()
         finally:
             self.db_pool.putconn(conn)
+        self.bus.init_db()
 
-    def handle_station_client(self, client_socket, addr):
-        try:
-            while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-                try:
-                    request = json.loads(data.decode('utf-8'))
-                    response = self.process_station_request(request, client_socket)
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-                except json.JSONDecodeError:
-                    response = {"status": "error", "message": "Invalid JSON"}
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-        except ConnectionResetError:
-            print(f"Station client {addr} disconnected")
-        finally:
-            # Удаляем соединение при отключении
-            for station_id, sock in list(self.connections.items()):
-                if sock == client_socket:
-                    self.connections.pop(station_id, None)
-                    self.command_sockets.pop(station_id, None)
-                    break
-            client_socket.close()
+    def on_station_disconnect(self, channel):
+        # Удаляем соединение при отключении
+        owner = self.connections.unregister(channel)
+        self.commands.unregister(channel)
+        if owner and owner[1] == COMMAND:
+            self.bus.release(owner[0])
 
-    def process_station_request(self, request, client_socket):
+    def on_station_evicted(self, station_id, channels):
+        for channel in channels:
+            self.commands.unregister(channel)
+        self.bus.release(station_id)
+
+    def process_station_request(self, request, channel):
         action = request.get("action")
         station_id = request.get("station_id")
 
         if action == "init":
             print(f"New connection from Station(id={station_id})")
-            return self.init_station(station_id, client_socket)
+            return self.init_station(station_id, channel)
         elif action == "heartbeat":
             return self.update_heartbeat(station_id)
         elif action == "get_status":
@@ -97,30 +146,21 @@ class ChargingServer:
             return self.update_charging_session(station_id, user_id, session_id, energy_consumed)
         elif action == "register_command":
             # Регистрируем отдельное соединение для команд
-            self.command_sockets[station_id] = client_socket
+            self.connections.register(station_id, channel, COMMAND)
+            self.commands.register(station_id, channel, acks=request.get(ACKS_CAPABILITY) is True)
+            self.bus.claim(station_id)
+            self.balancer.resync(station_id)
             return {"status": "success", "message": "Command channel registered"}
+        elif action == ACK_ACTION:
+            # Подтверждение команды - без ответа
+            self.commands.acknowledge(
+                request.get("command_id"), request.get("status") == "success", request.get("message")
+            )
+            return None
         else:
             return {"status": "error", "message": "Unknown action"}
 
-    def handle_api_client(self, client_socket, addr):
-        try:
-            while True:
-                data = client_socket.recv(1024)
-                if not data:
-                    break
-                try:
-                    request = json.loads(data.decode('utf-8'))
-                    response = self.process_api_request(request)
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-                except json.JSONDecodeError:
-                    response = {"status": "error", "message": "Invalid JSON"}
-                    client_socket.sendall(json.dumps(response).encode('utf-8'))
-        except ConnectionResetError:
-            print(f"API client {addr} disconnected")
-        finally:
-            client_socket.close()
-
-    def process_api_request(self, request):
+    def process_api_request(self, request, channel=None):
         action = request.get("action")
         station_id = request.get("station_id")
         user_id = request.get("user_id")
@@ -131,11 +171,44 @@ class ChargingServer:
             return self.stop_charging(station_id, user_id)
         elif action == "get_status":
             return self.get_station_status(station_id)
+        elif action == "pool_stats":
+            return {
+                "status": "success",
+                "pool": self.db_pool.stats(),
+                "station_cache": self.station_cache.stats(),
+                "commands": self.commands.stats(),
+                "connections": self.connections.stats(),
+                "gateway_bus": self.bus.stats(),
+                "tariffs": self.tariffs.stats(),
+                "meter_series": self.meter_series.stats(),
+            }
+        elif action == "bulk_command":
+            # {"command": "set_power", "power": 7.4, "selector": {"filter": {"status": "busy"}}}
+            try:
+                return self.fleet.execute(
+                    request.get("command"), request.get("selector"),
+                    power=request.get("power"), user_id=user_id, deadline=request.get("deadline"),
+                )
+            except (ValueError, TypeError, KeyError) as e:
+                return {"status": "error", "message": str(e)}
+        elif action == "reload_tariffs":
+            self.tariffs.reload()
+            return {"status": "success"}
+        elif action == "load_status":
+            return {"status": "success", **self.balancer.stats()}
+        elif action == "set_feeder_budget":
+            return self.set_feeder_budget(request.get("feeder_id"), request.get("power_budget"))
+        elif action == "last_seen":
+            last_seen = self.liveness.last_seen(station_id)
+            return {
+                "status": "success",
+                "last_seen": last_seen.strftime("%Y-%m-%d %H:%M:%S") if last_seen else None
+            }
         else:
             return {"status": "error", "message": "Unknown action"}
 
 
-    def init_station(self, station_id, client_socket):
+    def init_station(self, station_id, channel):
         conn = self.db_pool.getconn()
         try:
             with conn.cursor() as cur:
@@ -187,7 +260,7 @@ class ChargingServer:
                 
                 conn.commit()
             
-            self.connections[station_id] = client_socket
+            self.connections.register(station_id, channel)
             return response
         except Exception as e:
             return {"status": "error", "message": str(e)}
@@ -195,128 +268,97 @@ class ChargingServer:
             self.db_pool.putconn(conn)
 
     def update_heartbeat(self, station_id):
-        conn = self.db_pool.getconn()
-        try:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE charging_stations SET last_connection=%s WHERE id=%s",
-                    (datetime.now(), station_id)
-                )
-                conn.commit()
-                return {"status": "success"}
-        except Exception as e:
-            return {"status": "error", "message": str(e)}
-        finally:
-            self.db_pool.putconn(conn)
+        self.liveness.record(station_id)
+        self.connections.touch(station_id)
+        return {"status": "success"}
 
     def update_charging_session(self, station_id, user_id, session_id, energy_consumed):
-        conn = self.db_pool.getconn()
+        # Время последнего соединения обновляется через таблицу живости
+        self.liveness.record(station_id)
+        self.connections.touch(station_id)
+        # Стоимость растет на каждом кадре, без пересчета по истории сессии
+        meter = self.tariffs.update(station_id, session_id, energy_consumed) if session_id is not None else None
+        # Сессия обновляется фоновым потоком вместе с другими показаниями
+        cost, metered_at = (meter.cost, meter.metered_at) if meter else (None, None)
+        accepted = self.ingestor.submit(station_id, user_id, session_id, energy_consumed, cost, metered_at)
+        self.meter_series.record(station_id, session_id, user_id, energy_consumed)
+        return {"status": "success", "accepted": accepted}
+
+
+    def get_station_status(self, station_id):
         try:
-            with conn.cursor() as cur:
-                # Обновляем время последнего соединения и потребленную энергию
-                cur.execute(
-                    """UPDATE charging_stations 
-                    SET last_connection=%s 
-                    WHERE id=%s""",
-                    (datetime.now(), station_id)
-                )
-                
-                # Обновляем сессию
-                cur.execute(
-                    """UPDATE sessions SET 
-                    energy_consumed=%s
-                    WHERE station_id=%s AND user_id=%s AND id=%s""",
-                    (energy_consumed, station_id, user_id, session_id)
-                )
-                
-                conn.commit()
-                return {"status": "success"}
+            state = self.station_cache.get(station_id)
+            if state:
+                return {
+                    "status": "success", 
+                    "station_status": state["status"]
+                }
+            return {"status": "error", "message": "Station not found"}
         except Exception as e:
-            conn.rollback()
             return {"status": "error", "message": str(e)}
-        finally:
-            self.db_pool.putconn(conn)
-
 
-    def get_station_status(self, station_id):
+    def start_charging(self, station_id, user_id):
+        if not self.bus.is_connected(station_id):
+            return {"status": "error", "message": "Station is not connected"}
         conn = self.db_pool.getconn()
         try:
             with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT status FROM charging_stations WHERE id=%s",
-                    (station_id,)
-                )
-                result = cur.fetchone()
-                if result:
-                    return {
-                        "status": "success", 
-                        "station_status": result[0]
-                    }
-                return {"status": "error", "message": "Station not found"}
+                # Проверка, смена статуса и создание сессии - один вызов функции в БД
+                started = start_session(cur, self.station_cache, self.tariffs, station_id, user_id)
+                conn.commit()
         except Exception as e:
+            conn.rollback()
             return {"status": "error", "message": str(e)}
         finally:
             self.db_pool.putconn(conn)
-
-    def start_charging(self, station_id, user_id):
+        
+        if started["result"] == NO_STATION:
+            return {"status": "error", "message": "Station not found"}
+        if started["result"] == UNAVAILABLE:
+            return {"status": "error", "message": f"Station is {started['previous_status']}"}
+        if started["result"] == RESERVED_BY_OTHER:
+            return {"status": "error", "message": "Station is reserved by other user"}
+        session_id = started["session_id"]
+        status = started["previous_status"]
+        self.station_cache.apply(station_id, status='busy', using_by=user_id)
+        
+        # Отправляем команду станции начать зарядку; соединение с БД
+        # уже возвращено в пул и не держится на время ожидания
+        result = self.send_command_to_station(station_id, {
+            "action": "start_charging",
+            "session_id": session_id,
+            "status": "busy",
+            "user_id": user_id,
+        }, timeout=self.command_deadline)
+        if result["status"] == ACK:
+            return {
+                "status": "success",
+                "session_id": session_id,
+                "message": "Charging started"
+            }
+        if result["status"] in (NOT_CONNECTED, NACK, EXPIRED):
+            # Станция отказалась или не подтвердила команду до ее срока
+            self.cancel_started_session(station_id, session_id, status)
+            return {"status": "error", "message": result["message"] or "Station rejected the command"}
+        return {
+            "status": "pending",
+            "session_id": session_id,
+            "message": "Station has not confirmed the command yet",
+            "command_id": result["command_id"],
+        }
+
+    def cancel_started_session(self, station_id, session_id, status):
+        """Откатывает запуск зарядки, который станция не приняла"""
         conn = self.db_pool.getconn()
         try:
             with conn.cursor() as cur:
-                # Проверяем статус станции
-                cur.execute(
-                    "SELECT status, power_consumption, reserved_by FROM charging_stations WHERE id=%s FOR UPDATE",
-                    (station_id,)
-                )
-                result = cur.fetchone()
-                
-                if not result:
-                    return {"status": "error", "message": "Station not found"}
-                
-                status = result[0]
-                power_consumption = result[1]
-                reserved_by = result[2]
-                if status.strip() not in ['free', 'reserved']:
-                    return {"status": "error", "message": f"Station is {status}"}
-                elif status == 'reserved':
-                    if int(user_id) != int(reserved_by):
-                        return {"status": "error", "message": f"Station is reserved by other user"}
-                elif status == 'busy':
-                    if int(user_id) != int(reserved_by):
-                        return {"status": "error", "message": f"Station is used by other user"}
-                    return {"status": "error", "message": f"Charging is already start"}
-                # Обновляем статус
-                cur.execute(
-                    "UPDATE charging_stations SET status='busy', using_by=%s WHERE id=%s",
-                    (user_id, station_id,)
-                )
-
-
-                # Создаем запись о сессии
-                cur.execute(
-                    """INSERT INTO sessions (station_id, user_id, start_time, initial_electricity_meter)
-                    VALUES (%s, %s, %s, %s) RETURNING id""",
-                    (station_id, user_id, datetime.now(), power_consumption)
-                )
-                session_id = cur.fetchone()[0]
-                
+                cancelled = cancel_session(cur, self.station_cache, self.tariffs, station_id, session_id, status)
                 conn.commit()
-                
-                # Отправляем команду станции начать зарядку
-                self.send_command_to_station(station_id, {
-                    "action": "start_charging",
-                    "session_id": session_id,
-                    "status": "busy",
-                    "user_id": user_id,
-                })
-                
-                return {
-                    "status": "success",
-                    "session_id": session_id,
-                    "message": "Charging started"
-                }
+            if cancelled:
+                self.station_cache.apply(station_id, status=status, using_by=None)
         except Exception as e:
             conn.rollback()
-            return {"status": "error", "message": str(e)}
+            print(f"Error cancelling session {session_id}: {e}")
         finally:
             self.db_pool.putconn(conn)
 
@@ -324,88 +366,50 @@ class ChargingServer:
         conn = self.db_pool.getconn()
         try:
             with conn.cursor() as cur:
-                # Проверяем статус станции
-                cur.execute(
-                    "SELECT status, power, using_by FROM charging_stations WHERE id=%s",
-                    (station_id,)
-                )
-                result = cur.fetchone()
-                power = result[1]
-                using_by = result[2]
-                if not result:
-                    return {"status": "error", "message": "Station not found"}
-                
-                if result[0] != 'busy':
-                    return {"status": "error", "message": "Station is not charging"}
-                
-                if user_id != using_by:
-                    return {"status": "error", "message": "Station in use by other user"}
-                
-                cur.execute(
-                    """
-                    SELECT initial_electricity_meter, start_time FROM sessions WHERE
-                    station_id = %s AND user_id = %s AND end_time IS NULL
-                    """, (station_id, user_id)
-                )
-                
-                result = cur.fetchone()
-                if not result:
-                    return {"status": "error", "message": "Session not found"}
-                
-                initial_electricity_meter = result[0]
-                start_time = result[1]
-                
-                
-                duration = (datetime.now() - start_time).total_seconds()
-                energy_consumed = float(power) * (duration / 3600)
-                # Обновляем статус
-                cur.execute(
-                    """UPDATE charging_stations 
-                    SET status='free', reserved_by=NULL, using_by=NULL, power_consumption=power_consumption+%s 
-                    WHERE id=%s""",
-                    (energy_consumed, station_id)
-                )
-                
-                # Обновляем сессию
-                cur.execute(
-                    """UPDATE sessions SET 
-                    end_time=%s, 
-                    energy_consumed=%s, 
-                    end_electricity_meter=%s
-                    WHERE station_id=%s AND user_id=%s AND end_time IS NULL""",
-                    (datetime.now(), energy_consumed, initial_electricity_meter+energy_consumed,  station_id, user_id)
-                )
-                
+                # Проверка, закрытие сессии и освобождение станции - один вызов функции в БД
+                stopped = stop_session(cur, self.station_cache, self.ingestor, self.tariffs, station_id, user_id)
                 conn.commit()
-                
-                # Отправляем команду станции остановить зарядку
-                self.send_command_to_station(station_id, {
-                    "action": "stop_charging",
-                    "user_id": user_id,
-                })
-                
-                return {"status": "success", "message": "Charging stopped"}
         except Exception as e:
             conn.rollback()
             return {"status": "error", "message": str(e)}
         finally:
             self.db_pool.putconn(conn)
-
-    def send_command_to_station(self, station_id, command):
-        """Отправляет команду на станцию через отдельное соединение"""
-        try:
-            if station_id in self.command_sockets:
-                sock = self.command_sockets[station_id]
-                sock.sendall(json.dumps(command).encode('utf-8'))
-                return True
-            else:
-                print(f"No command socket for station {station_id}")
-                return False
-        except Exception as e:
-            print(f"Error sending command to station {station_id}: {e}")
-            # Удаляем нерабочее соединение
-            self.command_sockets.pop(station_id, None)
-            return False
+        
+        if stopped["result"] == NO_STATION:
+            return {"status": "error", "message": "Station not found"}
+        if stopped["result"] == NOT_CHARGING:
+            return {"status": "error", "message": "Station is not charging"}
+        if stopped["result"] == NO_SESSION:
+            return {"status": "error", "message": "Session not found"}
+        self.station_cache.apply(station_id, status='free', reserved_by=None, using_by=None)
+        self.meter_series.end_session(stopped["session_id"])
+        
+        # Отправляем команду станции остановить зарядку. Сессия уже закрыта,
+        # без подтверждения к сроку команда снимается
+        result = self.send_command_to_station(station_id, {
+            "action": "stop_charging",
+            "user_id": user_id,
+        }, timeout=self.command_deadline)
+        if result["status"] != ACK:
+            return {
+                "status": "success",
+                "message": "Charging stopped, station has not confirmed",
+                "cost": stopped["cost"],
+                "command_id": result["command_id"],
+            }
+        return {"status": "success", "message": "Charging stopped", "cost": stopped["cost"]}
+
+    def send_command_to_station(self, station_id, command, timeout=None):
+        """Ставит команду в очередь станции (на любом шлюзе); с timeout ждет подтверждения и возвращает итог"""
+        if timeout is None:
+            pending = self.bus.dispatch(station_id, command)
+            if pending.done and not pending.acknowledged:
+                print(f"Command to station {station_id} failed: {pending.result['message']}")
+            return pending.result
+        result = self.bus.send(station_id, command, timeout)
+        if result["status"] != ACK:
+            print(f"Command to station {station_id} not confirmed: {result['message']}")
+        return result
 
     def command_interface(self):
         """Интерфейс для ввода команд оператором"""
@@ -453,7 +457,8 @@ class ChargingServer:
                 print("\nConnected stations:")
                 for station in stations:
                     connected = "Yes" if station[0] in self.connections else "No"
-                    print(f"ID: {station[0]}, Power: {station[1]} kW, Status: {station[2]}, Connected: {connected}")
+                    last_seen = self.liveness.last_seen(station[0])
+                    print(f"ID: {station[0]}, Power: {station[1]} kW, Status: {station[2]}, Connected: {connected}, Last seen: {last_seen}")
         finally:
             self.db_pool.putconn(conn)
 
@@ -543,8 +548,16 @@ class ChargingServer:
                     "UPDATE charging_stations SET power=%s WHERE id=%s",
                     (power, station_id)
                 )
+                self.station_cache.notify(cur, station_id, power=power)
                 conn.commit()
-                
+                self.station_cache.apply(station_id, power=power)
+
+                if self.balancer.balances(station_id):
+                    # Идет сессия: мощность - запрос, станции ушла выделенная доля
+                    print(f"Power for station {station_id} set to {power} kW, "
+                          f"allocated {self.balancer.allocation(station_id)} kW")
+                    return
+
                 # Отправляем команду на обновление мощности
                 self.send_command_to_station(station_id, {
                     "action": "set_power",
@@ -557,6 +570,45 @@ class ChargingServer:
         finally:
             self.db_pool.putconn(conn)
 
+    def set_feeder_budget(self, feeder_id, power_budget):
+        try:
+            power_budget = float(power_budget)
+            if feeder_id is not None:
+                conn = self.db_pool.getconn()
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "UPDATE feeders SET power_budget=%s WHERE id=%s",
+                            (power_budget, feeder_id)
+                        )
+                        if cur.rowcount == 0:
+                            return {"status": "error", "message": "Feeder not found"}
+                        conn.commit()
+                finally:
+                    self.db_pool.putconn(conn)
+            # Без feeder_id - общий бюджет площадки (до перезапуска, см. SITE_POWER_BUDGET)
+            self.balancer.set_budget(feeder_id, power_budget)
+            return {"status": "success", "feeder_id": feeder_id, "power_budget": power_budget}
+        except (TypeError, ValueError):
+            return {"status": "error", "message": "power_budget must be a number"}
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
+    def bulk_set_power_ui(self):
+        ids = input("Enter station IDs separated by commas (empty - by status): ").strip()
+        if ids:
+            selector = {"ids": [int(station_id) for station_id in ids.split(",")]}
+        else:
+            selector = {"filter": {"status": input("Enter station status: ").strip()}}
+        power = float(input("Enter new power (kW): "))
+        
+        response = self.fleet.execute("set_power", selector, power=power)
+        print(f"Stations matched: {response['matched']}")
+        for status, count in response["summary"].items():
+            print(f"{status}: {count}")
+        print(f"Ack latency, ms: {response['latency_ms']}")
+        print(f"DB: {response['db_ms']} ms, total: {response['total_ms']} ms")
+
     def get_station_status_ui(self, station_id):
         response = self.get_station_status(station_id)
         if response["status"] == "success":
@@ -567,60 +619,28 @@ class ChargingServer:
             print(f"Error: {response['message']}")
 
     def start(self):
-        # Запускаем сервер для станций
-        self.station_socket.bind((self.station_host, self.station_port))
-        self.station_socket.listen(5)
-        print(f"Station server listening on {self.station_host}:{self.station_port}")
-
-        # Запускаем сервер для API команд
-        self.api_socket.bind((self.api_host, self.api_port))
-        self.api_socket.listen(5)
-        print(f"API command server listening on {self.api_host}:{self.api_port}")
-
-        # Поток для обработки соединений от станций
-        station_thread = threading.Thread(
-            target=self.accept_station_connections,
-            daemon=True
+        # Сервер для станций и сервер для API команд работают в одном
+        # цикле событий шлюза
+        self.gateway.add_listener(
+            self.station_host, self.station_port,
+            self.process_station_request, self.on_station_disconnect, name='station'
         )
-        station_thread.start()
-
-        # Поток для обработки API команд
-        api_thread = threading.Thread(
-            target=self.accept_api_connections,
-            daemon=True
+        self.gateway.add_listener(
+            self.api_host, self.api_port, self.process_api_request, name='API'
         )
-        api_thread.start()
+        self.liveness.start()
+        self.ingestor.start()
+        self.meter_series.start()
+        self.station_cache.start()
+        self.commands.start()
+        self.connections.start()
+        self.bus.start()
+        self.balancer.load()
+        self.gateway.start()
 
         # Основной поток для командного интерфейса
         self.command_interface()
 
-    def accept_station_connections(self):
-            try:
-                while True:
-                    client_socket, addr = self.station_socket.accept()
-                    client_thread = threading.Thread(
-                        target=self.handle_station_client,
-                        args=(client_socket, addr),
-                        daemon=True
-                    )
-                    client_thread.start()
-            except KeyboardInterrupt:
-                print("Shutting down station server...")
-
-    def accept_api_connections(self):
-        try:
-            while True:
-                client_socket, addr = self.api_socket.accept()
-                client_thread = threading.Thread(
-                    target=self.handle_api_client,
-                    args=(client_socket, addr),
-                    daemon=True
-                )
-                client_thread.start()
-        except KeyboardInterrupt:
-            print("Shutting down API server...")  
-
-
     def command_interface(self):
         """Интерфейс для ввода команд оператором"""
         while True:
@@ -630,11 +650,14 @@ class ChargingServer:
             print("3. Stop charging on station")
             print("4. Set station power")
             print("5. Get station status")
-            print("6. Exit")
+            print("6. Database pool stats")
+            print("7. Bulk set power")
+            print("8. Load balancing status")
+            print("9. Exit")
             
             try:
                 choice = input("Enter command number: ")
-                if choice == "6":
+                if choice == "9":
                     break
                 
                  # Для тестирования
@@ -656,6 +679,16 @@ class ChargingServer:
                 elif choice == "5":
                     station_id = int(input("Enter station ID: "))
                     self.get_station_status_ui(station_id)
+                elif choice == "6":
+                    for key, value in self.db_pool.stats().items():
+                        print(f"{key}: {value}")
+                elif choice == "7":
+                    self.bulk_set_power_ui()
+                elif choice == "8":
+                    stats = self.balancer.stats()
+                    for feeder_id, feeder in stats["feeders"].items():
+                        print(f"Feeder {feeder_id}: {feeder}")
+                    print(f"Commands sent: {stats['commands_sent']}, suppressed by hysteresis: {stats['suppressed']}")
                 else:
                     print("Invalid choice")
             except Exception as e:
@@ -665,8 +698,14 @@ class ChargingServer:
 
     def shutdown(self):
         print("Shutting down servers...")
-        self.station_socket.close()
-        self.api_socket.close()
+        self.gateway.stop()
+        self.connections.stop()
+        self.bus.stop()
+        self.commands.stop()
+        self.liveness.stop()
+        self.ingestor.stop()
+        self.meter_series.stop()
+        self.station_cache.stop()
         self.db_pool.closeall()    
 
 if __name__ == "__main__":
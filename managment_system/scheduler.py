@@ -0,0 +1,249 @@
+import bisect
+import math
+import os
+import threading
+
+# Разница, которую не считаем изменением мощности, кВт
+EPSILON_KW = 0.05
+
+
+class _Feeder:
+    __slots__ = ('budget', 'order', 'level')
+
+    def __init__(self, budget):
+        self.budget = budget  # кВт; 0 - без ограничения
+        self.order = []  # [(запрос, station_id)] по возрастанию запроса
+        self.level = math.inf  # уровень "заполнения": мощность выше него урезается
+
+
+class LoadBalancer:
+    """Распределение мощности фидера между заряжающимися станциями.
+
+    Бюджет фидера делится по принципу max-min: станции, которым нужно
+    меньше равной доли, получают свое, остаток поровну делится между
+    остальными. Запросы станций хранятся отсортированными, поэтому
+    пересчет при начале/окончании сессии - это вставка и один проход,
+    O(n log n) в худшем случае. Команда set_power уходит станции, только
+    если выделенная мощность снизилась или выросла больше полосы
+    гистерезиса: снижение отправляется всегда, чтобы не превысить бюджет.
+    """
+
+    def __init__(self, db_pool, commands, default_budget=None, hysteresis_kw=None, hysteresis_pct=None):
+        self.db_pool = db_pool
+        self.commands = commands
+        # Станции без фидера делят общий бюджет площадки
+        self.default_budget = float(default_budget or os.getenv('SITE_POWER_BUDGET', 0))
+        self.hysteresis_kw = float(hysteresis_kw or os.getenv('LOAD_HYSTERESIS_KW', 0.5))
+        self.hysteresis_pct = float(hysteresis_pct or os.getenv('LOAD_HYSTERESIS_PCT', 0.05))
+
+        self._lock = threading.RLock()
+        self._feeders = {None: _Feeder(self.default_budget)}  # {feeder_id: _Feeder}
+        self._stations = {}  # {station_id: (feeder_id, запрос кВт)}
+        self._active = set()
+        self._allocations = {}  # {station_id: выделено кВт}
+        self._sent = {}  # {station_id: последняя отправленная станции мощность}
+
+        self.rebalances = 0
+        self.commands_sent = 0
+        self.suppressed = 0
+
+    def load(self):
+        """Бюджеты фидеров и текущие сессии из БД"""
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id, power_budget FROM feeders")
+                feeders = cur.fetchall()
+                cur.execute("SELECT id, feeder_id, power FROM charging_stations WHERE status='busy'")
+                busy = cur.fetchall()
+        finally:
+            self.db_pool.putconn(conn)
+
+        with self._lock:
+            for feeder_id, budget in feeders:
+                self._feeders[feeder_id] = _Feeder(float(budget or 0))
+            for station_id, feeder_id, power in busy:
+                self._stations[station_id] = (feeder_id, float(power or 0))
+                self._sent.setdefault(station_id, float(power or 0))
+                self._insert(station_id)
+            changes = [change for feeder_id in self._feeders for change in self._rebalance(feeder_id)]
+        self._send(changes)
+
+    def _station(self, station_id):
+        info = self._stations.get(station_id)
+        if info is not None:
+            return info
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT feeder_id, power FROM charging_stations WHERE id=%s", (station_id,))
+                row = cur.fetchone()
+        finally:
+            self.db_pool.putconn(conn)
+        if row is None:
+            return None
+        info = (row[0], float(row[1] or 0))
+        self._stations[station_id] = info
+        return info
+
+    def _feeder(self, feeder_id):
+        feeder = self._feeders.get(feeder_id)
+        if feeder is None:
+            # Фидер без записи в feeders - без ограничения
+            feeder = self._feeders[feeder_id] = _Feeder(0.0)
+        return feeder
+
+    def _insert(self, station_id):
+        feeder_id, demand = self._stations[station_id]
+        if station_id in self._active:
+            return
+        self._active.add(station_id)
+        bisect.insort(self._feeder(feeder_id).order, (demand, station_id))
+
+    def _remove(self, station_id):
+        if station_id not in self._active:
+            return None
+        self._active.discard(station_id)
+        self._allocations.pop(station_id, None)
+        feeder_id, demand = self._stations[station_id]
+        order = self._feeder(feeder_id).order
+        index = bisect.bisect_left(order, (demand, station_id))
+        if index < len(order) and order[index][1] == station_id:
+            del order[index]
+        return feeder_id
+
+    def _rebalance(self, feeder_id):
+        """Пересчитывает фидер; возвращает [(station_id, мощность)] для отправки"""
+        feeder = self._feeder(feeder_id)
+        order = feeder.order
+        level = math.inf
+        if feeder.budget > 0:
+            remaining = feeder.budget
+            for i, (demand, _) in enumerate(order):
+                share = remaining / (len(order) - i)
+                if demand > share:
+                    level = share
+                    break
+                remaining -= demand
+        feeder.level = level
+        self.rebalances += 1
+
+        changes = []
+        for demand, station_id in order:
+            # Округляем вниз, чтобы сумма не вышла за бюджет
+            allocation = demand if demand <= level else math.floor(level * 10) / 10
+            self._allocations[station_id] = allocation
+            sent = self._sent.get(station_id, demand)
+            if allocation < sent - EPSILON_KW:
+                changes.append((station_id, allocation))
+            elif allocation - sent > max(self.hysteresis_kw, self.hysteresis_pct * sent):
+                changes.append((station_id, allocation))
+            elif abs(allocation - sent) > EPSILON_KW:
+                self.suppressed += 1
+        return changes
+
+    def _send(self, changes):
+        for station_id, power in changes:
+            pending = self.commands.dispatch(station_id, {"action": "set_power", "power": power})
+            if pending.done and not pending.acknowledged:
+                continue
+            with self._lock:
+                self._sent[station_id] = power
+                self.commands_sent += 1
+
+    def session_started(self, station_id):
+        with self._lock:
+            info = self._station(station_id)
+            if info is None:
+                return
+            self._sent.setdefault(station_id, info[1])
+            self._insert(station_id)
+            changes = self._rebalance(info[0])
+        self._send(changes)
+
+    def session_stopped(self, station_id):
+        with self._lock:
+            if station_id not in self._active:
+                return
+            feeder_id = self._remove(station_id)
+            changes = self._rebalance(feeder_id)
+        self._send(changes)
+
+    def set_demand(self, station_id, power):
+        """Номинальная мощность станции изменена оператором.
+
+        Заряжающейся станции новая мощность - только запрос: команду с
+        выделенной долей отправляет балансировщик (True), сырую мощность
+        ей слать нельзя. Простаивающей станции мощность отправляет вызывающий.
+        """
+        with self._lock:
+            info = self._station(station_id)
+            if info is None:
+                return False
+            active = self._remove(station_id) is not None
+            self._stations[station_id] = (info[0], float(power))
+            if not active:
+                self._sent[station_id] = float(power)
+                return False
+            self._insert(station_id)
+            changes = self._rebalance(info[0])
+            # Оператор ждет применения: долю самой станции отправляем и внутри гистерезиса
+            allocation = self._allocations[station_id]
+            if (all(changed != station_id for changed, _ in changes)
+                    and abs(allocation - self._sent.get(station_id, allocation)) > EPSILON_KW):
+                changes.append((station_id, allocation))
+        self._send(changes)
+        return True
+
+    def set_budget(self, feeder_id, budget):
+        with self._lock:
+            self._feeder(feeder_id).budget = float(budget)
+            changes = self._rebalance(feeder_id)
+        self._send(changes)
+
+    def resync(self, station_id):
+        """Станция переподключилась с номинальной мощностью - повторяем ее долю"""
+        with self._lock:
+            info = self._stations.get(station_id)
+            if info is None:
+                return
+            self._sent[station_id] = info[1]
+            if station_id not in self._active:
+                return
+            changes = self._rebalance(info[0])
+        self._send(changes)
+
+    def on_state_change(self, station_id, fields):
+        """Подписчик кэша состояния станций: начало/конец сессий и ручная смена мощности"""
+        if 'power' in fields and fields['power'] is not None:
+            self.set_demand(station_id, fields['power'])
+        if 'status' in fields:
+            if fields['status'] == 'busy':
+                self.session_started(station_id)
+            else:
+                self.session_stopped(station_id)
+
+    def balances(self, station_id):
+        """Мощность станции задает балансировщик (идет сессия)"""
+        return station_id in self._active
+
+    def allocation(self, station_id):
+        return self._allocations.get(station_id)
+
+    def stats(self):
+        with self._lock:
+            feeders = {
+                str(feeder_id): {
+                    'budget': feeder.budget,
+                    'stations': len(feeder.order),
+                    'allocated': round(sum(self._allocations.get(sid, 0) for _, sid in feeder.order), 1),
+                    'level': None if math.isinf(feeder.level) else round(feeder.level, 2),
+                }
+                for feeder_id, feeder in self._feeders.items()
+            }
+        return {
+            'feeders': feeders,
+            'rebalances': self.rebalances,
+            'commands_sent': self.commands_sent,
+            'suppressed': self.suppressed,
+        }
@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Скрипты импортируют соседние модули без пакета (auth, fleet, ...) - как при запуске
+for path in ('', 'backend', 'managment_system', 'controller', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+# Тесты с БД работают в отдельной базе на прогон: пулы, созданные модулями
+# при импорте, берут DB_NAME из окружения, поэтому подменяем его до импорта
+ADMIN_DB = os.getenv('DB_NAME', 'postgres')
+TEST_DB = f'test_greentech_{uuid.uuid4().hex[:8]}'
+os.environ['DB_NAME'] = TEST_DB
+
+# Таблицы, которых нет в init_db ни одного из серверов (создаются вручную при развертывании)
+BASE_SCHEMA = '''
+    CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(100),
+        email VARCHAR(100) UNIQUE NOT NULL,
+        password VARCHAR(255) NOT NULL,
+        phone VARCHAR(20),
+        balance DECIMAL(10, 2) DEFAULT 0,
+        photo_url VARCHAR(255)
+    );
+    CREATE TABLE charging_stations (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(100),
+        address VARCHAR(255),
+        latitude FLOAT,
+        longitude FLOAT,
+        connector_type VARCHAR(50),
+        current_type VARCHAR(10),
+        power FLOAT,
+        status VARCHAR(20) DEFAULT 'free',
+        photo_url VARCHAR(255),
+        tariff_id INTEGER,
+        reserved_by INTEGER REFERENCES users(id),
+        using_by INTEGER REFERENCES users(id),
+        last_connection TIMESTAMP,
+        power_consumption FLOAT DEFAULT 0
+    );
+    CREATE TABLE sessions (
+        id SERIAL PRIMARY KEY,
+        station_id INTEGER REFERENCES charging_stations(id),
+        user_id INTEGER REFERENCES users(id),
+        start_time TIMESTAMP NOT NULL,
+        end_time TIMESTAMP,
+        energy_consumed FLOAT,
+        initial_electricity_meter FLOAT NOT NULL,
+        end_electricity_meter FLOAT
+    );
+    CREATE TABLE feeders (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(100),
+        power_budget FLOAT NOT NULL
+    );
+    ALTER TABLE charging_stations ADD COLUMN feeder_id INTEGER REFERENCES feeders(id);
+'''
+
+
+@pytest.fixture(scope='session')
+def database():
+    """Пустая база на время прогона; без PostgreSQL (DB_* в окружении) тесты с БД пропускаются"""
+    psycopg2 = pytest.importorskip('psycopg2')
+    from common.db import db_config
+
+    config = {**db_config(), 'database': ADMIN_DB}
+    try:
+        admin = psycopg2.connect(connect_timeout=3, **config)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'PostgreSQL is not available: {e}')
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f'CREATE DATABASE {TEST_DB}')
+
+    conn = psycopg2.connect(**{**config, 'database': TEST_DB})
+    try:
+        with conn.cursor() as cur:
+            cur.execute(BASE_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+    from common.db import DatabasePool
+    pool = DatabasePool(minconn=1, maxconn=10)
+    with pool.connection() as conn, conn.cursor() as cur:
+        from common.charging import install
+        from common.ledger import init_db as init_ledger
+        from common.reservations import ReservationEngine
+        from common.tariffs import TariffEngine
+        from common.timeseries import MeterSeries
+
+        ReservationEngine(pool, None).init_db(cur)
+        init_ledger(cur)
+        TariffEngine(pool).init_db(cur)
+        MeterSeries(pool).init_db(cur)
+        install(cur)
+        conn.commit()
+    pool.closeall()
+
+    yield pool.db_config
+
+    with admin.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS {TEST_DB} WITH (FORCE)')
+    admin.close()
+
+
+@pytest.fixture
+def db_pool(database):
+    """Пул к тестовой базе; все таблицы очищаются перед каждым тестом"""
+    from common.db import DatabasePool
+
+    pool = DatabasePool(minconn=1, maxconn=10)
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT string_agg(quote_ident(tablename), ', ') FROM pg_tables
+            WHERE schemaname = 'public' AND tablename NOT LIKE 'meter_samples_%%'
+        ''')
+        cur.execute(f'TRUNCATE {cur.fetchone()[0]} RESTART IDENTITY CASCADE')
+        conn.commit()
+    yield pool
+    pool.closeall()
+
+
+@pytest.fixture
+def make_user(db_pool):
+    def make(balance=0, email=None):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'INSERT INTO users (name, email, password, balance) VALUES (%s, %s, %s, %s) RETURNING id',
+                ('Test user', email or f'{uuid.uuid4().hex[:10]}@example.com', 'x', balance)
+            )
+            user_id = cur.fetchone()[0]
+            conn.commit()
+        return user_id
+    return make
+
+
+@pytest.fixture
+def make_station(db_pool):
+    def make(status='free', power=22.0, latitude=55.75, longitude=37.62, feeder_id=None, **columns):
+        values = {'name': 'Test station', 'status': status, 'power': power, 'latitude': latitude,
+                  'longitude': longitude, 'connector_type': 'Type 2', 'current_type': 'AC',
+                  'feeder_id': feeder_id, **columns}
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"INSERT INTO charging_stations ({', '.join(values)}) "
+                f"VALUES ({', '.join(['%s'] * len(values))}) RETURNING id",
+                list(values.values())
+            )
+            station_id = cur.fetchone()[0]
+            conn.commit()
+        return station_id
+    return make
+
+
+@pytest.fixture(scope='session')
+def backend(database):
+    """Модуль API-сервера на тестовой базе со всеми его таблицами"""
+    import backend
+
+    backend.init_db()
+    return backend
+
+
+@pytest.fixture
+def client(db_pool, backend):
+    """HTTP-клиент API; кэши процесса сбрасываются вместе с таблицами"""
+    backend.station_cache.invalidate()
+    backend.user_cache.invalidate()
+    backend.station_index.loaded = False
+    return backend.app.test_client()
+
+
+class FakeChannel:
+    """Командное соединение станции: запоминает команды и сразу подтверждает их"""
+
+    def __init__(self, dispatcher, ack=True):
+        self.dispatcher = dispatcher
+        self.ack = ack
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        if self.ack and 'command_id' in message:
+            self.dispatcher.acknowledge(message['command_id'], ok=self.ack is True,
+                                        message=None if self.ack is True else 'Rejected')
+
+
+@pytest.fixture
+def dispatcher():
+    from common.commands import CommandDispatcher
+
+    commands = CommandDispatcher(ack_timeout=0.2, max_attempts=2)
+    commands.start()
+    yield commands
+    commands.stop()
+
+
+@pytest.fixture
+def fake_channel():
+    return FakeChannel
+
+
+def drain(dispatcher, timeout=2.0):
+    """Ждет, пока диспетчер разошлет все поставленные команды"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = dispatcher.stats()
+        if not stats['queued'] and not stats['inflight']:
+            return
+        time.sleep(0.005)
+    raise AssertionError('dispatcher did not drain')
+
+
+def wait_listening(db_pool, channel, listeners=1, timeout=5.0):
+    """NotifyListener подписывается в своем потоке - ждем, пока выполнятся все LISTEN канала"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND query = %s',
+                (f'LISTEN {channel}',)
+            )
+            if cur.fetchone()[0] >= listeners:
+                return
+        time.sleep(0.02)
+    raise AssertionError(f'no listener on {channel}')
+
+
+def eventually(check, timeout=3.0):
+    """Ждет, пока check() вернет истину (уведомления доставляются асинхронно)"""
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition was not met in time')
+        time.sleep(0.01)
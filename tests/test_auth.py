@@ -0,0 +1,162 @@
+import time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+jwt = pytest.importorskip('jwt')
+
+from conftest import eventually, wait_listening  # noqa: E402
+from auth import USER_CHANNEL, TokenCache, UserCache  # noqa: E402
+from common.ledger import DEPOSIT, LedgerSettlement, post  # noqa: E402
+
+SECRET = 'test-secret-key-of-at-least-32-bytes'
+
+
+@pytest.fixture
+def user_cache(db_pool):
+    """Кэш с длинным ttl: свежие данные возможны только через уведомления"""
+    tokens = TokenCache(SECRET)
+    cache = UserCache(db_pool, ttl=600, on_credentials_change=tokens.forget_user)
+    cache.tokens = tokens
+    cache.start()
+    wait_listening(db_pool, USER_CHANNEL)
+    yield cache
+    cache.stop()
+    cache._listener._thread.join(2)  # следующий тест не должен застать этот LISTEN
+
+
+def test_profile_write_is_visible_on_next_read(db_pool, user_cache, make_user):
+    user_id = make_user()
+    assert user_cache.get(user_id)['name'] == 'Test user'
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE users SET name = 'Renamed' WHERE id = %s", (user_id,))
+        user_cache.notify(cur, user_id)
+        conn.commit()
+
+    eventually(lambda: user_cache.get(user_id)['name'] == 'Renamed')
+
+
+def test_profile_is_cached_without_notify(db_pool, user_cache, make_user):
+    user_id = make_user()
+    user_cache.get(user_id)
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE users SET name = 'Renamed' WHERE id = %s", (user_id,))
+        conn.commit()
+
+    assert user_cache.get(user_id)['name'] == 'Test user'
+    assert user_cache.stats()['hits'] == 1
+
+
+def test_credentials_change_forgets_cached_tokens(db_pool, user_cache, make_user):
+    user_id, other_id = make_user(), make_user()
+    tokens = user_cache.tokens
+    for uid in (user_id, other_id):
+        tokens.verify(jwt.encode({'user_id': uid, 'exp': time.time() + 60}, SECRET, algorithm='HS256'))
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        user_cache.notify(cur, user_id)
+        conn.commit()
+    assert tokens.stats()['size'] == 2  # профиль изменился, учетные данные - нет
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        user_cache.notify(cur, user_id, credentials=True)
+        conn.commit()
+    eventually(lambda: tokens.stats()['size'] == 1)
+
+
+def test_settlement_notifies_settled_users(db_pool, user_cache, make_user):
+    user_id = make_user()
+    user_cache.get(user_id)
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        post(cur, user_id, 100, DEPOSIT)
+        conn.commit()
+
+    assert LedgerSettlement(db_pool, on_settle=user_cache.notify_many).settle() == 1
+    eventually(lambda: user_cache.stats()['invalidations'] == 1)
+
+
+def test_deposit_is_visible_in_profile(client, backend, make_user):
+    user_id = make_user()
+    headers = {'Authorization': f'Bearer {backend.generate_token(user_id)}'}
+    assert client.get('/api/auth/me', headers=headers).get_json()['balance'] == 0
+
+    response = client.post('/api/balance/replenish', headers=headers, json={
+        'amount': 250, 'card_number': '4111111111111111', 'expiry_date': '12/30',
+        'cvv': '123', 'card_holder': 'TEST USER',
+    })
+
+    assert response.status_code == 200
+    assert response.get_json()['new_balance'] == 250
+    assert client.get('/api/auth/me', headers=headers).get_json()['balance'] == 250
+
+
+def test_deposit_rejects_non_positive_amount(client, backend, make_user):
+    headers = {'Authorization': f'Bearer {backend.generate_token(make_user())}'}
+    response = client.post('/api/balance/replenish', headers=headers, json={
+        'amount': -5, 'card_number': '4111111111111111', 'expiry_date': '12/30',
+        'cvv': '123', 'card_holder': 'TEST USER',
+    })
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('payload', [
+    {'email': 123, 'password': 'secret1'},
+    {'email': 'user@example.com', 'password': ['secret1']},
+    {'email': '   ', 'password': 'secret1'},
+    ['user@example.com', 'secret1'],
+])
+def test_login_rejects_malformed_credentials(client, payload):
+    response = client.post('/api/auth/login', json=payload, environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Email and password required'}
+
+
+def test_register_rejects_non_string_fields(client):
+    response = client.post('/api/auth/register', json={'name': 'A', 'email': 'a@example.com', 'password': 1234567},
+                           environ_base={'REMOTE_ADDR': '10.0.0.2'})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'password must be a non-empty string'}
+
+
+def test_register_then_login(client, backend):
+    address = {'REMOTE_ADDR': '10.0.0.3'}
+    # Входы с адреса исчерпали свой лимит - регистрация ограничивается отдельно
+    while not backend.login_ip_limiter.acquire('10.0.0.3'):
+        pass
+
+    registered = client.post('/api/auth/register', environ_base=address, json={
+        'name': 'New user', 'email': 'new@example.com', 'password': 'secret1',
+    })
+    assert registered.status_code == 201
+
+    logged_in = client.post('/api/auth/login', environ_base={'REMOTE_ADDR': '10.0.0.4'}, json={
+        'email': 'new@example.com', 'password': 'secret1',
+    })
+    assert logged_in.status_code == 200
+    assert logged_in.get_json()['user_id'] == registered.get_json()['user_id']
+
+
+def test_token_cache_skips_repeated_verification_and_rejects_bad_tokens():
+    tokens = TokenCache(SECRET, maxsize=2)
+    token = jwt.encode({'user_id': 7, 'exp': time.time() + 60}, SECRET, algorithm='HS256')
+
+    assert tokens.verify(token) == 7 and tokens.verify(token) == 7
+    assert tokens.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    with pytest.raises(jwt.InvalidTokenError):
+        tokens.verify(jwt.encode({'user_id': 7}, 'another-secret-of-at-least-32-bytes', algorithm='HS256'))
+    exp = int(time.time()) + 2  # jwt сравнивает exp в целых секундах
+    short = jwt.encode({'user_id': 8, 'exp': exp}, SECRET, algorithm='HS256')
+    assert tokens.verify(short) == 8
+    time.sleep(exp - time.time() + 0.05)
+    # Истекший токен отклоняется и из кэша, без повторного jwt.decode
+    with pytest.raises(jwt.ExpiredSignatureError):
+        tokens.verify(short)
+    assert tokens.stats()['size'] == 1
+
+
+def test_invalid_token_is_rejected_by_api(client):
+    assert client.get('/api/auth/me', headers={'Authorization': 'Bearer garbage'}).status_code == 401
@@ -0,0 +1,53 @@
+import argparse
+
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('dotenv')
+
+from bench import check, compare, save_json  # noqa: E402
+
+
+def report(p95, throughput=100.0, errors=0, requests=1000):
+    return {
+        'meta': {'size': '10k', 'concurrency': 16, 'duration': 30, 'commit': 'abc1234'},
+        'results': {
+            'stations_list': {'p50': p95 / 2, 'p95': p95, 'p99': p95 * 2, 'throughput': throughput,
+                              'errors': errors, 'requests': requests},
+        },
+    }
+
+
+OPTIONS = argparse.Namespace(threshold=0.10, min_delta=1.0)
+
+
+def test_noise_is_not_a_regression(tmp_path, capsys):
+    baseline = report(20.0)
+    # +5% и +0.5 мс на быстром запросе - в пределах порогов
+    assert compare(report(21.0), baseline, 0.10, 1.0) == []
+    assert compare(report(0.2), report(0.1), 0.10, 1.0) == []
+
+    path = tmp_path / 'baseline.json'
+    save_json(str(path), baseline)
+    assert check(report(21.0), str(path), OPTIONS) == 0
+    assert 'No regressions' in capsys.readouterr().out
+
+
+def test_slower_or_failing_run_fails_the_check(tmp_path, capsys):
+    baseline = report(20.0)
+    regressions = compare(report(30.0, throughput=80.0, errors=50), baseline, 0.10, 1.0)
+
+    assert regressions == [
+        'stations_list p50: 10.00 -> 15.00 ms',
+        'stations_list p95: 20.00 -> 30.00 ms',
+        'stations_list p99: 40.00 -> 60.00 ms',
+        'stations_list throughput: 100.0 -> 80.0 req/s',
+        'stations_list errors: 0.0% -> 5.0%',
+    ]
+
+    path = tmp_path / 'baseline.json'
+    save_json(str(path), baseline)
+    assert check(report(30.0), str(path), OPTIONS) == 1
+    assert 'commit abc1234' in capsys.readouterr().out
+    # Без базы сравнивать не с чем - проверка не падает
+    assert check(report(30.0), str(tmp_path / 'missing.json'), OPTIONS) == 0
@@ -0,0 +1,85 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.charging import (  # noqa: E402
+    NO_SESSION, NO_STATION, NOT_CHARGING, RESERVED_BY_OTHER, STARTED, STOPPED, UNAVAILABLE,
+    cancel_session, start_session, stop_session,
+)
+from common.ingest import EnergyIngestor  # noqa: E402
+from common.station_cache import StationStateCache  # noqa: E402
+from common.tariffs import TariffEngine  # noqa: E402
+
+
+@pytest.fixture
+def charging(db_pool):
+    """Транзакции запуска и остановки с зависимостями, как в backend.py"""
+    cache = StationStateCache(db_pool, ttl=600)
+    ingestor = EnergyIngestor(db_pool, flush_interval=60)
+    tariffs = TariffEngine(db_pool)
+
+    def start(station_id, user_id):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            started = start_session(cur, cache, tariffs, station_id, user_id)
+            conn.commit()
+        return started
+
+    def stop(station_id, user_id, energy=None):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            stopped = stop_session(cur, cache, ingestor, tariffs, station_id, user_id, energy)
+            conn.commit()
+        return stopped
+
+    def cancel(station_id, session_id, status):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cancelled = cancel_session(cur, cache, tariffs, station_id, session_id, status)
+            conn.commit()
+        return cancelled
+
+    return start, stop, cancel, ingestor
+
+
+def station_row(db_pool, station_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT status, using_by, power_consumption FROM charging_stations WHERE id = %s',
+                    (station_id,))
+        return cur.fetchone()
+
+
+def test_session_starts_and_stops_with_the_queued_reading(db_pool, charging, make_user, make_station):
+    start, stop, _, ingestor = charging
+    user_id = make_user()
+    station_id = make_station(power_consumption=100.0)
+
+    started = start(station_id, user_id)
+    assert started['result'] == STARTED and started['previous_status'] == 'free'
+    assert started['meter_start'] == 100.0
+    assert station_row(db_pool, station_id) == ('busy', user_id, 100.0)
+
+    ingestor.submit(station_id, user_id, started['session_id'], 4.0)
+    # Показание из очереди важнее значения клиента
+    stopped = stop(station_id, user_id, energy=1.0)
+    assert stopped['result'] == STOPPED and stopped['session_id'] == started['session_id']
+    assert (stopped['energy'], stopped['meter_end']) == (4.0, 104.0)
+    assert station_row(db_pool, station_id) == ('free', None, 104.0)
+    assert ingestor.stats()['pending'] == 0
+
+
+def test_refusals_leave_the_station_unchanged(db_pool, charging, make_user, make_station):
+    start, stop, cancel, _ = charging
+    owner, other = make_user(), make_user()
+    reserved = make_station(status='reserved', reserved_by=owner)
+    free = make_station()
+
+    assert start(999, owner)['result'] == NO_STATION
+    assert start(make_station(status='offline'), owner)['result'] == UNAVAILABLE
+    assert start(reserved, other)['result'] == RESERVED_BY_OTHER
+    assert stop(free, owner)['result'] == NOT_CHARGING
+
+    started = start(reserved, owner)
+    assert started['result'] == STARTED and started['previous_status'] == 'reserved'
+    assert stop(reserved, other)['result'] == NO_SESSION
+    # Станция не приняла команду - запуск откатывается в прежний статус
+    assert cancel(reserved, started['session_id'], started['previous_status'])
+    assert station_row(db_pool, reserved) == ('reserved', None, 0)
+    assert not cancel(reserved, started['session_id'], 'free')
@@ -0,0 +1,72 @@
+from common.commands import ACK, DELIVERED_MESSAGE, EXPIRED, NACK, NOT_CONNECTED
+
+
+class FlakyChannel:
+    """Станция, подтверждающая команду только со второй попытки"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        if len(self.sent) > 1:
+            self.dispatcher.acknowledge(message['command_id'])
+
+
+def test_acknowledged_command(dispatcher, fake_channel):
+    channel = fake_channel(dispatcher)
+    dispatcher.register(1, channel)
+
+    result = dispatcher.send(1, {'action': 'set_power', 'power': 11.0}, timeout=1.0)
+
+    assert result['status'] == ACK
+    assert channel.sent[0]['command_id'] == result['command_id']
+
+
+def test_rejected_and_unconnected_commands(dispatcher, fake_channel):
+    dispatcher.register(1, fake_channel(dispatcher, ack='nack'))
+
+    assert dispatcher.send(1, {'action': 'stop_charging'}, timeout=1.0)['status'] == NACK
+    assert dispatcher.send(2, {'action': 'stop_charging'}, timeout=1.0)['status'] == NOT_CONNECTED
+
+
+def test_retry_keeps_command_id(dispatcher):
+    channel = FlakyChannel(dispatcher)
+    dispatcher.register(1, channel)
+
+    result = dispatcher.send(1, {'action': 'stop_charging'}, timeout=1.0)
+
+    assert result['status'] == ACK and result['attempts'] == 2
+    assert channel.sent[0]['command_id'] == channel.sent[1]['command_id']
+
+
+def test_unacknowledged_command_expires(dispatcher, fake_channel):
+    channel = fake_channel(dispatcher, ack=False)
+    dispatcher.register(1, channel)
+
+    result = dispatcher.send(1, {'action': 'start_charging'}, timeout=1.0)
+
+    # Повторы исчерпаны - итог окончательный, станции команда больше не уходит
+    assert result['status'] == EXPIRED
+    assert len(channel.sent) == dispatcher.max_attempts
+
+
+def test_station_without_acks_gets_delivery_as_outcome(dispatcher, fake_channel):
+    """Прошивка без подтверждений (нет acks в register_command) - команды не истекают"""
+    channel = fake_channel(dispatcher, ack=False)
+    dispatcher.register(1, channel, acks=False)
+
+    result = dispatcher.send(1, {'action': 'start_charging'}, timeout=1.0)
+
+    assert result['status'] == ACK
+    assert result['message'] == DELIVERED_MESSAGE
+    assert len(channel.sent) == 1
+    assert dispatcher.stats()['delivered'] == 1
+
+
+def test_reconnect_with_acks_replaces_legacy_channel(dispatcher, fake_channel):
+    dispatcher.register(1, fake_channel(dispatcher, ack=False), acks=False)
+    dispatcher.register(1, fake_channel(dispatcher, ack='nack'))
+
+    assert dispatcher.send(1, {'action': 'stop_charging'}, timeout=1.0)['status'] == NACK
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from common.db import DatabasePool, PoolTimeout  # noqa: E402
+
+
+def test_connection_is_reused_and_returned(database):
+    pool = DatabasePool(minconn=1, maxconn=2)
+    try:
+        with pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT 1')
+            first = conn
+        with pool.connection() as conn:
+            assert conn is first
+        assert pool.stats()['in_use'] == 0
+        assert pool.stats()['checkouts'] == 2
+    finally:
+        pool.closeall()
+
+
+def test_failed_block_rolls_back_and_releases(database, db_pool):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS pool_probe (id INTEGER)')
+        conn.commit()
+
+    with pytest.raises(psycopg2.Error):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('INSERT INTO pool_probe VALUES (1)')
+            cur.execute('SELECT * FROM missing_table')
+
+    # Соединение вернулось в пул без незавершенной транзакции и вставки
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT count(*) FROM pool_probe')
+        assert cur.fetchone()[0] == 0
+    assert db_pool.stats()['in_use'] == 0
+
+
+def test_checkout_times_out_when_pool_is_exhausted(database):
+    pool = DatabasePool(minconn=1, maxconn=1, checkout_timeout=0.1)
+    try:
+        held = pool.getconn()
+        with pytest.raises(PoolTimeout):
+            pool.getconn()
+        assert pool.stats()['timeouts'] == 1
+
+        # Освобожденное соединение получает ждущий поток
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+        pool.checkout_timeout = 2.0
+        waiter.start()
+        pool.putconn(held)
+        waiter.join(3)
+        assert got == [held]
+        pool.putconn(got[0])
+    finally:
+        pool.closeall()
+
+
+def test_broken_connection_is_replaced(database):
+    pool = DatabasePool(minconn=1, maxconn=1)
+    try:
+        conn = pool.getconn()
+        conn.close()
+        pool.putconn(conn)
+        with pool.connection() as fresh, fresh.cursor() as cur:
+            assert fresh is not conn
+            cur.execute('SELECT 1')
+    finally:
+        pool.closeall()
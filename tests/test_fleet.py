@@ -0,0 +1,127 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.commands import ACK  # noqa: E402
+from common.ingest import EnergyIngestor  # noqa: E402
+from common.station_cache import StationStateCache  # noqa: E402
+from common.tariffs import TariffEngine  # noqa: E402
+from common.timeseries import MeterSeries  # noqa: E402
+from fleet import SKIPPED, FleetCommander, build_selector  # noqa: E402
+
+
+@pytest.fixture
+def fleet(db_pool, dispatcher):
+    return FleetCommander(
+        db_pool, dispatcher, StationStateCache(db_pool), EnergyIngestor(db_pool),
+        TariffEngine(db_pool), MeterSeries(db_pool), deadline=2.0,
+    )
+
+
+def station_row(db_pool, station_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT status, using_by FROM charging_stations WHERE id = %s', (station_id,))
+        return cur.fetchone()
+
+
+def open_sessions(db_pool):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT station_id, user_id FROM sessions WHERE end_time IS NULL ORDER BY station_id')
+        return cur.fetchall()
+
+
+def test_selector_requires_a_condition():
+    with pytest.raises(ValueError):
+        build_selector({})
+    with pytest.raises(ValueError):
+        build_selector({'filter': {'colour': 'green'}})
+
+
+def test_bulk_start_reports_summary(db_pool, dispatcher, fake_channel, fleet, make_user, make_station):
+    user_id = make_user()
+    stations = [make_station() for _ in range(3)]
+    channels = {station_id: fake_channel(dispatcher) for station_id in stations}
+    for station_id, channel in channels.items():
+        dispatcher.register(station_id, channel)
+
+    result = fleet.execute('start_charging', {'ids': stations}, user_id=user_id)
+
+    assert result['status'] == 'success'
+    assert result['matched'] == 3
+    assert result['summary'] == {ACK: 3}
+    assert result['total_ms'] >= result['db_ms'] >= 0
+    assert open_sessions(db_pool) == [(station_id, user_id) for station_id in stations]
+    for station_id, channel in channels.items():
+        assert [command['action'] for command in channel.sent] == ['start_charging']
+        assert station_row(db_pool, station_id) == ('busy', user_id)
+
+
+def test_bulk_start_cancels_rejected_stations(db_pool, dispatcher, fake_channel, fleet, make_user, make_station):
+    user_id = make_user()
+    accepted, rejected = make_station(), make_station()
+    dispatcher.register(accepted, fake_channel(dispatcher))
+    dispatcher.register(rejected, fake_channel(dispatcher, ack='nack'))
+
+    result = fleet.execute('start_charging', {'ids': [accepted, rejected]}, user_id=user_id)
+
+    assert result['summary'] == {ACK: 1, 'nack': 1}
+    assert open_sessions(db_pool) == [(accepted, user_id)]
+    assert station_row(db_pool, rejected) == ('free', None)
+
+
+def test_bulk_start_requires_user(fleet):
+    with pytest.raises(ValueError):
+        fleet.execute('start_charging', {'ids': [1]})
+
+
+def open_session(db_pool, station_id, user_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'INSERT INTO sessions (station_id, user_id, start_time, initial_electricity_meter) '
+            'VALUES (%s, %s, LOCALTIMESTAMP, 0)',
+            (station_id, user_id)
+        )
+        conn.commit()
+
+
+def test_bulk_stop_finds_user_of_sessions_without_using_by(
+        db_pool, dispatcher, fake_channel, fleet, make_user, make_station):
+    user_id = make_user()
+    # Строка до появления using_by: станция занята, пользователь - только в сессии
+    station_id = make_station(status='busy')
+    open_session(db_pool, station_id, user_id)
+    channel = fake_channel(dispatcher)
+    dispatcher.register(station_id, channel)
+
+    result = fleet.execute('stop_charging', {'ids': [station_id]})
+
+    assert result['summary'] == {ACK: 1}
+    assert channel.sent[0]['user_id'] == user_id
+    assert open_sessions(db_pool) == []
+    assert station_row(db_pool, station_id) == ('free', None)
+
+
+def test_bulk_stop_reports_stations_without_session(db_pool, dispatcher, fake_channel, fleet, make_station):
+    station_id = make_station(status='busy')
+    channel = fake_channel(dispatcher)
+    dispatcher.register(station_id, channel)
+
+    result = fleet.execute('stop_charging', {'ids': [station_id]})
+
+    assert result['summary'] == {SKIPPED: 1}
+    assert result['results'] == [
+        {'station_id': station_id, 'status': SKIPPED, 'message': 'No open session on the station'},
+    ]
+    assert channel.sent == []
+
+
+def test_bulk_start_selects_only_connected_stations(db_pool, dispatcher, fake_channel, fleet, make_user, make_station):
+    user_id = make_user()
+    connected, offline = make_station(), make_station()
+    dispatcher.register(connected, fake_channel(dispatcher))
+
+    result = fleet.execute('start_charging', {'ids': [connected, offline]}, user_id=user_id)
+
+    assert result['matched'] == 1
+    assert open_sessions(db_pool) == [(connected, user_id)]
+    assert station_row(db_pool, offline) == ('free', None)
@@ -0,0 +1,60 @@
+import socket
+
+import pytest
+
+from conftest import eventually
+from common.gateway import StationGateway
+from common.protocol import CODEC_LENGTH_PREFIXED, MessageChannel
+
+
+@pytest.fixture
+def gateway():
+    disconnected = []
+
+    def handler(request, channel):
+        if request.get('action') == 'fail':
+            raise RuntimeError('Handler failed')
+        if request.get('action') == 'ack':
+            return None
+        return {'status': 'success', 'echo': request}
+
+    gateway = StationGateway(max_workers=2)
+    gateway.add_listener('127.0.0.1', 0, handler, disconnected.append)
+    gateway.start()
+    gateway.disconnected = disconnected
+    yield gateway
+    gateway.stop()
+
+
+def connect(gateway):
+    port = gateway._servers[0].sockets[0].getsockname()[1]
+    return MessageChannel(socket.create_connection(('127.0.0.1', port), timeout=5))
+
+
+def test_requests_are_answered_in_order(gateway):
+    channel = connect(gateway)
+    try:
+        response = channel.request({'action': 'init', 'station_id': 1})
+        assert response['status'] == 'success' and response['codec'] == CODEC_LENGTH_PREFIXED
+
+        # Пачка запросов одного соединения - ответы в порядке запросов, без ответа на ack
+        for i in range(5):
+            channel.send({'action': 'update', 'seq': i})
+        channel.send({'action': 'ack'})
+        channel.send({'action': 'update', 'seq': 5})
+        assert [channel.receive()['echo']['seq'] for _ in range(6)] == list(range(6))
+    finally:
+        channel.sock.close()
+    eventually(lambda: len(gateway.disconnected) == 1)
+    assert not gateway.channels
+
+
+def test_bad_requests_get_errors_and_keep_the_connection(gateway):
+    channel = connect(gateway)
+    try:
+        channel.sock.sendall(b'{"action": broken}')
+        assert channel.receive() == {'status': 'error', 'message': 'Invalid JSON'}
+        assert channel.request({'action': 'fail'}) == {'status': 'error', 'message': 'Handler failed'}
+        assert channel.request({'action': 'update'})['status'] == 'success'
+    finally:
+        channel.sock.close()
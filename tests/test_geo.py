@@ -0,0 +1,50 @@
+import random
+import time
+
+from geo import StationIndex, haversine_km
+
+
+def station(station_id, lat, lon, power=22.0, status='free'):
+    return {'id': station_id, 'latitude': lat, 'longitude': lon, 'power': power, 'status': status,
+            'connector_type': 'Type 2', 'current_type': 'AC'}
+
+
+def brute_force(stations, lat, lon, radius_km, limit, min_power=None):
+    found = sorted(
+        (haversine_km(lat, lon, s['latitude'], s['longitude']), s['id'])
+        for s in stations if min_power is None or s['power'] >= min_power
+    )
+    return [station_id for dist, station_id in found if dist <= radius_km][:limit]
+
+
+def test_nearest_matches_full_scan():
+    rng = random.Random(7)
+    stations = [station(i, 55.75 + rng.uniform(-0.5, 0.5), 37.62 + rng.uniform(-0.8, 0.8),
+                        power=rng.choice([7.0, 22.0, 50.0])) for i in range(1, 2001)]
+    index = StationIndex()
+    index.load(stations)
+
+    for radius, limit, min_power in ((5, 10, None), (30, 20, 22.0), (0.1, 5, None)):
+        result = index.nearest(55.75, 37.62, radius_km=radius, limit=limit, min_power=min_power)
+        assert [s['id'] for _, s in result] == brute_force(stations, 55.75, 37.62, radius, limit, min_power)
+        assert [dist for dist, _ in result] == sorted(dist for dist, _ in result)
+
+
+def test_nearest_near_the_pole_is_bounded():
+    stations = [station(1, 89.9, 170.0), station(2, 89.5, -10.0), station(3, 55.75, 37.62)]
+    index = StationIndex()
+    index.load(stations)
+
+    started = time.monotonic()
+    result = index.nearest(89.95, 0.0, radius_km=200, limit=5)
+
+    # Без ограничения колец поиск обходил бы сотни миллионов ячеек
+    assert time.monotonic() - started < 1.0
+    assert [s['id'] for _, s in result] == brute_force(stations, 89.95, 0.0, 200, 5) == [1, 2]
+
+
+def test_nearest_outside_radius_is_empty():
+    index = StationIndex()
+    index.load([station(1, 55.75, 37.62)])
+
+    assert index.nearest(59.93, 30.31, radius_km=10) == []
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.ingest import EnergyIngestor  # noqa: E402
+
+
+@pytest.fixture
+def session(db_pool, make_user, make_station):
+    def make():
+        user_id, station_id = make_user(), make_station(status='busy')
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                'INSERT INTO sessions (station_id, user_id, start_time, initial_electricity_meter) '
+                'VALUES (%s, %s, LOCALTIMESTAMP, 0) RETURNING id',
+                (station_id, user_id)
+            )
+            session_id = cur.fetchone()[0]
+            conn.commit()
+        return station_id, user_id, session_id
+    return make
+
+
+def energy(db_pool, session_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT energy_consumed FROM sessions WHERE id = %s', (session_id,))
+        return cur.fetchone()[0]
+
+
+def test_latest_readings_are_written_in_one_batch(db_pool, session):
+    first, second = session(), session()
+    ingestor = EnergyIngestor(db_pool, flush_interval=60)
+
+    for reading in (1.0, 2.0, 3.5):
+        assert ingestor.submit(*first, reading)
+    assert ingestor.submit(*second, 0.5)
+    # Чужой пользователь не может дописать энергию в сессию
+    assert ingestor.submit(first[0], second[1], 999, 7.0)
+
+    assert ingestor.flush() == 3
+    assert energy(db_pool, first[2]) == 3.5
+    assert energy(db_pool, second[2]) == 0.5
+    assert ingestor.stats() == {'pending': 0, 'accepted': 3, 'coalesced': 2, 'dropped': 0,
+                                'batches': 1, 'rows_written': 3}
+
+
+def test_full_queue_drops_new_sessions_but_updates_queued_ones(db_pool, session):
+    first, second = session(), session()
+    ingestor = EnergyIngestor(db_pool, flush_interval=60, max_pending=1, submit_timeout=0.05)
+
+    assert ingestor.submit(*first, 1.0)
+    assert not ingestor.submit(*second, 1.0)
+    assert ingestor.submit(*first, 2.0)
+    assert ingestor.stats()['dropped'] == 1
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        # Завершение сессии забирает показание из очереди в своей транзакции
+        assert ingestor.flush_station(first[0], cur) == 1
+        conn.commit()
+    assert energy(db_pool, first[2]) == 2.0
+    assert ingestor.submit(*second, 1.0)
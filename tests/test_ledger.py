@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.ledger import (  # noqa: E402
+    DEPOSIT, SETTLEMENT_LOCK, LedgerSettlement, balance, charge_session, post,
+)
+
+
+def current_balance(db_pool, user_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        return balance(cur, user_id)
+
+
+def test_balance_is_the_same_before_and_after_settlement(db_pool, make_user):
+    user_id = make_user()
+    settled_users = []
+    ledger = LedgerSettlement(db_pool, on_settle=lambda cur, user_ids: settled_users.extend(user_ids), batch=2)
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        assert post(cur, user_id, 100, DEPOSIT, 1)
+        assert post(cur, user_id, 100, DEPOSIT, 1) is None  # повтор того же пополнения
+        post(cur, user_id, 50, DEPOSIT)
+        charge_session(cur, user_id, 7, 30.5)
+        charge_session(cur, user_id, 7, 30.5)
+        charge_session(cur, user_id, 8, 0)
+        conn.commit()
+
+    assert current_balance(db_pool, user_id) == 119.5
+    assert ledger.settle() == 3
+    assert current_balance(db_pool, user_id) == 119.5
+    assert set(settled_users) == {user_id}
+    assert ledger.verify() == []
+    assert current_balance(db_pool, 999) is None
+
+
+def test_concurrent_settlement_is_skipped_and_drift_is_reported(db_pool, make_user):
+    user_id = make_user()
+    ledger = LedgerSettlement(db_pool)
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        post(cur, user_id, 10, DEPOSIT)
+        conn.commit()
+
+    # Расчет уже идет в другом процессе - этот ничего не трогает
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (SETTLEMENT_LOCK,))
+        assert ledger.settle() == 0
+        conn.rollback()
+    assert ledger.stats()['skipped'] == 1
+    assert ledger.settle() == 1
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('UPDATE users SET balance = balance + 1 WHERE id = %s', (user_id,))
+        conn.commit()
+    assert ledger.verify() == [{'user_id': user_id, 'balance': 11.0, 'ledger': 10.0}]
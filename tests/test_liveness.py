@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.liveness import LivenessTable  # noqa: E402
+
+
+def last_connection(db_pool, station_id):
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT last_connection FROM charging_stations WHERE id = %s', (station_id,))
+        return cur.fetchone()[0]
+
+
+def test_heartbeats_are_coalesced_into_one_write(db_pool, make_station):
+    first, second = make_station(), make_station()
+    table = LivenessTable(db_pool, flush_interval=60)
+    now = datetime.now().replace(microsecond=0)
+
+    for i in range(10):
+        table.record(first, now + timedelta(seconds=i))
+    table.record(second, now)
+
+    assert table.last_seen(first) == now + timedelta(seconds=9)
+    assert table.flush() == 2
+    assert last_connection(db_pool, first) == now + timedelta(seconds=9)
+    assert last_connection(db_pool, second) == now
+    assert table.stats() == {'heartbeats': 11, 'pending': 0, 'flushes': 1, 'rows_flushed': 2}
+
+    # Более старая отметка не затирает записанную
+    table.record(first, now)
+    table.flush()
+    assert last_connection(db_pool, first) == now + timedelta(seconds=9)
+
+
+def test_failed_flush_keeps_marks_for_retry(db_pool, make_station):
+    station_id = make_station()
+    table = LivenessTable(db_pool, flush_interval=60)
+    table.record(station_id, 'not a timestamp')
+
+    assert table.flush() == 0
+    assert table.stats()['pending'] == 1
+
+    now = datetime.now().replace(microsecond=0)
+    table.record(station_id, now)
+    assert table.flush() == 1
+    assert last_connection(db_pool, station_id) == now
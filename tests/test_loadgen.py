@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+import pytest
+
+from conftest import eventually
+from common.gateway import StationGateway
+from loadgen import FleetSimulator, parse_args
+
+
+class FakeServer:
+    """Шлюз без БД: принимает станции с id из allowed и собирает подтверждения команд"""
+
+    def __init__(self, allowed):
+        self.allowed = allowed
+        self.command_channels = {}
+        self.acks = []
+
+    def handle(self, request, channel):
+        action = request.get('action')
+        if action == 'command_ack':
+            self.acks.append(request)
+            return None
+        if request.get('station_id') not in self.allowed:
+            return {'status': 'error', 'message': 'Station not found'}
+        if action == 'register_command':
+            self.command_channels[request['station_id']] = channel
+            return {'status': 'success'}
+        if action == 'init':
+            return {'status': 'success', 'power': 22.0, 'power_consumption': 0, 'station_status': 'free'}
+        return {'status': 'success'}
+
+
+@pytest.fixture
+def server():
+    def start(allowed):
+        fake = FakeServer(allowed)
+        gateway = StationGateway(max_workers=4)
+        gateway.add_listener('127.0.0.1', 0, fake.handle)
+        gateway.start()
+        fake.port = gateway._servers[0].sockets[0].getsockname()[1]
+        started.append(gateway)
+        return fake
+
+    started = []
+    yield start
+    for gateway in started:
+        gateway.stop()
+
+
+def run_fleet(port, stations, duration):
+    options = parse_args([
+        '--stations', str(stations), '--host', '127.0.0.1', '--port', str(port),
+        '--duration', str(duration), '--ramp', '0', '--heartbeat', '0.05',
+        '--backoff', '0.05', '--max-backoff', '0.1', '--progress', '0', '--gateways', '',
+    ])
+    fleet = FleetSimulator(options)
+    return fleet, threading.Thread(target=asyncio.run, args=(fleet.run(),))
+
+
+def test_fleet_connects_heartbeats_and_acknowledges_commands(server):
+    fake = server(allowed={1, 2, 3})
+    fleet, thread = run_fleet(fake.port, 3, duration=1.0)
+    thread.start()
+
+    eventually(lambda: fleet.online() == 3)
+    command = {'action': 'set_power', 'power': 7.0, 'command_id': 'c1'}
+    # Повтор команды (нет подтверждения) выполняется один раз, но подтверждается снова
+    fake.command_channels[1].send(command)
+    fake.command_channels[1].send(command)
+    thread.join(5)
+
+    report = fleet.report()
+    assert report['latency_ms']['init']['count'] == 3
+    assert report['latency_ms']['heartbeat']['count'] >= 3
+    assert report['errors'] == {}
+    assert [ack['status'] for ack in fake.acks] == ['success', 'success']
+    assert fleet.stations[0].power == 7.0
+
+
+def test_rejected_stations_retry_and_are_counted_as_errors(server):
+    fake = server(allowed={1})
+    fleet, thread = run_fleet(fake.port, 2, duration=0.5)
+    thread.start()
+    thread.join(5)
+
+    report = fleet.report()
+    assert report['latency_ms']['init']['count'] >= 1
+    # Станция 2 неизвестна шлюзу: каждая попытка отклоняется, с задержкой между ними
+    assert report['errors']['register_command'] >= 2
+    assert fleet.online() == 0  # после остановки все соединения закрыты
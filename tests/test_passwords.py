@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+pytest.importorskip('werkzeug')
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+from passwords import Overloaded, PasswordHasher, RateLimiter  # noqa: E402
+
+FAST_METHOD = 'pbkdf2:sha256:1000'
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=1, max_pending=1, queue_timeout=0.05, method=FAST_METHOD)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_hash_verify_and_rehash_of_old_hashes(hasher):
+    stored = hasher.hash('secret')
+    assert hasher.verify(stored, 'secret') and not hasher.verify(stored, 'wrong')
+    assert not hasher.needs_rehash(stored)
+
+    # Хеш со старыми параметрами пересчитывается в фоне после входа
+    legacy = generate_password_hash('secret', method='pbkdf2:sha256:500')
+    assert hasher.needs_rehash(legacy)
+    saved = []
+    done = threading.Event()
+    hasher.rehash_later('secret', lambda new_hash: (saved.append(new_hash), done.set()))
+    assert done.wait(10)
+    assert not hasher.needs_rehash(saved[0]) and hasher.verify(saved[0], 'secret')
+
+
+def test_busy_pool_rejects_instead_of_queueing():
+    slow = PasswordHasher(workers=1, max_pending=1, queue_timeout=0.05, method='pbkdf2:sha256:2000000')
+    try:
+        slow.rehash_later('secret', lambda new_hash: None)
+        with pytest.raises(Overloaded):
+            slow.hash('other')
+        assert slow.stats()['rejected'] == 1
+    finally:
+        slow.shutdown()
+
+
+def test_rate_limiter_allows_burst_then_limits_per_key():
+    limiter = RateLimiter(rate=0.5, burst=2, maxsize=2)
+
+    assert limiter.acquire('a') == 0 and limiter.acquire('a') == 0
+    assert limiter.acquire('a') == pytest.approx(2, abs=0.01)
+    assert limiter.acquire('b') == 0
+    # Вытесненный ключ начинает с полным запасом
+    limiter.acquire('c')
+    assert limiter.acquire('a') == 0
+    assert limiter.stats() == {'keys': 2, 'allowed': 5, 'limited': 1}
+    assert RateLimiter(rate=0, burst=0).acquire('a') == 0
@@ -0,0 +1,52 @@
+import socket
+
+import pytest
+
+from common.protocol import (
+    CODEC_JSON, CODEC_LENGTH_PREFIXED, FrameDecoder, MessageChannel, ProtocolError, encode,
+)
+
+
+@pytest.mark.parametrize('codec', [CODEC_JSON, CODEC_LENGTH_PREFIXED])
+def test_messages_split_across_reads_are_reassembled(codec):
+    messages = [{'action': 'update', 'energy': 1.5}, {'note': 'brace } in "string"'}, {'nested': {'a': [1, 2]}}]
+    data = b''.join(encode(message, codec) for message in messages)
+    decoder = FrameDecoder(codec)
+
+    # Байты приходят по одному - каждое сообщение отдается ровно один раз
+    decoded = []
+    for i in range(len(data)):
+        decoded += decoder.feed(data[i:i + 1])
+
+    assert decoded == messages
+
+
+def test_broken_json_does_not_stop_the_stream():
+    decoder = FrameDecoder(CODEC_JSON)
+
+    assert decoder.feed(b'garbage{"a": 1}{"b": nope}{"c": 3}') == [None, {'a': 1}, None, {'c': 3}]
+
+
+def test_oversized_frame_is_a_protocol_error():
+    with pytest.raises(ProtocolError):
+        FrameDecoder(CODEC_LENGTH_PREFIXED, max_frame_size=16).feed(encode({'data': 'x' * 32}, CODEC_LENGTH_PREFIXED))
+    with pytest.raises(ProtocolError):
+        FrameDecoder(CODEC_JSON, max_frame_size=16).feed(b'{"data": "' + b'x' * 32)
+
+
+def test_handshake_switches_both_sides_to_length_prefix():
+    station_sock, server_sock = socket.socketpair()
+    station, server = MessageChannel(station_sock), MessageChannel(server_sock)
+    try:
+        station.send({'action': 'init', 'station_id': 1, 'codecs': [CODEC_LENGTH_PREFIXED]})
+        request = server.receive()
+        server.reply(request, {'status': 'success'})
+        server.send({'action': 'set_power', 'power': 7.0})
+
+        assert station.accept_codec(station.receive(limit=1)) == {'status': 'success', 'codec': CODEC_LENGTH_PREFIXED}
+        # Кадр после ответа уже в новом кодеке
+        assert station.receive() == {'action': 'set_power', 'power': 7.0}
+        assert station.codec == server.codec == CODEC_LENGTH_PREFIXED
+    finally:
+        station_sock.close()
+        server_sock.close()
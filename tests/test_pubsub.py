@@ -0,0 +1,72 @@
+import json
+import threading
+
+import pytest
+
+from common.pubsub import TelemetryHub
+
+
+def test_events_reach_subscribers_until_the_topic_closes():
+    hub = TelemetryHub(queue_size=8, max_drops=8)
+    subscription = hub.subscribe(1)
+    received = []
+
+    def read():
+        while (event := subscription.get(timeout=2)) is not None:
+            received.append(event)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert hub.publish(1, {'event': 'meter', 'energy': 1.0}) == 1
+    assert hub.publish(2, {'event': 'meter', 'energy': 5.0}) == 0
+    hub.close_topic(1, {'event': 'end'})
+    reader.join(3)
+
+    assert received == [{'event': 'meter', 'energy': 1.0}, {'event': 'end'}]
+    assert hub.stats()['topics'] == 0
+
+
+def test_slow_subscriber_keeps_latest_events_then_is_evicted():
+    hub = TelemetryHub(queue_size=2, max_drops=3)
+    subscription = hub.subscribe(1)
+
+    for energy in range(4):
+        hub.publish(1, {'energy': energy})
+    # Переполнение отбрасывает старые события
+    assert subscription.get(timeout=0) == {'energy': 2}
+
+    for energy in range(10):
+        hub.publish(1, {'energy': energy})
+    assert subscription.evicted and subscription.get(timeout=0) is None
+    assert not hub.has_subscribers(1)
+    assert hub.stats()['evictions'] == 1
+
+
+def sse_events(response):
+    return [json.loads(line[len('data: '):]) for line in response.get_data(as_text=True).splitlines()
+            if line.startswith('data: ')]
+
+
+def test_stream_of_finished_session_and_foreign_session(db_pool, backend, client, make_user, make_station):
+    owner, stranger = make_user(), make_user()
+    station_id = make_station()
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            'INSERT INTO sessions (station_id, user_id, start_time, end_time, initial_electricity_meter, '
+            'energy_consumed) VALUES (%s, %s, LOCALTIMESTAMP, LOCALTIMESTAMP, 0, 3.5) RETURNING id',
+            (station_id, owner)
+        )
+        session_id = cur.fetchone()[0]
+        conn.commit()
+
+    def stream(user_id):
+        headers = {'Authorization': f'Bearer {backend.generate_token(user_id)}'}
+        return client.get(f'/api/sessions/{session_id}/stream', headers=headers)
+
+    response = stream(owner)
+    assert response.status_code == 200
+    assert [event['event'] for event in sse_events(response)] == ['snapshot', 'end']
+    assert sse_events(response)[1]['energy_consumed'] == 3.5
+
+    assert stream(stranger).status_code == 404
+    assert not backend.telemetry_hub.has_subscribers(session_id)
@@ -0,0 +1,46 @@
+import time
+
+from common.registry import COMMAND, DATA, ConnectionRegistry
+
+
+class Channel:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_reconnect_replaces_channel_and_reverse_lookup_follows():
+    registry = ConnectionRegistry(timeout=60, tick=1)
+    old, new, command = Channel(), Channel(), Channel()
+
+    assert registry.register(1, old) is None
+    registry.register(1, command, COMMAND)
+    assert registry.register(1, new) is old
+
+    # Закрытие устаревшего соединения не отвязывает станцию от нового
+    assert registry.unregister(old) is None
+    assert registry.owner(new) == (1, DATA) and registry.get(1) is new
+    assert registry.unregister(new) == (1, DATA)
+    assert 1 not in registry
+    assert registry.stats() == {'connected': 0, 'command_channels': 1, 'tracked': 1, 'evictions': 0}
+    registry.unregister(command)
+    assert registry.stats()['tracked'] == 0
+
+
+def test_silent_station_is_evicted_and_live_one_is_kept():
+    evicted = []
+    registry = ConnectionRegistry(timeout=0.2, tick=0.05, on_evict=lambda sid, channels: evicted.append(sid))
+    silent, live = Channel(), Channel()
+    registry.register(1, silent)
+    registry.register(2, live)
+
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        registry.touch(2)
+        registry.sweep()
+        time.sleep(0.02)
+
+    assert evicted == [1]
+    assert silent.closed and not live.closed
+    assert registry.owner(silent) is None and registry.stations() == [2]
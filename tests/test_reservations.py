@@ -0,0 +1,53 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.reservations import (  # noqa: E402
+    CANCELLED, CONFLICT, FORBIDDEN, NOT_FOUND, NOT_RESERVED, RESERVED, ReservationEngine,
+)
+from common.station_cache import StationStateCache  # noqa: E402
+
+
+@pytest.fixture
+def engine(db_pool):
+    return ReservationEngine(db_pool, StationStateCache(db_pool, ttl=600), ttl=60)
+
+
+def test_only_one_of_concurrent_reservations_wins(engine, make_user, make_station):
+    station_id = make_station()
+    users = [make_user() for _ in range(8)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda user_id: engine.reserve(station_id, user_id), users))
+
+    winners = [user_id for user_id, result in zip(users, results) if result['result'] == RESERVED]
+    assert len(winners) == 1
+    assert {result['result'] for result in results} == {RESERVED, CONFLICT}
+    assert all(result['reserved_by'] == winners[0] for result in results)
+    # Своя бронь продлевается, чужую снять нельзя
+    assert engine.reserve(station_id, winners[0])['result'] == RESERVED
+    other = next(user_id for user_id in users if user_id != winners[0])
+    assert engine.cancel(station_id, other)['result'] == FORBIDDEN
+    assert engine.cancel(station_id, winners[0])['result'] == CANCELLED
+    assert engine.cancel(station_id, winners[0])['result'] == NOT_RESERVED
+    assert engine.station_cache.get(station_id)['status'] == 'free'
+
+
+def test_expired_reservation_is_released(engine, make_user, make_station):
+    station_id, busy_id = make_station(), make_station(status='busy')
+    first, second = make_user(), make_user()
+
+    assert engine.reserve(busy_id, first)['result'] == CONFLICT
+    assert engine.reserve(999, first)['result'] == NOT_FOUND
+    assert engine.reserve(station_id, first, ttl=0.05)['result'] == RESERVED
+    time.sleep(0.1)
+
+    # Просроченную бронь можно перехватить и до уборки
+    assert engine.reserve(station_id, second, ttl=0.05)['result'] == RESERVED
+    time.sleep(0.1)
+    assert engine.sweep() == 1
+    assert engine.station_cache.get(station_id)['reserved_by'] is None
+    assert engine.stats()['expired'] == 1
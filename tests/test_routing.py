@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from conftest import wait_listening  # noqa: E402
+from common.commands import ACK, NOT_CONNECTED, TIMEOUT, CommandDispatcher  # noqa: E402
+from common.routing import BUS_CHANNEL, CommandBus  # noqa: E402
+
+
+@pytest.fixture
+def gateways(db_pool, dispatcher):
+    """Два шлюза на одной БД: станции подключаются к первому, команды шлет второй"""
+    remote = CommandDispatcher(ack_timeout=0.2, max_attempts=2)
+    remote.start()
+    owner = CommandBus(db_pool, dispatcher, gateway_id='gw-a', owner_ttl=30)
+    sender = CommandBus(db_pool, remote, gateway_id='gw-b', owner_ttl=30)
+    owner.init_db()
+    for bus in (owner, sender):
+        bus.start()
+    wait_listening(db_pool, BUS_CHANNEL, 2)
+    yield owner, sender
+    for bus in (owner, sender):
+        bus.stop()
+        bus._listener._thread.join(2)
+    remote.stop()
+
+
+def test_dispatch_reaches_station_on_another_gateway(dispatcher, fake_channel, gateways):
+    owner, sender = gateways
+    channel = fake_channel(dispatcher)
+    dispatcher.register(7, channel)
+    owner.claim(7)
+
+    assert sender.connected_stations() == [7]
+    pending = sender.dispatch(7, {'action': 'set_power', 'power': 11.0}, ttl=2.0)
+    # dispatch не ждет доставки: итог приходит ответом владельца
+    assert pending.wait(3.0)['status'] == ACK
+    assert [command['power'] for command in channel.sent] == [11.0]
+    assert sender.forwarded == 1 and owner.served == 1
+
+
+def test_dispatch_to_station_without_owner(dispatcher, gateways):
+    _, sender = gateways
+    # Без записи владения команда идет по кольцу, а в нем только сам отправитель
+    assert sender.dispatch(8, {'action': 'stop_charging'}).result['status'] == NOT_CONNECTED
+    assert sender.connected_stations() == []
+
+
+def test_expire_forwarded_command_without_reply(db_pool, gateways):
+    _, sender = gateways
+    # Владелец записан, но его шлюз не отвечает
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO station_owners (station_id, gateway_id) VALUES (9, 'gw-gone')")
+        conn.commit()
+
+    pending = sender.dispatch(9, {'action': 'stop_charging'}, ttl=0.1)
+    assert pending.wait(0.3) is None
+    assert sender.expire(pending)
+    assert pending.result['status'] == TIMEOUT
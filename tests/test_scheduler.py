@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from conftest import drain  # noqa: E402
+from common.ingest import EnergyIngestor  # noqa: E402
+from common.station_cache import StationStateCache  # noqa: E402
+from common.tariffs import TariffEngine  # noqa: E402
+from common.timeseries import MeterSeries  # noqa: E402
+from fleet import FleetCommander  # noqa: E402
+from scheduler import LoadBalancer  # noqa: E402
+
+
+@pytest.fixture
+def feeder(db_pool):
+    def make(budget):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('INSERT INTO feeders (name, power_budget) VALUES (%s, %s) RETURNING id', ('F', budget))
+            feeder_id = cur.fetchone()[0]
+            conn.commit()
+        return feeder_id
+    return make
+
+
+@pytest.fixture
+def balanced(db_pool, dispatcher):
+    """Кэш, балансировщик и массовые команды, связанные как в ChargingServer"""
+    cache = StationStateCache(db_pool)
+    balancer = LoadBalancer(db_pool, dispatcher, hysteresis_kw=0.5, hysteresis_pct=0.05)
+    cache.subscribe(balancer.on_state_change)
+    fleet = FleetCommander(
+        db_pool, dispatcher, cache, EnergyIngestor(db_pool), TariffEngine(db_pool),
+        MeterSeries(db_pool), deadline=2.0, balancer=balancer,
+    )
+    return cache, balancer, fleet
+
+
+def last_power(channel):
+    drain(channel.dispatcher)
+    return [command['power'] for command in channel.sent if command['action'] == 'set_power'][-1]
+
+
+def test_budget_is_shared_max_min(db_pool, dispatcher, fake_channel, balanced, feeder, make_station):
+    cache, balancer, _ = balanced
+    feeder_id = feeder(25)
+    small, big = make_station(power=7.0, feeder_id=feeder_id), make_station(power=22.0, feeder_id=feeder_id)
+    channels = {station_id: fake_channel(dispatcher) for station_id in (small, big)}
+    for station_id, channel in channels.items():
+        dispatcher.register(station_id, channel)
+    balancer.load()
+
+    cache.apply(small, status='busy')
+    cache.apply(big, status='busy')
+
+    assert balancer.allocation(small) == 7.0
+    assert balancer.allocation(big) == 18.0
+    assert last_power(channels[big]) == 18.0
+    assert not channels[small].sent  # своя мощность в пределах равной доли
+
+    cache.apply(small, status='free')
+    assert balancer.allocation(small) is None
+    assert last_power(channels[big]) == 22.0
+
+
+def test_bulk_power_on_budgeted_station_sends_only_allocation(
+        db_pool, dispatcher, fake_channel, balanced, feeder, make_station):
+    cache, balancer, fleet = balanced
+    feeder_id = feeder(24)
+    busy = [make_station(power=7.0, feeder_id=feeder_id) for _ in range(3)]
+    idle = make_station(power=7.0, feeder_id=feeder_id)
+    channels = {station_id: fake_channel(dispatcher) for station_id in (*busy, idle)}
+    for station_id, channel in channels.items():
+        dispatcher.register(station_id, channel)
+    balancer.load()
+    for station_id in busy:
+        cache.apply(station_id, status='busy')
+
+    result = fleet.execute('set_power', {'ids': [*busy, idle]}, power=22.0)
+
+    assert result['summary'] == {'balanced': 3, 'ack': 1}
+    for station_id in busy:
+        # Последняя команда не больше доли: сырые 22 кВт заряжающимся станциям не уходят
+        assert balancer.allocation(station_id) == 8.0
+        assert last_power(channels[station_id]) <= balancer.allocation(station_id)
+        assert 22.0 not in [command.get('power') for command in channels[station_id].sent]
+    assert last_power(channels[idle]) == 22.0
+
+
+def test_lowered_power_reaches_the_station_inside_hysteresis(
+        db_pool, dispatcher, fake_channel, balanced, feeder, make_station):
+    cache, balancer, _ = balanced
+    station_id = make_station(power=22.0, feeder_id=feeder(0))
+    channel = fake_channel(dispatcher)
+    dispatcher.register(station_id, channel)
+    balancer.load()
+    cache.apply(station_id, status='busy')
+
+    assert balancer.set_demand(station_id, 11.0) is True
+    assert balancer.set_demand(station_id, 11.3) is True
+
+    assert balancer.allocation(station_id) == 11.3
+    assert last_power(channel) == 11.3
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from conftest import eventually, wait_listening  # noqa: E402
+from common.station_cache import NOTIFY_CHANNEL, StationStateCache  # noqa: E402
+
+
+@pytest.fixture
+def caches(db_pool):
+    """Кэши двух процессов с длинным ttl: свежие данные возможны только через уведомления"""
+    caches = [StationStateCache(db_pool, ttl=600) for _ in range(2)]
+    for cache in caches:
+        cache.start()
+    wait_listening(db_pool, NOTIFY_CHANNEL, listeners=2)
+    yield caches
+    for cache in caches:
+        cache.stop()
+    for cache in caches:
+        cache._listener._thread.join(2)
+
+
+def test_change_reaches_other_process(db_pool, caches, make_station):
+    writer, reader = caches
+    stations = [make_station() for _ in range(3)]
+    for station_id in stations:
+        assert reader.get(station_id)['status'] == 'free'
+    changes = []
+    reader.subscribe(lambda station_id, fields: changes.append(station_id))
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE charging_stations SET status = 'offline' WHERE id = ANY(%s)", (stations,))
+        writer.notify_many(cur, stations, status='offline')
+        conn.commit()
+    for station_id in stations:
+        writer.apply(station_id, status='offline')
+
+    eventually(lambda: all(reader.get(station_id)['status'] == 'offline' for station_id in stations))
+    assert sorted(changes) == stations
+    assert reader.stats()['misses'] == 3  # состояние пришло уведомлением, не перечитыванием
+
+
+def test_unreadable_event_drops_the_cache(db_pool, caches, make_station):
+    _, reader = caches
+    station_id = make_station()
+    reader.get(station_id)
+    assert reader.get(12345) is None
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE charging_stations SET status = 'busy' WHERE id = %s", (station_id,))
+        cur.execute('SELECT pg_notify(%s, %s)', (NOTIFY_CHANNEL, 'not json'))
+        conn.commit()
+
+    # Непонятное событие - кэш сбрасывается и перечитывается из БД
+    eventually(lambda: reader.get(station_id)['status'] == 'busy')
+    assert reader.stats()['invalidations'] >= 1
@@ -0,0 +1,95 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('flask')
+
+
+@pytest.mark.parametrize('query', ['', '&bbox=37.0,55.0,38.0,56.0&zoom=16'])
+def test_non_numeric_min_power_is_rejected(client, query):
+    response = client.get(f'/api/stations?min_power=fast{query}')
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'min_power must be a number'}
+
+
+def test_viewport_applies_min_power(client, make_station):
+    slow = make_station(power=7.0, latitude=55.5, longitude=37.5)
+    fast = make_station(power=50.0, latitude=55.6, longitude=37.6)
+    make_station(power=50.0, latitude=60.0, longitude=30.0)  # вне области
+
+    response = client.get('/api/stations?bbox=37.0,55.0,38.0,56.0&zoom=16&min_power=22')
+
+    assert response.status_code == 200
+    assert [station['id'] for station in response.get_json()['stations']] == [fast]
+    assert slow not in [station['id'] for station in response.get_json()['stations']]
+
+
+def test_list_etag_depends_on_query(client, make_station):
+    make_station(power=7.0)
+    make_station(power=50.0)
+
+    first = client.get('/api/stations?min_power=22')
+    etag = first.headers['ETag']
+    assert [station['power'] for station in first.get_json()['stations']] == [50.0]
+
+    # Тот же запрос без изменений таблицы - 304
+    assert client.get('/api/stations?min_power=22', headers={'If-None-Match': etag}).status_code == 304
+    # Другие фильтры или страница с тем же ETag получают свой ответ
+    for query in ('', '?min_power=5', '?min_power=22&after_id=1', '?min_power=22&limit=1'):
+        response = client.get(f'/api/stations{query}', headers={'If-None-Match': etag})
+        assert response.status_code == 200, query
+        assert response.headers['ETag'] != etag
+
+
+def test_filtered_list_pages_by_id(client, make_station):
+    ac = [make_station(power=22.0, current_type='AC') for _ in range(5)]
+    make_station(power=50.0, current_type='DC')
+    make_station(power=22.0, current_type='AC', status='busy')
+
+    pages, after_id = [], 0
+    while after_id is not None:
+        body = client.get(f'/api/stations?current_type=AC&status=free&limit=2&after_id={after_id}').get_json()
+        pages.append([station['id'] for station in body['stations']])
+        after_id = body['next_after_id']
+
+    assert pages == [ac[0:2], ac[2:4], ac[4:5]]
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=ten', 'after_id=x'])
+def test_invalid_page_parameters_are_rejected(client, query):
+    assert client.get(f'/api/stations?{query}').status_code == 400
+
+
+def test_nearby_orders_by_distance(client, make_station):
+    far = make_station(latitude=55.80, longitude=37.62)
+    near = make_station(latitude=55.751, longitude=37.62)
+    make_station(latitude=59.93, longitude=30.31)  # вне радиуса
+
+    response = client.get('/api/stations/nearby?lat=55.75&lon=37.62&radius=20')
+
+    assert response.status_code == 200
+    stations = response.get_json()['stations']
+    assert [station['id'] for station in stations] == [near, far]
+    assert stations[0]['distance_km'] < stations[1]['distance_km']
+
+
+@pytest.mark.parametrize('query', ['lon=37.6', 'lat=north&lon=37.6', 'lat=91&lon=37.6', 'lat=55&lon=37&radius=0'])
+def test_nearby_rejects_bad_coordinates(client, query):
+    assert client.get(f'/api/stations/nearby?{query}').status_code == 400
+
+
+def test_low_zoom_returns_clusters(client, make_station):
+    for i in range(3):
+        make_station(latitude=55.75 + i * 0.001, longitude=37.62, status='free' if i else 'busy', power=22.0 + i)
+    make_station(latitude=60.0, longitude=30.0)
+
+    body = client.get('/api/stations?bbox=37.0,55.0,38.0,56.0&zoom=5').get_json()
+
+    assert 'stations' not in body
+    assert [(cluster['count'], cluster['free'], cluster['busy'], cluster['max_power'])
+            for cluster in body['clusters']] == [(3, 2, 1, 24.0)]
+
+
+@pytest.mark.parametrize('bbox', ['37.0,55.0,38.0', '38.0,55.0,37.0,56.0', 'a,b,c,d'])
+def test_invalid_bbox_is_rejected(client, bbox):
+    assert client.get(f'/api/stations?bbox={bbox}').status_code == 400
@@ -0,0 +1,93 @@
+import threading
+from datetime import time as day_time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from conftest import eventually, wait_listening  # noqa: E402
+from common.station_cache import NOTIFY_CHANNEL, StationStateCache  # noqa: E402
+from common.tariffs import SessionMeter, TariffEngine, compile_tariff  # noqa: E402
+
+
+def test_period_prices_apply_by_minute_of_day():
+    tariff = compile_tariff(1, 10, 1, [(day_time(23, 0), day_time(7, 0), 5, None)])
+
+    assert tariff.kwh_price(12 * 60) == 10
+    assert tariff.kwh_price(23 * 60 + 30) == 5
+    assert tariff.kwh_price(3 * 60) == 5  # период через полночь
+    assert tariff.time_cost(0, 2 * 24 * 60) == 2 * 24 * 60
+    assert tariff.time_cost(10, 5) == 0
+
+
+def test_meter_ignores_energy_counter_reset():
+    meter = SessionMeter(1, 1, 1, compile_tariff(1, 10, 0), position=0)
+    meter.advance(2.0, 1)
+    meter.advance(1.0, 2)
+
+    assert meter.cost == 20.0
+    assert meter.energy == 2.0
+
+
+def test_concurrent_readings_are_billed_once():
+    meter = SessionMeter(1, 1, 1, compile_tariff(1, 10, 1), position=0)
+    readings = [(i / 10, float(i)) for i in range(1, 2001)]
+
+    def feed(chunk):
+        for energy, position in chunk:
+            meter.advance(energy, position)
+
+    threads = [threading.Thread(target=feed, args=(readings[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Порядок показаний произвольный, но каждая минута и каждый кВт·ч оплачены один раз
+    assert meter.position == 2000.0
+    assert meter.energy == 200.0
+    assert meter.cost == pytest.approx(2000 * 1 + 200 * 10)
+
+
+@pytest.fixture
+def tariff_rows(db_pool):
+    def make(price_per_kwh):
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute('INSERT INTO tariffs (name, price_per_kwh) VALUES (%s, %s) RETURNING id', ('T', price_per_kwh))
+            tariff_id = cur.fetchone()[0]
+            conn.commit()
+        return tariff_id
+    return make
+
+
+def test_station_tariff_change_reaches_engine(db_pool, tariff_rows, make_station):
+    day, night = tariff_rows(10), tariff_rows(4)
+    station_id = make_station(tariff_id=day)
+    engine = TariffEngine(db_pool)
+    cache = StationStateCache(db_pool)
+    cache.subscribe(engine.on_state_change)
+    cache.start()
+    try:
+        wait_listening(db_pool, NOTIFY_CHANNEL)
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            assert engine.tariff_for_station(cur, station_id).id == day
+            # Правка мимо приложений: событие рассылает триггер БД
+            cur.execute('UPDATE charging_stations SET tariff_id = %s WHERE id = %s', (night, station_id))
+            conn.commit()
+
+        def switched():
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                return engine.tariff_for_station(cur, station_id).id == night
+        eventually(switched)
+    finally:
+        cache.stop()
+        cache._listener._thread.join(2)
+
+
+def test_update_for_unknown_session_is_not_billed(db_pool, make_station):
+    engine = TariffEngine(db_pool)
+    station_id = make_station()
+
+    assert engine.update(station_id, 42, 1.5) is None
+    assert engine.update(station_id, 42, 2.0) is None
+    assert engine.stats()['restored'] == 0 and engine.stats()['meters'] == 0
@@ -0,0 +1,49 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from common.timeseries import MeterSeries, choose_resolution, partition_name  # noqa: E402
+
+
+def test_readings_roll_up_into_energy_per_interval(db_pool):
+    series = MeterSeries(db_pool, flush_interval=60)
+    # Первое показание - точка отсчета, уменьшение - сброс счетчика
+    for energy in (1.0, 3.0, 2.5, 4.0):
+        assert series.record(1, 10, 5, energy)
+    series.record(2, 11, 5, 7.0)
+
+    assert series.flush() == 5
+    start = datetime.now() - timedelta(days=1)
+    end = datetime.now() + timedelta(days=1)
+    for resolution in ('1m', '1h', '1d'):
+        _, points = series.curve(start, end, station_id=1, resolution=resolution)
+        assert sum(point['energy'] for point in points) == 3.5
+        assert sum(point['samples'] for point in points) == 4
+    _, points = series.curve(start, end, user_id=5, resolution='1d')
+    assert [point['samples'] for point in points] == [5]
+    assert choose_resolution(start, end) == '1h'
+    assert choose_resolution(end - timedelta(hours=1), end) == '1m'
+    assert choose_resolution(start - timedelta(days=400), end) == '1d'
+
+
+def test_bad_readings_are_rejected_and_old_partitions_dropped(db_pool):
+    series = MeterSeries(db_pool, flush_interval=60, retention_days=7, max_pending=2)
+
+    assert not series.record(1, None, 5, 1.0)
+    assert not series.record(1, 10, 5, 'lots')
+    assert not series.record(1, 10, 5, float('nan'))
+    assert series.record(1, 10, 5, 1.0) and series.record(1, 10, 5, 2.0)
+    assert not series.record(1, 10, 5, 3.0)
+    assert series.stats()['invalid'] == 2 and series.stats()['dropped'] == 1
+
+    old_day = date.today() - timedelta(days=30)
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        series._ensure_partitions(cur, {old_day})
+        conn.commit()
+    series.maintain()
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT to_regclass(%s)', (partition_name(old_day),))
+        assert cur.fetchone()[0] is None
+    assert series.stats()['partitions_dropped'] == 1